@@ -3,7 +3,7 @@
 {
     "name": "Cetmix Tower Server Management",
     "summary": "Flexible Server Management directly from Odoo",
-    "version": "14.0.0.3.24",
+    "version": "14.0.0.4.0",
     "category": "Productivity",
     "website": "https://cetmix.com",
     "author": "Cetmix",
@@ -52,6 +52,7 @@
         "views/cx_tower_file_template_view.xml",
         "views/cx_tower_server_log_view.xml",
         "views/cx_tower_server_template_view.xml",
+        "views/cx_tower_log_retention_view.xml",
         "views/menuitems.xml",
     ],
     "demo": [
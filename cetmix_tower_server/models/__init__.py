@@ -20,5 +20,6 @@ from . import cx_tower_plan_line
 from . import cx_tower_plan_line_action
 from . import cx_tower_plan_log
 from . import cx_tower_server_log
+from . import cx_tower_log_retention
 from . import cx_tower_server_template
 from . import cetmix_tower
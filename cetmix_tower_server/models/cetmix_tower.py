@@ -27,6 +27,17 @@ class CetmixTower(models.AbstractModel):
             template_reference=template_reference, server_name=server_name, **kwargs
         )
 
+    @api.model
+    def servers_create_from_templates(self, server_specs):
+        """Shortcut for the 'create_servers_from_templates' method
+        of the 'cx.tower.server.template' model.
+
+        Important! Add dedicated tests for this function if modified later.
+        """
+        return self.env["cx.tower.server.template"].create_servers_from_templates(
+            server_specs
+        )
+
     @api.model
     def server_set_variable_value(self, server_reference, variable_reference, value):
         """Set variable value for selected server.
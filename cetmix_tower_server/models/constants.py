@@ -32,3 +32,7 @@ PLAN_LINE_CONDITION_CHECK_FAILED = -20
 
 # Returned when the command failed to execute due to a python code execution error
 PYTHON_COMMAND_ERROR = -24
+
+# Set to the command that was running when its flight plan was interrupted
+# (eg on worker restart) and then resumed
+PLAN_INTERRUPTED = -25
@@ -1,7 +1,92 @@
 # Copyright (C) 2022 Cetmix OÜ
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import gzip
+from functools import partial
+
 from odoo import _, api, fields, models
 
+# {output field: field of the attachment with the full output}
+OUTPUT_ATTACHMENT_FIELDS = {
+    "command_response": "response_attachment_id",
+    "command_error": "error_attachment_id",
+}
+
+# Max number of commands listed in a notification digest
+COMMAND_DIGEST_MAX_LINES = 10
+
+
+class CommandOutputWriter:
+    """Save output of a running command in a separate transaction.
+    Output is appended to the `cx_tower_command_log_output` table
+    so the command log record itself is never updated concurrently
+    with the transaction running the command.
+    Cursor is opened on the first write and kept until the writer is closed.
+
+    Args:
+        registry (Registry): database registry
+        command_log_id (int): command log id
+        max_size (int): number of the last output characters kept. 0 - all.
+    """
+
+    def __init__(self, registry, command_log_id, max_size=0):
+        self.registry = registry
+        self.command_log_id = command_log_id
+        self.max_size = max_size
+        self._cr = None
+
+    def write(self, response=None, error=None):
+        """Append new output
+
+        Args:
+            response (Text): command response received since the previous call
+            error (Text): command error received since the previous call
+        """
+        if not response and not error:
+            return
+        if self._cr is None:
+            self._cr = self.registry.cursor()
+        self._cr.execute(
+            """
+            INSERT INTO cx_tower_command_log_output
+                (command_log_id, command_response, command_error)
+            VALUES (%s, %s, %s)
+            """,
+            (self.command_log_id, response or "", error or ""),
+        )
+        if self.max_size > 0:
+            # Remove chunks that are fully covered by the newer ones
+            self._cr.execute(
+                """
+                DELETE FROM cx_tower_command_log_output
+                WHERE id IN (
+                    SELECT id FROM (
+                        SELECT
+                            id,
+                            command_response,
+                            command_error,
+                            SUM(LENGTH(command_response)) OVER newer AS response_size,
+                            SUM(LENGTH(command_error)) OVER newer AS error_size
+                        FROM cx_tower_command_log_output
+                        WHERE command_log_id = %(id)s
+                        WINDOW newer AS (
+                            ORDER BY id DESC
+                            ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                        )
+                    ) AS chunk
+                    WHERE (command_response = '' OR response_size >= %(max_size)s)
+                        AND (command_error = '' OR error_size >= %(max_size)s)
+                )
+                """,
+                {"id": self.command_log_id, "max_size": self.max_size},
+            )
+        self._cr.commit()
+
+    def close(self):
+        """Close the cursor. Saved output is kept until the log is finished."""
+        if self._cr is not None:
+            self._cr.close()
+            self._cr = None
+
 
 class CxTowerCommandLog(models.Model):
     _name = "cx.tower.command.log"
@@ -18,6 +103,11 @@ class CxTowerCommandLog(models.Model):
     # -- Time
     start_date = fields.Datetime(string="Started")
     finish_date = fields.Datetime(string="Finished")
+    output_date = fields.Datetime(
+        string="Last Output",
+        compute="_compute_output_date",
+        help="Last time the output of the running command was saved",
+    )
     duration = fields.Float(
         help="Time consumed for execution, seconds",
         compute="_compute_duration",
@@ -38,6 +128,24 @@ class CxTowerCommandLog(models.Model):
     command_status = fields.Integer(string="Exit Code")
     command_response = fields.Text(string="Response")
     command_error = fields.Text(string="Error")
+    response_attachment_id = fields.Many2one(
+        comodel_name="ir.attachment",
+        readonly=True,
+        copy=False,
+        help="Compressed full response. Response field keeps its preview only",
+    )
+    error_attachment_id = fields.Many2one(
+        comodel_name="ir.attachment",
+        readonly=True,
+        copy=False,
+        help="Compressed full error. Error field keeps its preview only",
+    )
+    command_response_full = fields.Text(
+        string="Full Response", compute="_compute_command_output_full"
+    )
+    command_error_full = fields.Text(
+        string="Full Error", compute="_compute_command_output_full"
+    )
     use_sudo = fields.Selection(
         string="Use sudo",
         selection=[("n", "Without password"), ("p", "With password")],
@@ -53,6 +161,42 @@ class CxTowerCommandLog(models.Model):
     # -- Flight Plan
     plan_log_id = fields.Many2one(comodel_name="cx.tower.plan.log", ondelete="cascade")
 
+    def init(self):
+        """Create indexes:
+        - to check if the command is already running on the server
+        - to select logs removed by log retention policies
+
+        Create table for the output of running commands.
+        It has no foreign key because the output is saved
+        before the log record is committed.
+        """
+        self.env.cr.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cx_tower_command_log_output (
+                id SERIAL PRIMARY KEY,
+                command_log_id INTEGER NOT NULL,
+                create_date TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'UTC'),
+                command_response TEXT NOT NULL DEFAULT '',
+                command_error TEXT NOT NULL DEFAULT ''
+            );
+            CREATE INDEX IF NOT EXISTS cx_tower_command_log_output_log_index
+            ON cx_tower_command_log_output (command_log_id, id);
+            """
+        )
+        self.env.cr.execute(
+            """
+            CREATE INDEX IF NOT EXISTS cx_tower_command_log_running_index
+            ON cx_tower_command_log (server_id, command_id)
+            WHERE is_running
+            """
+        )
+        self.env.cr.execute(
+            """
+            CREATE INDEX IF NOT EXISTS cx_tower_command_log_server_start_date_index
+            ON cx_tower_command_log (server_id, start_date)
+            """
+        )
+
     @api.depends("name", "command_id.name")
     def _compute_name(self):
         for rec in self:
@@ -66,6 +210,144 @@ class CxTowerCommandLog(models.Model):
                     command_log.finish_date - command_log.start_date
                 ).total_seconds()
 
+    def _compute_output_date(self):
+        saved_output = self._get_running_output()
+        for command_log in self:
+            command_log.output_date = saved_output.get(command_log.id, {}).get(
+                "output_date"
+            )
+
+    @api.depends(
+        "is_running",
+        "command_response",
+        "command_error",
+        "response_attachment_id",
+        "error_attachment_id",
+    )
+    def _compute_command_output_full(self):
+        """Full output is read from the attachments only when it is accessed,
+        eg when the log form is opened.
+        Output of running commands is read from the chunks saved so far.
+        """
+        running_output = self.filtered("is_running")._get_running_output()
+        for command_log in self:
+            saved_output = running_output.get(command_log.id)
+            command_log.update(
+                {
+                    f"{field_name}_full": saved_output[field_name]
+                    if saved_output
+                    else command_log._get_command_output(field_name)
+                    for field_name in OUTPUT_ATTACHMENT_FIELDS
+                }
+            )
+
+    def _get_command_output(self, field_name):
+        """Get full command output
+
+        Args:
+            field_name (Char): `command_response` or `command_error`
+
+        Returns:
+            Text: output
+        """
+        self.ensure_one()
+        attachment = self[OUTPUT_ATTACHMENT_FIELDS[field_name]].sudo()
+        if attachment:
+            return gzip.decompress(attachment.raw).decode()
+        return self[field_name]
+
+    def _prepare_command_output_values(self, vals):
+        """Move large command output into compressed attachments.
+        Only a preview made of the beginning and the end of the output
+        is kept in the log.
+        Settings are taken from the system parameters:
+            - `cetmix_tower_server.command_output_compress_threshold`: output
+                larger than this number of characters is compressed. 0 - disable.
+            - `cetmix_tower_server.command_output_preview_size`: number of
+                characters kept from the beginning and the end of the output.
+
+        Args:
+            vals (dict): values to write
+
+        Returns:
+            dict: updated values
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        threshold = int(
+            get_param("cetmix_tower_server.command_output_compress_threshold", 0)
+        )
+        if threshold <= 0:
+            return vals
+        preview_size = int(
+            get_param("cetmix_tower_server.command_output_preview_size", 1000)
+        )
+        for field_name, attachment_field in OUTPUT_ATTACHMENT_FIELDS.items():
+            output = vals.get(field_name)
+            if not output or len(output) <= threshold:
+                continue
+            attachment = (
+                self.env["ir.attachment"]
+                .sudo()
+                .create(
+                    {
+                        "name": f"{field_name}.txt.gz",
+                        "raw": gzip.compress(output.encode()),
+                        "mimetype": "application/gzip",
+                        "res_model": self._name,
+                        "res_id": self.id,
+                    }
+                )
+            )
+            vals.update(
+                {
+                    field_name: self._get_command_output_preview(output, preview_size),
+                    attachment_field: attachment.id,
+                }
+            )
+        return vals
+
+    def _link_command_output_attachments(self):
+        """Link compressed output attachments to their logs.
+        Logs finished together share the same output
+        so each of them gets its own copy of the attachment.
+        """
+        linked_attachments = self.env["ir.attachment"]
+        for command_log in self:
+            for attachment_field in OUTPUT_ATTACHMENT_FIELDS.values():
+                attachment = command_log[attachment_field]
+                if not attachment:
+                    continue
+                if attachment in linked_attachments:
+                    command_log[attachment_field] = attachment.copy(
+                        {"res_id": command_log.id}
+                    )
+                else:
+                    attachment.write({"res_id": command_log.id})
+                    linked_attachments |= attachment
+
+    def _get_command_output_preview(self, output, preview_size):
+        """Get preview of the command output
+
+        Args:
+            output (Text): command output
+            preview_size (int): number of characters kept
+                from the beginning and the end of the output
+
+        Returns:
+            Text: preview
+        """
+        if len(output) <= preview_size * 2:
+            return output
+        return "%s\n\n%s\n\n%s" % (
+            output[:preview_size],
+            _(
+                "... %(count)s characters skipped. Full output is saved "
+                "in the attachment ...",
+                count=len(output) - preview_size * 2,
+            ),
+            output[-preview_size:],
+        )
+
     def _compute_duration_current(self):
         """Shows relative time between now() and start time for running commands,
         and computed duration for finished ones.
@@ -111,25 +393,131 @@ class CxTowerCommandLog(models.Model):
             finish_date (Datetime): command finish date time.
             **kwargs (dict): optional values
         """
-        now = fields.Datetime.now()
+        # All logs are finished with a single write
+        logs = self.sudo()
+        vals = {
+            "is_running": False,
+            "finish_date": finish_date if finish_date else fields.Datetime.now(),
+            "command_status": -1 if status is None else status,
+            "command_response": response,
+            "command_error": error,
+        }
+        # Apply kwargs and write
+        vals.update(kwargs)
+        logs.write(logs.browse()._prepare_command_output_values(vals))
+        logs._update_duration()
+        logs._link_command_output_attachments()
+        logs._delete_running_output()
 
-        for rec in self.sudo():
-            # Duration
-            date_finish = finish_date if finish_date else now
+        # Trigger post finish hook
+        logs._command_finished()
 
-            vals = {
-                "is_running": False,
-                "finish_date": date_finish,
-                "command_status": -1 if status is None else status,
-                "command_response": response,
-                "command_error": error,
+    def _update_duration(self):
+        """Compute duration of all logs with a single query
+        instead of recomputing it for each log separately.
+        """
+        if not self:
+            return
+        self.env.remove_to_compute(self._fields["duration"], self)
+        self.flush(["start_date", "finish_date"])
+        self.env.cr.execute(
+            """
+            UPDATE cx_tower_command_log
+            SET duration = EXTRACT(EPOCH FROM finish_date - start_date)
+            WHERE id IN %s AND start_date IS NOT NULL AND finish_date IS NOT NULL
+            """,
+            (tuple(self.ids),),
+        )
+        self.invalidate_cache(["duration"], self.ids)
+
+    def _get_output_writer(self):
+        """Get writer saving output of the running command.
+        Only the last part of the output is kept according to
+        the `cetmix_tower_server.command_output_max_size` system parameter.
+        Final output is saved by `finish()`.
+
+        Returns:
+            CommandOutputWriter: output writer. Must be closed when
+                the command is finished.
+        """
+        self.ensure_one()
+        max_size = int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("cetmix_tower_server.command_output_max_size", default=10485760)
+        )
+        return CommandOutputWriter(self.pool, self.id, max_size)
+
+    def _get_running_output(self):
+        """Get output saved while the commands were running
+
+        Returns:
+            dict: {log id: {"command_response": Text, "command_error": Text,
+                "output_date": Datetime}}
+        """
+        if not self.ids:
+            return {}
+        self.env.cr.execute(
+            """
+            SELECT
+                command_log_id,
+                STRING_AGG(command_response, '' ORDER BY id),
+                STRING_AGG(command_error, '' ORDER BY id),
+                MAX(create_date)
+            FROM cx_tower_command_log_output
+            WHERE command_log_id IN %s
+            GROUP BY command_log_id
+            """,
+            (tuple(self.ids),),
+        )
+        max_size = int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("cetmix_tower_server.command_output_max_size", default=10485760)
+        )
+        return {
+            command_log_id: {
+                "command_response": response[-max_size:] if max_size > 0 else response,
+                "command_error": error[-max_size:] if max_size > 0 else error,
+                "output_date": output_date,
             }
-            # Apply kwargs and write
-            vals.update(kwargs)
-            rec.write(vals)
+            for command_log_id, response, error, output_date in self.env.cr.fetchall()
+        }
 
-            # Trigger post finish hook
-            rec._command_finished()
+    def _delete_running_output(self):
+        """Delete output saved while the commands were running.
+        Output is saved by other transactions so it is deleted
+        after the current transaction is committed.
+        """
+        if not self.ids:
+            return
+        self.env.cr.postcommit.add(
+            partial(self._delete_output_chunks, self.pool, tuple(self.ids))
+        )
+
+    @staticmethod
+    def _delete_output_chunks(registry, command_log_ids):
+        with registry.cursor() as cr:
+            cr.execute(
+                "DELETE FROM cx_tower_command_log_output WHERE command_log_id IN %s",
+                (command_log_ids,),
+            )
+
+    @api.autovacuum
+    def _gc_running_output(self):
+        """Delete output of the commands that are not running anymore,
+        eg if the transaction running the command was rolled back.
+        """
+        self.env.cr.execute(
+            """
+            DELETE FROM cx_tower_command_log_output AS chunk
+            WHERE chunk.create_date < (NOW() AT TIME ZONE 'UTC') - INTERVAL '1 day'
+                AND NOT EXISTS (
+                    SELECT 1 FROM cx_tower_command_log
+                    WHERE id = chunk.command_log_id AND is_running
+                )
+            """
+        )
 
     def record(
         self,
@@ -169,41 +557,126 @@ class CxTowerCommandLog(models.Model):
                 "command_error": error,
             }
         )
-        rec = self.sudo().create(vals)
+        rec = self.sudo().create(self._prepare_command_output_values(vals))
+        rec._link_command_output_attachments()
         rec._command_finished()
         return rec
 
     def _command_finished(self):
         """Triggered when command is finished
         Inherit to implement your own hooks
+        Context:
+            cx_tower_command_notifications (list): if provided notifications
+                are added to this list instead of being sent. Use it to send
+                a single digest for several commands using
+                `_send_command_notifications()`.
         """
-        # Trigger next flightplan line
+        notifications = []
         for rec in self:
-            context_timestamp = fields.Datetime.context_timestamp(
-                self, fields.Datetime.now()
-            )
+            # Trigger next flightplan line
             if rec.plan_log_id:  # type: ignore
                 rec.plan_log_id._plan_command_finished(rec)  # type: ignore
-            elif rec.command_status == 0:
-                rec.create_uid.notify_success(
+            else:
+                notifications.append(rec._prepare_command_notification())
+
+        collected_notifications = self._context.get("cx_tower_command_notifications")
+        if collected_notifications is not None:
+            collected_notifications += notifications
+        else:
+            self._send_command_notifications(notifications)
+
+    def _prepare_command_notification(self):
+        """Prepare values of the notification about the finished command.
+        Only plain values are used so notifications can be collected
+        in different transactions.
+
+        Returns:
+            dict: notification values
+        """
+        self.ensure_one()
+        return {
+            "user_id": self.create_uid.id,
+            "success": self.command_status == 0,
+            "name": self.command_id.name,
+            "server_name": self.server_id.name,
+            "timestamp": str(
+                fields.Datetime.context_timestamp(self, fields.Datetime.now())
+            ),
+        }
+
+    @api.model
+    def _send_command_notifications(self, notifications):
+        """Notify users about finished commands.
+        Notifications of the same user are sent in a single message
+        for successful and for failed commands.
+
+        Args:
+            notifications (list of dict): values returned by
+                `_prepare_command_notification()`
+        """
+        grouped_notifications = {}
+        for notification in notifications:
+            grouped_notifications.setdefault(
+                (notification["user_id"], notification["success"]), []
+            ).append(notification)
+
+        for (user_id, success), user_notifications in grouped_notifications.items():
+            user = self.env["res.users"].sudo().browse(user_id)
+            notification = user_notifications[-1]
+            if len(user_notifications) == 1 and success:
+                user.notify_success(
                     message=_(
-                        "%(timestamp)s<br/>" "Command '%(name)s' finished successfully",
-                        name=rec.command_id.name,
-                        timestamp=context_timestamp,
+                        "%(timestamp)s<br/>Command '%(name)s' finished successfully",
+                        name=notification["name"],
+                        timestamp=notification["timestamp"],
                     ),
-                    title=rec.server_id.name,
+                    title=notification["server_name"],
                     sticky=True,
                 )
-            else:
-                rec.create_uid.notify_danger(
+            elif len(user_notifications) == 1:
+                user.notify_danger(
                     message=_(
                         "%(timestamp)s<br/>"
                         "Command '%(name)s'"
                         " finished with error. "
                         "Please check the command log for details.",
-                        name=rec.command_id.name,
-                        timestamp=context_timestamp,
+                        name=notification["name"],
+                        timestamp=notification["timestamp"],
                     ),
-                    title=rec.server_id.name,
+                    title=notification["server_name"],
                     sticky=True,
                 )
+            else:
+                commands = "<br/>".join(
+                    f"{item['server_name']}: {item['name']}"
+                    for item in user_notifications[:COMMAND_DIGEST_MAX_LINES]
+                )
+                if len(user_notifications) > COMMAND_DIGEST_MAX_LINES:
+                    commands += "<br/>..."
+                if success:
+                    user.notify_success(
+                        message=_(
+                            "%(timestamp)s<br/>"
+                            "%(count)s commands finished successfully:<br/>"
+                            "%(commands)s",
+                            count=len(user_notifications),
+                            commands=commands,
+                            timestamp=notification["timestamp"],
+                        ),
+                        title=_("Cetmix Tower"),
+                        sticky=True,
+                    )
+                else:
+                    user.notify_danger(
+                        message=_(
+                            "%(timestamp)s<br/>"
+                            "%(count)s commands finished with error. "
+                            "Please check the command logs for details:<br/>"
+                            "%(commands)s",
+                            count=len(user_notifications),
+                            commands=commands,
+                            timestamp=notification["timestamp"],
+                        ),
+                        title=_("Cetmix Tower"),
+                        sticky=True,
+                    )
@@ -1,12 +1,25 @@
 # Copyright (C) 2022 Cetmix OÜ
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
-from base64 import b64decode, b64encode
+import hashlib
+import hmac
+import io
+import os
+import re
+import shutil
+import tempfile
+import time
 
 from dateutil.relativedelta import relativedelta
 
 from odoo import _, api, fields, models
 from odoo.exceptions import AccessError, UserError, ValidationError
-from odoo.tools import exception_to_unicode
+from odoo.tools import config, exception_to_unicode
+from odoo.tools.mimetypes import guess_mimetype
+
+from .tools import HashingFile
+
+# Downloaded files larger than this are spooled to disk, bytes
+DOWNLOAD_SPOOL_MAX_SIZE = 1024 * 1024
 
 # mapping of field names from template and field names from file
 TEMPLATE_FILE_FIELD_MAPPING = {
@@ -104,6 +117,17 @@ class CxTowerFile(models.Model):
         "Otherwise there will be a server error message logged."
     )
     server_id = fields.Many2one(comodel_name="cx.tower.server", required=True)
+    content_hash = fields.Char(
+        readonly=True,
+        copy=False,
+        help="Hash of the file content after the latest synchronisation",
+    )
+    remote_stat = fields.Char(
+        readonly=True,
+        copy=False,
+        help="Size and modification time of the file on server "
+        "after the latest synchronisation",
+    )
     code_on_server = fields.Text(
         readonly=True,
         help="Latest version of file content on server",
@@ -251,6 +275,11 @@ class CxTowerFile(models.Model):
         Override to sync files from tower
         """
         vals = self._sanitize_values(vals)
+        # File must be synced in full if its content or location is modified
+        if "content_hash" not in vals and any(
+            field in vals for field in self._get_content_field_names()
+        ):
+            vals.update({"content_hash": False, "remote_stat": False})
         result = super().write(vals)
 
         # sync tower files after change
@@ -294,14 +323,14 @@ class CxTowerFile(models.Model):
             lambda file: file.auto_sync and file.source == "server"
         )
         if server_files_to_sync:
-            server_files_to_sync.action_pull_from_server()
+            server_files_to_sync.download(raise_error=True)
 
         # Push all `auto_sync` tower files
         tower_files_to_sync = self.filtered(
             lambda file: file.auto_sync and file.source == "tower"
         )
         if tower_files_to_sync:
-            tower_files_to_sync.action_push_to_server()
+            tower_files_to_sync.upload(raise_error=True)
 
     def action_modify_code(self):
         self.ensure_one()
@@ -326,7 +355,7 @@ class CxTowerFile(models.Model):
                     "sticky": False,
                 },
             }
-        self.upload(raise_error=True)
+        self.upload(raise_error=True, force=True)
         single_msg = _("File uploaded!")
         plural_msg = _("Files uploaded!")
         return {
@@ -346,7 +375,7 @@ class CxTowerFile(models.Model):
         tower_files = self.filtered(lambda file_: file_.source == "tower")
         server_files = self - tower_files
         tower_files.action_get_current_server_code()
-        res = server_files.download(raise_error=True)
+        res = server_files.download(raise_error=True, force=True)
         if isinstance(res, dict):
             return res
 
@@ -457,7 +486,7 @@ class CxTowerFile(models.Model):
             )
         return values
 
-    def download(self, raise_error=False):
+    def download(self, raise_error=False, force=False):
         """Wrapper function for file download.
         Use it for custom hooks implementation.
 
@@ -465,10 +494,12 @@ class CxTowerFile(models.Model):
             raise_error (bool, optional):
                 Will raise and exception on error if set to 'True'.
                 Defaults to False.
+            force (bool, optional): Download file even if it was not
+                modified on server since the latest sync. Defaults to False.
         """
-        return self._process("download", raise_error)
+        return self._process("download", raise_error, force)
 
-    def upload(self, raise_error=False):
+    def upload(self, raise_error=False, force=False):
         """Wrapper function for file upload.
         Use it for custom hooks implementation.
 
@@ -476,8 +507,11 @@ class CxTowerFile(models.Model):
             raise_error (bool, optional):
                 Will raise and exception on error if set to 'True'.
                 Defaults to False.
+            force (bool, optional): Upload file even if neither its content
+                nor the file on server was modified since the latest sync.
+                Defaults to False.
         """
-        self._process("upload", raise_error)
+        self._process("upload", raise_error, force)
 
     def delete(self, raise_error=False):
         """Wrapper function for file removal.
@@ -490,10 +524,107 @@ class CxTowerFile(models.Model):
         """
         self._process("delete", raise_error)
 
+    def _get_content_field_names(self):
+        """
+        Return the list of field names that affect the file content
+        or its location on server
+        """
+        return ["name", "server_dir", "server_id", "code", "file", "file_type"]
+
+    def _get_content_hash(self, content):
+        """Compute hash of the file content.
+        Hash is keyed with the database secret so it cannot be used
+        to guess the secret values used in file.
+
+        Args:
+            content (Text, Bytes): file content
+
+        Returns:
+            Char: content hash
+        """
+        if isinstance(content, str):
+            content = content.encode()
+        secret = self.env["ir.config_parameter"].sudo().get_param("database.secret", "")
+        return hmac.new(secret.encode(), content, hashlib.sha256).hexdigest()
+
+    @api.model
+    def _format_remote_stat(self, size, mtime):
+        """Compose value of the `remote_stat` field
+
+        Args:
+            size (Int): file size in bytes
+            mtime (Int): file modification timestamp
+
+        Returns:
+            Char: remote stat value
+        """
+        return f"{size}:{mtime}"
+
+    def _get_remote_stat(self, remote_path):
+        """Get size and modification time of the file on server.
+
+        Args:
+            remote_path (Char): file path on server
+
+        Returns:
+            Char: `remote_stat` field value or None if not available
+        """
+        self.ensure_one()
+        try:
+            stat = self.server_id.stat_file(remote_path)
+        except Exception:
+            # File will be synced in full
+            return None
+        return self._format_remote_stat(stat["size"], stat["mtime"])
+
+    def _process_upload(self, tower_key_obj, force=False):
+        """
+        Processing of file upload.
+        Upload is skipped if neither the file content nor the file on server
+        was modified since the latest sync.
+
+        Args:
+            tower_key_obj (RecordSet): `cx.tower.key`
+                recordset to parse file path and content.
+            force (bool): Upload file anyway.
+        """
+        self.ensure_one()
+        remote_path = tower_key_obj._parse_code(self.full_server_path)
+        if self.file_type == "binary":
+            # Checksum is computed by the attachment so file is not read here
+            attachment = self._get_file_attachment()
+            content_hash = attachment.checksum
+        else:
+            file_content = tower_key_obj._parse_code(self.rendered_code)
+            content_hash = self._get_content_hash(file_content)
+        if (
+            not force
+            and content_hash
+            and self.remote_stat
+            and content_hash == self.content_hash
+            and self.remote_stat == self._get_remote_stat(remote_path)
+        ):
+            return
+
+        if self.file_type == "binary":
+            # Stream file content directly from the filestore
+            with self._open_file_attachment(attachment) as file_content:
+                result = self.server_id.upload_file(file_content, remote_path)
+        else:
+            result = self.server_id.upload_file(file_content, remote_path)
+        self.write(
+            {
+                "content_hash": content_hash,
+                "remote_stat": hasattr(result, "st_size")
+                and self._format_remote_stat(result.st_size, result.st_mtime),
+            }
+        )
+
     def _process_download(
         self,
         tower_key_obj,
         is_server_code_version_process=False,
+        force=False,
     ):
         """
         Processing of file download.
@@ -506,6 +637,8 @@ class CxTowerFile(models.Model):
             is_server_code_version_process (bool):
                 Flag to fetch actual file content from server
                 for a `tower` type file.
+            force (bool): Download file even if it was not modified
+                on server since the latest sync.
 
         Returns:
             [dict|str|None]:
@@ -515,9 +648,30 @@ class CxTowerFile(models.Model):
                 None otherwise.
         """
         self.ensure_one()
-        code = self.server_id.download_file(
-            tower_key_obj._parse_code(self.full_server_path),
-        )
+        remote_path = tower_key_obj._parse_code(self.full_server_path)
+        remote_stat = None
+        if not is_server_code_version_process:
+            remote_stat = self._get_remote_stat(remote_path)
+            # File was not modified since the latest sync
+            if (
+                not force
+                and remote_stat
+                and self.content_hash
+                and remote_stat == self.remote_stat
+            ):
+                return
+
+        if self.file_type == "binary" and not is_server_code_version_process:
+            # Binary files are streamed directly to the filestore
+            self.write(
+                {
+                    "remote_stat": remote_stat,
+                    "content_hash": self._download_file_attachment(remote_path),
+                }
+            )
+            return
+
+        code = self.server_id.download_file(remote_path)
         if self.file_type == "text" and b"\x00" in code:
             return {
                 "type": "ir.actions.client",
@@ -536,12 +690,143 @@ class CxTowerFile(models.Model):
         # In case server version of a 'tower' file is requested
         if is_server_code_version_process:
             return code
-        if self.file_type == "binary":
-            self.file = b64encode(code)
+
+        # Save content only if it was modified to avoid useless updates
+        vals = {"remote_stat": remote_stat}
+        content_hash = self._get_content_hash(code)
+        if content_hash != self.content_hash:
+            vals.update({"content_hash": content_hash, "code": code})
+        self.write(vals)
+
+    def _get_file_attachment(self):
+        """Get attachment that stores the `file` field value
+
+        Returns:
+            ir.attachment(): attachment or empty recordset
+        """
+        self.ensure_one()
+        return (
+            self.env["ir.attachment"]
+            .sudo()
+            .search(
+                [
+                    ("res_model", "=", self._name),
+                    ("res_field", "=", "file"),
+                    ("res_id", "=", self.id),
+                ],
+                limit=1,
+            )
+        )
+
+    @api.model
+    def _open_file_attachment(self, attachment):
+        """Open attachment content for reading.
+        Attachments stored in the filestore are read directly from disk.
+        Attachments stored in the database or missing in the filestore
+        are read using the `raw` field.
+
+        Args:
+            attachment (ir.attachment()): attachment to read
+
+        Returns:
+            file object: attachment content
+        """
+        if attachment.store_fname:
+            try:
+                return open(self._get_filestore_path(attachment.store_fname), "rb")
+            except OSError:
+                pass
+        return io.BytesIO(attachment.raw or b"")
+
+    @api.model
+    def _get_filestore_path(self, store_fname):
+        """Get full path of the file in the filestore
+
+        Args:
+            store_fname (Char): attachment `store_fname`
+
+        Returns:
+            Char: full path
+        """
+        # Same sanitizing as in `ir.attachment`
+        store_fname = re.sub("[.]", "", store_fname).strip("/\\")
+        return os.path.join(config.filestore(self.env.cr.dbname), store_fname)
+
+    def _download_file_attachment(self, remote_path):
+        """Download binary file from server into the `file` field.
+        File is streamed into a temporary file and hashed on the fly.
+        Small files are kept in memory, larger ones are spooled to disk.
+        Attachment is updated only if the file content was modified,
+        so unchanged files are never loaded to memory at once.
+
+        Args:
+            remote_path (Char): file path on server
+
+        Returns:
+            Char: content hash (attachment checksum)
+        """
+        self.ensure_one()
+        attachment = self._get_file_attachment()
+        with tempfile.SpooledTemporaryFile(
+            max_size=DOWNLOAD_SPOOL_MAX_SIZE
+        ) as temp_file:
+            hashing_file = HashingFile(temp_file)
+            self.server_id.download_fileobj(remote_path, hashing_file)
+            checksum = hashing_file.hexdigest()
+            if checksum != attachment.checksum:
+                temp_file.seek(0)
+                self._save_file_attachment(temp_file, checksum, hashing_file.size)
+        return checksum
+
+    def _save_file_attachment(self, file, checksum, file_size):
+        """Replace attachment of the `file` field with the file content.
+        If attachments are stored in the filestore the file is copied
+        there in chunks without loading it to memory.
+
+        Args:
+            file (file object): file content
+            checksum (Char): SHA1 hash of the file content
+            file_size (int): file size in bytes
+        """
+        self.ensure_one()
+        vals = {
+            "name": "file",
+            "type": "binary",
+            "res_model": self._name,
+            "res_field": "file",
+            "res_id": self.id,
+        }
+        location = (
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("ir_attachment.location", "file")
+        )
+        if location == "file":
+            # Filestore file name is made of the checksum as in `ir.attachment`
+            store_fname = f"{checksum[:2]}/{checksum}"
+            full_path = self._get_filestore_path(store_fname)
+            if not os.path.exists(full_path):
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                with open(full_path, "wb") as store_file:
+                    shutil.copyfileobj(file, store_file)
+            file.seek(0)
+            vals.update(
+                {
+                    "store_fname": store_fname,
+                    "checksum": checksum,
+                    "file_size": file_size,
+                    "mimetype": guess_mimetype(file.read(1024)),
+                }
+            )
         else:
-            self.code = code
+            vals["raw"] = file.read()
 
-    def _process(self, action, raise_error=False):
+        # Old attachment file is removed by the filestore garbage collector
+        self._get_file_attachment().unlink()
+        self.env["ir.attachment"].sudo().create(vals)
+        self.invalidate_cache(["file"], self.ids)
+
+    def _process(self, action, raise_error=False, force=False):
         """Upload or download file to/from server.
         Important!
         This function will return a value only in case `is_server_code_version_process`
@@ -561,6 +846,8 @@ class CxTowerFile(models.Model):
                     - "delete": Delete file.
             raise_error (bool, optional): Raise exception if there was an error
                  during the operation. Defaults to False.
+            force (bool, optional): Transfer file even if it was not modified
+                since the latest sync. Defaults to False.
 
         Raises:
             UserError: In case file format doesn't match the requested operation.
@@ -576,7 +863,10 @@ class CxTowerFile(models.Model):
         is_server_code_version_process = self.env.context.get(
             "is_server_code_version_process"
         )
+        # Files which content was not modified by the operation
+        unchanged_files = self.browse()
         for file in self:
+            content_hash = file.content_hash
             if not is_server_code_version_process and (
                 (action == "download" and file.source != "server")
                 or (action == "upload" and file.source != "tower")
@@ -612,19 +902,12 @@ class CxTowerFile(models.Model):
             try:
                 if action == "download":
                     res = file._process_download(
-                        tower_key_obj, is_server_code_version_process
+                        tower_key_obj, is_server_code_version_process, force
                     )
                     if res:
                         return res
                 elif action == "upload":
-                    if file.file_type == "binary":
-                        file_content = b64decode(file.file)
-                    else:
-                        file_content = tower_key_obj._parse_code(file.rendered_code)
-                    file.server_id.upload_file(
-                        file_content,
-                        tower_key_obj._parse_code(file.full_server_path),
-                    )
+                    file._process_upload(tower_key_obj, force)
                 elif action == "delete":
                     file.server_id.delete_file(
                         tower_key_obj._parse_code(file.full_server_path)
@@ -642,9 +925,14 @@ class CxTowerFile(models.Model):
                         )
                     ) from error
                 file.server_response = repr(error)
+            if content_hash and file.content_hash == content_hash:
+                unchanged_files |= file
 
         if not is_server_code_version_process:
-            self._update_file_sync_date(fields.Datetime.now())
+            now = fields.Datetime.now()
+            (self - unchanged_files)._update_file_sync_date(now)
+            # Do not track sync of unchanged files
+            unchanged_files.with_context(mail_notrack=True)._update_file_sync_date(now)
 
     @api.model
     def _get_tower_sync_field_names(self):
@@ -657,17 +945,37 @@ class CxTowerFile(models.Model):
     @api.model
     def _run_auto_pull_files(self):
         """
-        Run auto sync files
-        """
+        Run auto sync files.
+        Files are grouped by server. Servers are processed in parallel
+        (check `cx.tower.server._fan_out()`) while files of the same server
+        are pulled one by one using the same connection.
+        Settings are taken from the system parameters:
+            - `cetmix_tower_server.file_auto_pull_batch_size`: max number
+                of files pulled in a single run. 0 means no limit.
+            - `cetmix_tower_server.file_auto_pull_time_budget`: max number
+                of seconds a single run can take. Files that are not pulled
+                in time are left for the next run. 0 means no limit.
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        batch_size = int(
+            get_param("cetmix_tower_server.file_auto_pull_batch_size", default=1000)
+        )
+        time_budget = float(
+            get_param("cetmix_tower_server.file_auto_pull_time_budget", default=50)
+        )
+        deadline = time_budget > 0 and time.monotonic() + time_budget or None
+
         now = fields.Datetime.now()
         files = self.search(
             [
                 ("source", "=", "server"),
                 ("auto_sync", "=", True),
                 ("sync_date_next", "<=", now),
-            ]
+            ],
+            order="sync_date_next",
+            limit=batch_size if batch_size > 0 else None,
         )
-        files.download(raise_error=False)
+        files.server_id._fan_out("_pull_files", files, deadline=deadline)
 
     def _update_file_sync_date(self, last_sync_date):
         """
@@ -1,10 +1,18 @@
 # Copyright (C) 2022 Cetmix OÜ
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 import re
+from weakref import WeakKeyDictionary
 
-from odoo import _, api, fields, models
+from odoo import api, fields, models
 from odoo.osv.expression import OR
 
+from .tools import SecretRedactor
+
+# Secret values resolved in the current transaction.
+# Cache is cleared when transaction is finished or keys are modified.
+# {cursor: {(uid, su, server_id, partner_id): {reference: value}}}
+_secret_cache = WeakKeyDictionary()
+
 
 class CxTowerKey(models.Model):
     """SSH Private key and secret storage"""
@@ -80,15 +88,21 @@ class CxTowerKey(models.Model):
         Returns:
             Records: The created record(s).
         """
+        # Group keys by partner and server to generate references at once
+        # {(partner_id, server_id): [vals]}
+        vals_by_scope = {}
         for vals in vals_list:
             vals["name"] = vals["name"].strip()
-            # Generate reference
-            reference = self._generate_or_fix_reference(
-                vals.get("reference") or vals.get("name"),
-                vals.get("partner_id"),
-                vals.get("server_id"),
+            scope = (vals.get("partner_id") or False, vals.get("server_id") or False)
+            vals_by_scope.setdefault(scope, []).append(vals)
+        for (partner_id, server_id), scope_vals_list in vals_by_scope.items():
+            references = self._generate_or_fix_references(
+                [vals.get("reference") or vals.get("name") for vals in scope_vals_list],
+                domain=self._get_reference_scope_domain(partner_id, server_id),
             )
-            vals.update({"reference": reference})
+            for index, vals in enumerate(scope_vals_list):
+                vals.update({"reference": references[index]})
+        self._clear_secret_cache()
         return super(
             CxTowerKey, self.with_context(reference_mixin_override=True)
         ).create(vals_list)
@@ -104,6 +118,7 @@ class CxTowerKey(models.Model):
         Returns:
             Result of the super `write` call.
         """
+        self._clear_secret_cache()
         if "reference" in vals:
             reference = vals.get("reference", vals.get("name"))
             server_id = vals.get("server_id")
@@ -129,6 +144,86 @@ class CxTowerKey(models.Model):
                 return
         return super().write(vals)
 
+    def unlink(self):
+        self._clear_secret_cache()
+        return super().unlink()
+
+    def _clear_secret_cache(self):
+        """Remove secret values cached in the current transaction"""
+        _secret_cache.pop(self.env.cr, None)
+
+    def _get_secret_cache(self, server_id=None, partner_id=None):
+        """Get secret values cached in the current transaction
+        for the server and partner
+
+        Args:
+            server_id (int, optional): server id
+            partner_id (int, optional): partner id
+
+        Returns:
+            dict: {reference: value}
+        """
+        cr = self.env.cr
+        cr_cache = _secret_cache.get(cr)
+        if cr_cache is None:
+            cr_cache = _secret_cache[cr] = {}
+            # Secret values must not outlive the transaction
+            cr.postcommit.add(lambda: _secret_cache.pop(cr, None))
+            cr.postrollback.add(lambda: _secret_cache.pop(cr, None))
+        return cr_cache.setdefault(
+            (self.env.uid, self.env.su, server_id, partner_id), {}
+        )
+
+    def _get_secret_values(self, references, server_id=None, partner_id=None):
+        """Get values of secrets.
+        Secrets that are not cached yet are fetched in a single query.
+
+        Keys are checked in the following order:
+        1. Server specific
+        2. Partner specific
+        3. General (no server or partner specified)
+
+        Args:
+            references (list of Char): key references
+            server_id (int, optional): server id
+            partner_id (int, optional): partner id
+
+        Returns:
+            dict: {reference: value or None}
+        """
+        cache = self._get_secret_cache(server_id, partner_id)
+        references_to_fetch = [
+            reference
+            for reference in set(references)
+            if reference and reference not in cache
+        ]
+        if references_to_fetch:
+            key_domain = [("server_id", "=", False), ("partner_id", "=", False)]
+            if server_id:
+                key_domain = OR([key_domain, [("server_id", "=", server_id)]])
+            if partner_id:
+                key_domain = OR([key_domain, [("partner_id", "=", partner_id)]])
+            key_domain = [("reference", "in", references_to_fetch)] + key_domain
+
+            # {reference: (priority, value)}
+            values = {}
+            for key in self.search(key_domain).sudo():
+                if server_id and key.server_id.id == server_id:
+                    priority = 0
+                elif partner_id and key.partner_id.id == partner_id:
+                    priority = 1
+                else:
+                    priority = 2
+                value = values.get(key.reference)
+                if value is None or priority < value[0]:
+                    values[key.reference] = (priority, key.secret_value)
+
+            for reference in references_to_fetch:
+                value = values.get(reference)
+                cache[reference] = value[1] if value else None
+
+        return {reference: cache.get(reference) for reference in references}
+
     def _get_reference_pattern(self):
         """
         Override mixin method
@@ -149,39 +244,26 @@ class CxTowerKey(models.Model):
         Returns:
             str: Generated or fixed reference.
         """
-        # Check if reference matches the pattern
-        reference_pattern = self._get_reference_pattern()
+        return self._generate_or_fix_references(
+            [reference_source],
+            domain=self._get_reference_scope_domain(partner_id, server_id),
+        )[0]
 
-        if re.fullmatch(rf"{reference_pattern}+", reference_source):
-            reference = reference_source
+    def _get_reference_scope_domain(self, partner_id=False, server_id=False):
+        """Domain of the keys that must have unique references.
+        Key references are unique per partner and server.
 
-        # Fix reference if it doesn't match
-        else:
-            # Modify the pattern to be used in `sub`
-            inner_pattern = reference_pattern[1:-1]
-            reference = re.sub(
-                rf"[^{inner_pattern}]",
-                "",
-                reference_source.strip().replace(" ", "_").lower(),
-            )
-
-        # Check if the same reference already exists and add a suffix if yes
-        counter = 1
-        final_reference = reference
-        while (
-            self.search_count(
-                [
-                    ("reference", "=", final_reference),
-                    ("partner_id", "=", partner_id),
-                    ("server_id", "=", server_id),
-                ]
-            )
-            > 0
-        ):
-            counter += 1
-            final_reference = _(f"{reference}_{counter}")
+        Args:
+            partner_id (Int, optional): partner id of the key. Defaults to False.
+            server_id (Int, optional): server id of the key. Defaults to False.
 
-        return final_reference
+        Returns:
+            list: domain
+        """
+        return [
+            ("partner_id", "=", partner_id or False),
+            ("server_id", "=", server_id or False),
+        ]
 
     def _compose_key_prefix(self, key_type):
         """Compose key prefix based on key type.
@@ -243,27 +325,48 @@ class CxTowerKey(models.Model):
         ):  # at least one dot separator and two symbols
             return {"code": code, "key_values": None}
 
-        # Get key strings
-        key_strings = self._extract_key_strings(code)
+        # Get key strings with their positions in code
+        key_matches = self._find_key_strings(code)
+        if not key_matches:
+            return {"code": code, "key_values": []}
+        key_strings = list(dict.fromkeys(match.group() for match in key_matches))
+
+        # Fetch all secrets used in code at once
+        secret_prefix = f"{self.KEY_PREFIX}.secret."
+        secret_references = [
+            key_string.replace(" ", "")[len(secret_prefix) : -len(self.KEY_TERMINATOR)]
+            for key_string in key_strings
+            if key_string.replace(" ", "").startswith(secret_prefix)
+        ]
+        if secret_references:
+            self._get_secret_values(
+                secret_references, kwargs.get("server_id"), kwargs.get("partner_id")
+            )
 
-        # Set key values
-        key_values = []
-        # Replace keys with values
+        # Resolve each key string once
+        values_by_key_string = {}
         for key_string in key_strings:
-            # Replace key including key terminator
             key_value = self._parse_key_string(key_string, **kwargs)
-            if key_value:
-                if pythonic_mode:
-                    # save key value as string in pythonic mode
-                    key_value = f'"{key_value}"'
-
-                code = code.replace(key_string, key_value)
-
-                # Save key value if not saved yet
-                if key_value not in key_values:
-                    key_values.append(key_value)
-
-        return {"code": code, "key_values": key_values}
+            if key_value and pythonic_mode:
+                # save key value as string in pythonic mode
+                key_value = f'"{key_value}"'
+            values_by_key_string[key_string] = key_value
+
+        # Replace keys with values in a single pass
+        parts = []
+        position = 0
+        for match in key_matches:
+            key_value = values_by_key_string[match.group()]
+            if not key_value:
+                continue
+            parts += [code[position : match.start()], key_value]
+            position = match.end()
+        parts.append(code[position:])
+
+        # Save each key value only once
+        key_values = list(dict.fromkeys(filter(None, values_by_key_string.values())))
+
+        return {"code": "".join(parts), "key_values": key_values}
 
     def _parse_code(self, code, **kwargs):
         """Replaces key placeholders in code with the corresponding values.
@@ -279,41 +382,35 @@ class CxTowerKey(models.Model):
 
         return self._parse_code_and_return_key_values(code, **kwargs)["code"]
 
+    def _find_key_strings(self, code):
+        """Find all key strings in code.
+        Key string starts with the key prefix and ends with
+        the nearest key terminator.
+
+        Args:
+            code (Text): code to search in
+
+        Returns:
+            [re.Match]: matches of key strings in order of appearance
+        """
+        pattern = re.compile(
+            f"{re.escape(self.KEY_PREFIX)}.*?{re.escape(self.KEY_TERMINATOR)}",
+            re.DOTALL,
+        )
+        return list(pattern.finditer(code))
+
     def _extract_key_strings(self, code):
         """Extract all keys from code
 
         Args:
-            code (Text): _description_
-            **kwargs (dict): optional arguments
+            code (Text): code to extract keys from
 
         Returns:
-            [str]: list of key stings
+            [str]: list of unique key stings in order of appearance
         """
-        key_strings = []
-        key_terminator_len = len(self.KEY_TERMINATOR)
-        index_from = 0  # initial position
-        while index_from > -1:
-            index_from = code.find(self.KEY_PREFIX, index_from)
-
-            if index_from > 0:
-                # Key end
-                index_to = code.find(self.KEY_TERMINATOR, index_from)
-
-                # Extract key value only if key terminator is found
-                if index_to > 0:
-                    # Extract key string including key terminator
-                    extract_to = index_to + key_terminator_len
-                    key_string = code[index_from:extract_to]
-
-                    # Add only if not added before
-                    if key_string not in key_strings:
-                        key_strings.append(key_string)
-                    # Update index from
-                    index_from = extract_to
-                else:
-                    break
-
-        return key_strings
+        return list(
+            dict.fromkeys(match.group() for match in self._find_key_strings(code))
+        )
 
     def _parse_key_string(self, key_string, **kwargs):
         """Parse key string and call resolver based on the key type.
@@ -374,56 +471,9 @@ class CxTowerKey(models.Model):
         if not reference:
             return
 
-        # Compose domain used to fetch keys
-        #
-        # Keys are checked in the following order:
-        # 1. Server specific
-        # 2. Partner specific
-        # 3. General (no server or partner specified)
-        server_id = kwargs.get("server_id")
-        partner_id = kwargs.get("partner_id")
-
-        key_domain = [
-            ("reference", "=", reference),
-            ("server_id", "=", False),
-            ("partner_id", "=", False),
-        ]
-
-        if server_id:
-            key_domain = OR(
-                [
-                    key_domain,
-                    [("reference", "=", reference), ("server_id", "=", server_id)],
-                ]
-            )
-        if partner_id:
-            key_domain = OR(
-                [
-                    key_domain,
-                    [("reference", "=", reference), ("partner_id", "=", partner_id)],
-                ]
-            )
-
-        # Fetch keys
-        keys = self.search(key_domain).sudo()
-        if not keys:
-            return
-
-        # Try to get server specific key first
-        key = False
-        if server_id:
-            key = keys.filtered(lambda k: k.server_id.id == server_id)
-
-        # Try to get partner specific key next
-        if not key and partner_id:
-            key = keys.filtered(lambda k: k.partner_id.id == partner_id)
-
-        if not key:
-            # Fallback to a global key
-            key = keys
-
-        key_value = key[0].secret_value
-        return key_value
+        return self._get_secret_values(
+            [reference], kwargs.get("server_id"), kwargs.get("partner_id")
+        )[reference]
 
     def _replace_with_spoiler(self, code, key_values):
         """Helper function that replaces clean text keys in code with spoiler.
@@ -441,16 +491,10 @@ class CxTowerKey(models.Model):
         Returns:
             Text: cleaned code
         """
-
         ## No need to search if code is too short
         if not key_values or len(code) <= len(self.KEY_PREFIX) + 3 + len(
             self.KEY_TERMINATOR
         ):  # at least one dot separator and two symbols
             return code
 
-        # Replace keys with values
-        for key_value in key_values:
-            # Replace key including key terminator
-            code = code.replace(key_value, self.SECRET_VALUE_SPOILER)
-
-        return code
+        return SecretRedactor(key_values, self.SECRET_VALUE_SPOILER).redact(code)
@@ -0,0 +1,313 @@
+# Copyright (C) 2022 Cetmix OÜ
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import gzip
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from odoo import api, fields, models
+from odoo.tools import split_every
+
+_logger = logging.getLogger(__name__)
+
+# Size of the command log output in bytes
+COMMAND_LOG_SIZE_SQL = (
+    "COALESCE(OCTET_LENGTH({alias}.command_response), 0)"
+    " + COALESCE(OCTET_LENGTH({alias}.command_error), 0)"
+)
+
+
+class CxTowerLogRetention(models.Model):
+    """Log retention policy.
+    Removes command and flight plan logs that are not needed anymore.
+    Removed logs can be archived into compressed attachments.
+    """
+
+    _name = "cx.tower.log.retention"
+    _description = "Cetmix Tower Log Retention Policy"
+    _order = "sequence, id"
+
+    active = fields.Boolean(default=True)
+    name = fields.Char(required=True)
+    sequence = fields.Integer(default=10)
+    log_type = fields.Selection(
+        selection=[("command", "Command Logs"), ("plan", "Flight Plan Logs")],
+        required=True,
+        default="command",
+    )
+    server_ids = fields.Many2many(
+        comodel_name="cx.tower.server",
+        string="Servers",
+        help="Policy is applied to logs of these servers only. "
+        "Leave empty to apply to all servers",
+    )
+    command_ids = fields.Many2many(
+        comodel_name="cx.tower.command",
+        string="Commands",
+        help="Policy is applied to logs of these commands only. "
+        "Leave empty to apply to all commands. "
+        "Commands run from flight plans are removed together with their "
+        "flight plan logs",
+    )
+    plan_ids = fields.Many2many(
+        comodel_name="cx.tower.plan",
+        string="Flight Plans",
+        help="Policy is applied to logs of these flight plans only. "
+        "Leave empty to apply to all flight plans",
+    )
+    max_age = fields.Integer(
+        string="Max Age, days",
+        help="Logs older than this are removed. 0 - no limit",
+    )
+    max_count = fields.Integer(
+        help="Max number of logs kept for each server. 0 - no limit",
+    )
+    max_size = fields.Integer(
+        string="Max Size, MB",
+        help="Max size of command output kept for each server. 0 - no limit",
+    )
+    archive = fields.Boolean(
+        help="Save removed logs into compressed attachments of this policy",
+    )
+    archive_count = fields.Integer(compute="_compute_archive_count")
+
+    def _compute_archive_count(self):
+        data = self.env["ir.attachment"].read_group(
+            [("res_model", "=", self._name), ("res_id", "in", self.ids)],
+            ["res_id"],
+            ["res_id"],
+        )
+        counts = {item["res_id"]: item["res_id_count"] for item in data}
+        for policy in self:
+            policy.archive_count = counts.get(policy.id, 0)
+
+    def action_open_archives(self):
+        """
+        Open current policy log archives
+        """
+        action = self.env["ir.actions.actions"]._for_xml_id("base.action_attachment")
+        action["domain"] = [("res_model", "=", self._name), ("res_id", "=", self.id)]
+        action["context"] = {"create": False}
+        return action
+
+    @api.model
+    def _cron_apply_log_retention(self):
+        """Apply all active retention policies.
+        Settings are taken from the system parameters:
+            - `cetmix_tower_server.log_retention_batch_size`: number of logs
+                removed in a single transaction.
+            - `cetmix_tower_server.log_retention_time_budget`: max number
+                of seconds a single run can take. Logs that are not removed
+                in time are left for the next run. 0 means no limit.
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        batch_size = max(
+            int(
+                get_param("cetmix_tower_server.log_retention_batch_size", default=1000)
+            ),
+            1,
+        )
+        time_budget = float(
+            get_param("cetmix_tower_server.log_retention_time_budget", default=50)
+        )
+        deadline = time_budget > 0 and time.monotonic() + time_budget or None
+
+        for policy in self.search([]):
+            policy._apply_log_retention(batch_size, deadline=deadline, commit=True)
+            if deadline and time.monotonic() > deadline:
+                break
+
+    def _apply_log_retention(self, batch_size, deadline=None, commit=False):
+        """Remove logs matching the policy.
+        Expired logs are selected once and removed in batches.
+
+        Args:
+            batch_size (int): number of logs removed in a single batch
+            deadline (float, optional): `time.monotonic()` value
+                after which no new batches are started
+            commit (bool, optional): commit the transaction after each batch
+                so tables are not locked for a long time.
+                Use it only when the cursor is owned by the caller, eg in cron.
+
+        Returns:
+            int: number of removed logs
+        """
+        self.ensure_one()
+        removed = 0
+        for log_ids in split_every(batch_size, self._get_expired_log_ids()):
+            logs = self._get_with_nested_logs(
+                self._get_log_model().browse(log_ids).exists()
+            )
+            if not logs:
+                continue
+            if self.archive:
+                self._archive_logs(logs)
+            removed += len(logs)
+            # Remove command logs explicitly so their attachments are removed too
+            if logs._name == "cx.tower.plan.log":
+                logs.command_log_ids.unlink()
+            logs.unlink()
+            if commit:
+                self._commit_log_retention_progress()
+            if deadline and time.monotonic() > deadline:
+                break
+        if removed:
+            _logger.info("Log retention policy %s: %s logs removed", self.name, removed)
+        return removed
+
+    def _commit_log_retention_progress(self):
+        """Commit removed logs so each batch is a separate transaction"""
+        if getattr(threading.current_thread(), "testing", False):
+            return
+        self.env.cr.commit()  # pylint: disable=invalid-commit
+
+    def _get_expired_log_ids(self):
+        """Get ids of the logs that must be removed according to the policy.
+        Running logs are never removed.
+        Nested flight plan logs are not returned,
+        use `_get_with_nested_logs()` to get them.
+
+        Returns:
+            list: log ids in ascending order
+        """
+        self.ensure_one()
+        if not (self.max_age > 0 or self.max_count > 0 or self.max_size > 0):
+            return []
+
+        if self.log_type == "plan":
+            table = "cx_tower_plan_log"
+            size_sql = (
+                f"(SELECT COALESCE(SUM({COMMAND_LOG_SIZE_SQL.format(alias='c')}), 0)"
+                " FROM cx_tower_command_log c WHERE c.plan_log_id = l.id)"
+            )
+            # Nested flight plans are removed with their parent ones
+            where = ["l.parent_flight_plan_log_id IS NULL"]
+            objects = ("l.plan_id", self.plan_ids)
+        else:
+            table = "cx_tower_command_log"
+            size_sql = COMMAND_LOG_SIZE_SQL.format(alias="l")
+            where = ["l.plan_log_id IS NULL"]
+            objects = ("l.command_id", self.command_ids)
+
+        params = []
+        where.append("NOT COALESCE(l.is_running, FALSE)")
+        if self.server_ids:
+            where.append("l.server_id IN %s")
+            params.append(tuple(self.server_ids.ids))
+        if objects[1]:
+            where.append(f"{objects[0]} IN %s")
+            params.append(tuple(objects[1].ids))
+
+        columns = ["l.id"]
+        conditions = []
+        if self.max_age > 0:
+            columns.append("l.start_date")
+            conditions.append("logs.start_date < %s")
+            params.append(fields.Datetime.now() - timedelta(days=self.max_age))
+        # Newest logs of each server are kept
+        window = (
+            "OVER (PARTITION BY l.server_id"
+            " ORDER BY l.start_date DESC NULLS LAST, l.id DESC)"
+        )
+        if self.max_count > 0:
+            columns.append(f"ROW_NUMBER() {window} AS row_number")
+            conditions.append("logs.row_number > %s")
+            params.append(self.max_count)
+        if self.max_size > 0:
+            columns.append(f"SUM({size_sql}) {window} AS total_size")
+            conditions.append("logs.total_size > %s")
+            params.append(self.max_size * 1024 * 1024)
+
+        query = f"""
+            SELECT logs.id FROM (
+                SELECT {", ".join(columns)}
+                FROM {table} l
+                WHERE {" AND ".join(where)}
+            ) logs
+            WHERE {" OR ".join(conditions)}
+            ORDER BY logs.id
+        """  # nosec B608
+        self.env.cr.execute(query, params)
+        return [row[0] for row in self.env.cr.fetchall()]
+
+    def _get_with_nested_logs(self, logs):
+        """Add nested flight plan logs to the logs
+
+        Args:
+            logs (cx.tower.command.log() or cx.tower.plan.log()): logs
+
+        Returns:
+            cx.tower.command.log() or cx.tower.plan.log(): logs
+        """
+        if logs._name != "cx.tower.plan.log":
+            return logs
+        nested_logs = logs
+        while nested_logs:
+            nested_logs = logs.search(
+                [("parent_flight_plan_log_id", "in", nested_logs.ids)]
+            )
+            logs |= nested_logs
+        return logs
+
+    def _get_log_model(self):
+        """Get model of the logs the policy is applied to
+
+        Returns:
+            cx.tower.command.log() or cx.tower.plan.log(): empty recordset
+        """
+        model = (
+            "cx.tower.plan.log" if self.log_type == "plan" else "cx.tower.command.log"
+        )
+        return self.env[model].sudo().with_context(active_test=False)
+
+    def _archive_logs(self, logs):
+        """Save logs into a compressed attachment of the policy.
+        Each line of the attachment is a JSON object with the log values.
+        Command logs of the flight plan logs are saved too.
+
+        Args:
+            logs (cx.tower.command.log() or cx.tower.plan.log()): logs to save
+
+        Returns:
+            ir.attachment(): attachment
+        """
+        self.ensure_one()
+        records = [logs]
+        if logs._name == "cx.tower.plan.log":
+            records.append(logs.command_log_ids)
+
+        lines = []
+        for record in records:
+            field_names = [
+                name
+                for name, field in record._fields.items()
+                if field.store and field.type not in ("one2many", "many2many")
+            ]
+            # Full command output is saved instead of its preview
+            output_fields = {
+                f"{name}_full": name
+                for name in ("command_response", "command_error")
+                if f"{name}_full" in record._fields
+            }
+            for vals in record.read(field_names + list(output_fields), load=None):
+                for full_name, name in output_fields.items():
+                    vals[name] = vals.pop(full_name)
+                vals["model"] = record._name
+                lines.append(json.dumps(vals, default=str))
+
+        return (
+            self.env["ir.attachment"]
+            .sudo()
+            .create(
+                {
+                    "name": "%s-%s.jsonl.gz"
+                    % (logs._table, fields.Datetime.now().strftime("%Y%m%d%H%M%S")),
+                    "raw": gzip.compress("\n".join(lines).encode()),
+                    "mimetype": "application/gzip",
+                    "res_model": self._name,
+                    "res_id": self.id,
+                }
+            )
+        )
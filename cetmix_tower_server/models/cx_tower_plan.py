@@ -73,10 +73,8 @@ class CxTowerPlan(models.Model):
                     - "key": {values passed to key parser}
         """
 
-        # Execute each plan for each server is list
-        for server in servers:
-            for plan in self:
-                plan._execute_single(server, **kwargs)
+        # Execute plans on each server in list. Servers are processed in parallel
+        servers._fan_out("_execute_flight_plans", self, **kwargs)
 
     def _execute_single(self, server, **kwargs):
         """Execute Flight Plan
@@ -102,6 +100,9 @@ class CxTowerPlan(models.Model):
         if not self.allow_parallel_run or self.env.context.get(
             "prevent_plan_recursion"
         ):
+            # Plan is being started by another transaction right now
+            if not server._try_lock_run(self):
+                return ANOTHER_PLAN_RUNNING
             running_count = plan_log_obj.search_count(
                 [
                     ("server_id", "=", server.id),
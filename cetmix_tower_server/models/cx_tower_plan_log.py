@@ -1,8 +1,31 @@
 # Copyright (C) 2022 Cetmix OÜ
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
-from odoo import _, api, fields, models
+import logging
+import threading
+from datetime import timedelta
 
-from .constants import PLAN_IS_EMPTY
+from odoo import _, api, fields, models, registry
+from odoo.exceptions import AccessError, ValidationError
+from odoo.tools import str2bool
+
+from .constants import PLAN_INTERRUPTED, PLAN_IS_EMPTY
+
+_logger = logging.getLogger(__name__)
+
+# Flight plans being run by `_run_plan_steps()` in the current thread.
+# {plan_log_id: command log of the last finished step or None}
+_plan_steps = threading.local()
+
+
+def _get_plan_steps():
+    """Get flight plans being run in the current thread
+
+    Returns:
+        dict: {plan_log_id: cx.tower.command.log() or None}
+    """
+    if not hasattr(_plan_steps, "logs"):
+        _plan_steps.logs = {}
+    return _plan_steps.logs
 
 
 class CxTowerPlanLog(models.Model):
@@ -40,6 +63,12 @@ class CxTowerPlanLog(models.Model):
 
     # -- Commands
     is_running = fields.Boolean(help="Plan is being executed right now")
+    is_stale = fields.Boolean(
+        string="Stale",
+        readonly=True,
+        help="Plan is running but there was no progress for a long time. "
+        "Most probably it was interrupted and can be resumed",
+    )
     plan_line_executed_id = fields.Many2one(
         comodel_name="cx.tower.plan.line",
         help="Flight Plan line that is being currently executed",
@@ -52,6 +81,25 @@ class CxTowerPlanLog(models.Model):
         "cx.tower.plan.log",
     )
 
+    def init(self):
+        """Create indexes:
+        - to check if the flight plan is already running on the server
+        - to select logs removed by log retention policies
+        """
+        self.env.cr.execute(
+            """
+            CREATE INDEX IF NOT EXISTS cx_tower_plan_log_running_index
+            ON cx_tower_plan_log (server_id, plan_id)
+            WHERE is_running
+            """
+        )
+        self.env.cr.execute(
+            """
+            CREATE INDEX IF NOT EXISTS cx_tower_plan_log_server_start_date_index
+            ON cx_tower_plan_log (server_id, start_date)
+            """
+        )
+
     @api.depends("server_id.name", "name")
     def _compute_name(self):
         for rec in self:
@@ -158,6 +206,121 @@ class CxTowerPlanLog(models.Model):
         self.sudo().write(values)
         self._plan_finished()
 
+    def action_resume(self):
+        """Resume interrupted flight plans"""
+        if not self.env.user.has_group("cetmix_tower_server.group_manager"):
+            raise AccessError(_("You are not allowed to resume flight plans"))
+        for plan_log in self:
+            plan_log._resume()
+
+    def _resume(self):
+        """Resume interrupted flight plan using the same log.
+        If the command of the last executed line was finished plan continues
+        from the next line. Otherwise the last executed line is run again.
+        """
+        self.ensure_one()
+        if not self.is_running:
+            raise ValidationError(
+                _("Flight plan '%(name)s' is not running", name=self.name)
+            )
+
+        # Close commands and nested plans that were interrupted
+        now = fields.Datetime.now()
+        interrupted_vals = {"is_running": False, "finish_date": now}
+        self.command_log_ids.filtered("is_running").sudo().write(
+            dict(interrupted_vals, command_status=PLAN_INTERRUPTED)
+        )
+        self.sudo().search(
+            [("parent_flight_plan_log_id", "=", self.id), ("is_running", "=", True)]
+        ).write(dict(interrupted_vals, plan_status=PLAN_INTERRUPTED))
+        self.sudo().write({"is_stale": False})
+
+        last_command_log = self.command_log_ids.sorted("id")[-1:]
+        line = self.plan_line_executed_id
+        if (
+            line
+            and last_command_log
+            and last_command_log.command_status != PLAN_INTERRUPTED
+        ):
+            self._run_plan_steps(last_command_log)
+            return
+
+        # Run the interrupted line again
+        line = line or self.plan_id.line_ids[:1]
+        if not line:
+            self.finish(PLAN_IS_EMPTY)
+        elif line._is_executable_line(self.server_id):
+            line._execute(self.server_id, self)
+        else:
+            line._skip(self.server_id, self)
+
+    @api.model
+    def _cron_check_stale_plans(self):
+        """Mark running flight plans without any progress as stale.
+        Settings are taken from the system parameters:
+            - `cetmix_tower_server.plan_stale_timeout`: minutes without progress
+                after which a running plan is considered stale. 0 - disable.
+            - `cetmix_tower_server.plan_stale_auto_resume`: resume stale plans.
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        timeout = int(get_param("cetmix_tower_server.plan_stale_timeout", default=60))
+        if timeout <= 0:
+            return
+        threshold = fields.Datetime.now() - timedelta(minutes=timeout)
+
+        plan_logs = self.search(
+            [
+                ("is_running", "=", True),
+                ("is_stale", "=", False),
+                ("write_date", "<", threshold),
+            ]
+        )
+        if not plan_logs:
+            return
+        # Flight plans being executed right now are locked by their transactions
+        self.env.cr.execute(
+            """
+            SELECT id FROM cx_tower_plan_log
+            WHERE id IN %s
+            FOR UPDATE SKIP LOCKED
+            """,
+            (tuple(plan_logs.ids),),
+        )
+        plan_logs = self.browse([row[0] for row in self.env.cr.fetchall()])
+        # Running commands update their logs when new output is received
+        stale_plan_logs = plan_logs.filtered(
+            lambda plan_log: all(
+                max(
+                    command_log.write_date,
+                    command_log.output_date or command_log.write_date,
+                )
+                < threshold
+                for command_log in plan_log.command_log_ids
+            )
+        )
+        if not stale_plan_logs:
+            return
+        stale_plan_logs.write({"is_stale": True})
+
+        if not str2bool(get_param("cetmix_tower_server.plan_stale_auto_resume", "0")):
+            return
+
+        # Nested plans are resumed by their parent ones.
+        # Each plan is resumed in a savepoint so the cron transaction
+        # must not be committed between flight plan lines.
+        # If plan commits are enabled the rest of the plan
+        # is run once the cron transaction is committed.
+        for plan_log in stale_plan_logs.filtered(
+            lambda plan_log: not plan_log.parent_flight_plan_log_id
+        ):
+            try:
+                with self.env.cr.savepoint():
+                    plan_log.with_user(plan_log.create_uid).with_context(
+                        cx_tower_own_cursor=False
+                    )._resume()
+            except Exception as e:
+                _logger.error("Failed to resume flight plan %s: %s", plan_log.name, e)
+
     def _plan_finished(self):
         """Triggered when flightplan in finished
         Inherit to implement your own hooks
@@ -201,5 +364,114 @@ class CxTowerPlanLog(models.Model):
 
         """
         self.ensure_one()
-        # Get next line to execute
-        self.plan_id._run_next_action(command_log)  # type: ignore
+        plan_steps = _get_plan_steps()
+
+        # Plan is already being run in this thread.
+        # Pass command to the loop instead of going deeper into the stack.
+        if self.id in plan_steps:
+            plan_steps[self.id] = command_log
+            return
+
+        self._run_plan_steps(command_log)
+
+    def _run_plan_steps(self, command_log):
+        """Run flight plan lines one by one in a loop.
+        Next line is executed when the command of the previous one is finished.
+        If command is executed asynchronously the loop stops
+        and is started again when the command is finished.
+
+        If `cetmix_tower_server.plan_commit_between_lines` system parameter is set
+        the loop is run in a cursor owned by the flight plan
+        and the transaction is committed between lines.
+
+        Args:
+            command_log (cx.tower.command.log()): Command log of the finished line
+        """
+        self.ensure_one()
+        if self._is_plan_commit_enabled() and not self._context.get(
+            "cx_tower_own_cursor"
+        ):
+            self._run_plan_steps_after_commit(command_log)
+            return
+
+        plan_steps = _get_plan_steps()
+        plan_steps[self.id] = command_log
+        try:
+            while plan_steps[self.id]:
+                command_log = plan_steps[self.id]
+                plan_steps[self.id] = None
+                self._commit_plan_progress()
+                # Get next line to execute
+                self.plan_id._run_next_action(command_log)  # type: ignore
+        finally:
+            del plan_steps[self.id]
+
+    def _is_plan_commit_enabled(self):
+        """Check if transaction is committed between flight plan lines
+
+        Returns:
+            bool: True if `cetmix_tower_server.plan_commit_between_lines`
+                system parameter is set
+        """
+        # Test transaction cannot be committed
+        if getattr(threading.current_thread(), "testing", False):
+            return False
+        return str2bool(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("cetmix_tower_server.plan_commit_between_lines", "False")
+        )
+
+    def _run_plan_steps_after_commit(self, command_log):
+        """Run the rest of the flight plan in a new cursor
+        once the current transaction is committed.
+        Transactions of the callers (HTTP requests, jobs, crons)
+        are never committed by the flight plan.
+        New cursor is owned by the flight plan, so it is marked
+        with the `cx_tower_own_cursor` context key.
+
+        Args:
+            command_log (cx.tower.command.log()): Command log of the finished line
+        """
+        self.ensure_one()
+        db_name = self.env.cr.dbname
+        uid = self.env.uid
+        su = self.env.su
+        context = self.env.context
+        plan_log_id = self.id
+        command_log_id = command_log.id
+
+        def run():
+            try:
+                with api.Environment.manage(), registry(db_name).cursor() as cr:
+                    env = api.Environment(
+                        cr, uid, dict(context, cx_tower_own_cursor=True), su=su
+                    )
+                    plan_log = env["cx.tower.plan.log"].browse(plan_log_id).exists()
+                    command_log = (
+                        env["cx.tower.command.log"].browse(command_log_id).exists()
+                    )
+                    # Plan could be stopped or rolled back meanwhile
+                    if plan_log.is_running and command_log:
+                        plan_log._run_plan_steps(command_log)
+            except Exception:
+                _logger.exception("Failed to run flight plan log %s", plan_log_id)
+
+        self.env.cr.postcommit.add(run)
+
+    def _commit_plan_progress(self):
+        """Commit current transaction between flight plan lines
+        if `cetmix_tower_server.plan_commit_between_lines` system parameter is set.
+        This way long flight plans do not keep a single transaction open
+        and completed lines are saved even if the plan is interrupted.
+
+        Only cursors owned by Cetmix Tower are committed,
+        eg the ones of the `_fan_out()` workers or the one opened by
+        `_run_plan_steps_after_commit()`. They are marked
+        with the `cx_tower_own_cursor` context key.
+        """
+        if not self._context.get("cx_tower_own_cursor"):
+            return
+        if not self._is_plan_commit_enabled():
+            return
+        self.env.cr.commit()  # pylint: disable=invalid-commit
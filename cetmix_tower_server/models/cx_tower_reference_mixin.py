@@ -5,6 +5,8 @@ import re
 from odoo import _, api, fields, models
 from odoo.osv import expression
 
+from .tools import escape_like
+
 
 class CxTowerReferenceMixin(models.AbstractModel):
     """
@@ -46,43 +48,87 @@ class CxTowerReferenceMixin(models.AbstractModel):
         Returns:
             str: Generated or fixed reference.
         """
+        return self._generate_or_fix_references([reference_source])[0]
 
-        # Check if reference matches the pattern
-        reference_pattern = self._get_reference_pattern()
+    def _fix_reference(self, reference_source):
+        """
+        Fix reference so it matches the reference pattern.
 
+        Args:
+            reference_source (str): Original string.
+
+        Returns:
+            str: Fixed reference.
+        """
+        reference_pattern = self._get_reference_pattern()
         if re.fullmatch(rf"{reference_pattern}+", reference_source):
-            reference = reference_source
-
-        # Fix reference if it doesn't match
-        else:
-            # Modify the pattern to be used in `sub`
-            inner_pattern = reference_pattern[1:-1]
-            reference = re.sub(
-                rf"[^{inner_pattern}]",
-                "",
-                reference_source.strip().replace(" ", "_").lower(),
-            )
+            return reference_source
+
+        # Modify the pattern to be used in `sub`
+        inner_pattern = reference_pattern[1:-1]
+        return re.sub(
+            rf"[^{inner_pattern}]",
+            "",
+            reference_source.strip().replace(" ", "_").lower(),
+        )
 
-        # Check if the same reference already exists and add a suffix if yes
-        counter = 1
-        final_reference = reference
+    def _generate_or_fix_references(self, reference_sources, domain=None):
+        """
+        Generate new references or fix existing ones for several records at once.
+        Existing references are fetched with a single query and
+        suffixes are added in memory, so references are unique
+        among the existing records and the returned ones.
 
-        # If exclude same records from search results
-        if self:
-            domain = [("id", "not in", self.ids)]
-        else:
-            domain = []
+        Args:
+            reference_sources (list of str): Original strings.
+            domain (list, optional): Domain used to select records
+                the references must be unique among. Defaults to all records.
 
-        final_domain = expression.AND([domain, [("reference", "=", final_reference)]])
+        Returns:
+            list of str: Generated or fixed references in the same order.
+        """
+        references = [self._fix_reference(source) for source in reference_sources]
+        if not references:
+            return references
 
-        while self.search_count(final_domain) > 0:
-            counter += 1
-            final_reference = _(f"{reference}_{counter}")
-            final_domain = expression.AND(
-                [domain, [("reference", "=", final_reference)]]
+        # If exclude same records from search results
+        if self:
+            domain = expression.AND([domain or [], [("id", "not in", self.ids)]])
+
+        # Fetch all references that may conflict with the new ones
+        existing_references = {
+            record["reference"]
+            for record in self.with_context(active_test=False).search_read(
+                expression.AND(
+                    [
+                        domain or [],
+                        expression.OR(
+                            [
+                                [("reference", "=like", f"{escape_like(ref)}%")]
+                                for ref in set(references)
+                                if ref
+                            ]
+                        ),
+                    ]
+                ),
+                ["reference"],
             )
-
-        return final_reference
+        }
+
+        # Add suffix if the same reference already exists
+        # {reference: last used counter}
+        counters = {}
+        result = []
+        for reference in references:
+            final_reference = reference
+            counter = counters.get(reference, 1)
+            while final_reference in existing_references:
+                counter += 1
+                final_reference = f"{reference}_{counter}"
+            counters[reference] = counter
+            existing_references.add(final_reference)
+            result.append(final_reference)
+        return result
 
     @api.model
     def _name_search(
@@ -130,11 +176,12 @@ class CxTowerReferenceMixin(models.AbstractModel):
         if not self._context.get("reference_mixin_override"):
             for vals in vals_list:
                 vals["name"] = vals["name"].strip()
-                # Generate reference
-                reference = self._generate_or_fix_reference(
-                    vals.get("reference") or vals.get("name")
-                )
-                vals.update({"reference": reference})
+            # Generate references for all records at once
+            references = self._generate_or_fix_references(
+                [vals.get("reference") or vals.get("name") for vals in vals_list]
+            )
+            for index, vals in enumerate(vals_list):
+                vals.update({"reference": references[index]})
         return super().create(vals_list)
 
     def write(self, vals):
@@ -158,11 +205,10 @@ class CxTowerReferenceMixin(models.AbstractModel):
 
                 # No name in vals. Update records one by one
                 if not updated_name:
-                    for record in self:
+                    references = self._generate_or_fix_references(self.mapped("name"))
+                    for index, record in enumerate(self):
                         record_vals = vals.copy()
-                        record_vals.update(
-                            {"reference": self._generate_or_fix_reference(record.name)}
-                        )
+                        record_vals.update({"reference": references[index]})
                         super(CxTowerReferenceMixin, record).write(record_vals)
                     return
                 # Name is present in vals
@@ -185,8 +231,12 @@ class CxTowerReferenceMixin(models.AbstractModel):
         original_name = self.name
         copy_name = _("%(name)s (copy)", name=original_name)
 
+        # Fetch all names that may conflict with the copied one
+        domain = [("name", "=like", f"{escape_like(original_name)}%")]
+        existing_names = set(self.search(domain).mapped("name"))
+
         counter = 1
-        while self.search_count([("name", "=", copy_name)]) > 0:
+        while copy_name in existing_names:
             counter += 1
             copy_name = _(
                 "%(name)s (copy %(number)s)", name=original_name, number=str(counter)
@@ -224,9 +274,30 @@ class CxTowerReferenceMixin(models.AbstractModel):
         Returns:
             Record: Record that matches provided reference
         """
-        return self.browse(self._get_id_by_reference(reference))
+        # Limit is in case some models will remove reference uniqueness constraint
+        return self.search([("reference", "=", reference)], limit=1)
+
+    def get_by_references(self, references):
+        """Get records based on their references.
+        All records are fetched with a single query.
+
+        Important: references are case sensitive!
+
+        Args:
+            references (list of Char): record references
+
+        Returns:
+            dict: {reference: Record}. Empty recordset for references
+                that are not found.
+        """
+        references = [reference for reference in set(references) if reference]
+        result = {reference: self.browse() for reference in references}
+        for record in self.search([("reference", "in", references)]):
+            # Keep the first record in case reference is not unique
+            if not result[record.reference]:
+                result[record.reference] = record
+        return result
 
-    # TODO: implement caching for this method
     def _get_id_by_reference(self, reference):
         """Get record id based on its reference.
 
@@ -238,7 +309,4 @@ class CxTowerReferenceMixin(models.AbstractModel):
         Returns:
             Record: Record id that matches provided reference
         """
-        records = self.search([("reference", "=", reference)])
-
-        # This is in case some models will remove reference uniqueness constraint
-        return records and records[0].id
+        return self.get_by_reference(reference).id
@@ -1,11 +1,22 @@
 # Copyright (C) 2022 Cetmix OÜ
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 import ast
+import codecs
+import collections
+import hashlib
 import io
 import logging
-
-from odoo import _, api, fields, models
+import os
+import re
+import select
+import shlex
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from odoo import _, api, fields, models, registry
 from odoo.exceptions import UserError, ValidationError
+from odoo.tools import config, str2bool
 from odoo.tools.safe_eval import safe_eval
 
 from .constants import (
@@ -14,7 +25,7 @@ from .constants import (
     NO_COMMAND_RUNNER_FOUND,
     PYTHON_COMMAND_ERROR,
 )
-from .tools import generate_random_id
+from .tools import SecretRedactor, generate_random_id
 
 _logger = logging.getLogger(__name__)
 
@@ -28,11 +39,364 @@ except ImportError:
     AutoAddPolicy = RSAKey = SSHClient = None
 
 
+class SSHConnectionPool(object):
+    """
+    Process wide pool of authenticated SSH connections.
+
+    Connections are kept per host (host, port, username) along with
+    the fingerprint of the credentials they were opened with.
+    Idle connections are reused as long as they are alive,
+    are closed after `idle_timeout` seconds of inactivity
+    and are evicted as soon as the host credentials change.
+    """
+
+    def __init__(self, idle_timeout=300, max_per_host=4):
+        """
+        Args:
+            idle_timeout (int, optional): seconds an idle connection is kept.
+                Defaults to 300.
+            max_per_host (int, optional): max number of idle connections kept
+                per host. Connections above this limit are closed on release.
+                It does not limit the number of connections used at the same
+                time. Defaults to 4.
+        """
+        self.idle_timeout = idle_timeout
+        self.max_per_host = max_per_host
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+        # {host_key: [(client, last_used), ...]}
+        self._idle = {}
+        # {client: (host_key, fingerprint)}
+        self._in_use = {}
+        # {client: SFTPClient}
+        self._sftp = {}
+        # {host_key: fingerprint}
+        self._fingerprints = {}
+
+    @staticmethod
+    def get_fingerprint(mode, password=None, ssh_key=None):
+        """Compute credentials fingerprint.
+        Plain credentials are never stored in the pool.
+
+        Args:
+            mode (Char): SSH auth mode
+            password (Char, optional): SSH password
+            ssh_key (Char, optional): SSH private key
+
+        Returns:
+            Char: credentials fingerprint
+        """
+        auth_string = "\x00".join([mode or "", password or "", ssh_key or ""])
+        return hashlib.sha256(auth_string.encode()).hexdigest()
+
+    def configure(self, idle_timeout=None, max_per_host=None):
+        """Update pool settings
+
+        Args:
+            idle_timeout (int, optional): seconds an idle connection is kept.
+            max_per_host (int, optional): max number of idle connections
+                kept per host.
+        """
+        with self._lock:
+            if idle_timeout is not None:
+                self.idle_timeout = idle_timeout
+            if max_per_host is not None:
+                self.max_per_host = max_per_host
+
+    def acquire(self, host_key, fingerprint, connect):
+        """Get a live connection from the pool or open a new one.
+
+        Args:
+            host_key (tuple): (host, port, username)
+            fingerprint (Char): credentials fingerprint
+            connect (callable): function that opens a new connection
+
+        Returns:
+            SSHClient: connection ready to be used
+        """
+        with self._lock:
+            self._check_pid()
+            self._evict_expired()
+
+            # Credentials have changed: drop connections opened with the old ones
+            if self._fingerprints.get(host_key) != fingerprint:
+                self._discard_host(host_key)
+                self._fingerprints[host_key] = fingerprint
+
+        while True:
+            with self._lock:
+                idle = self._idle.get(host_key)
+                if not idle:
+                    break
+                client, _last_used = idle.pop()
+            # Check connection outside of the lock because it's a network call
+            if self._is_alive(client):
+                with self._lock:
+                    self._in_use[client] = (host_key, fingerprint)
+                return client
+            self._close(client)
+
+        # Open a new connection outside of the lock because handshake is slow
+        client = connect()
+        with self._lock:
+            self._in_use[client] = (host_key, fingerprint)
+        return client
+
+    def get_sftp(self, client, open_sftp):
+        """Get SFTP session opened over the connection.
+        Session is opened once and shared by all file operations
+        while the connection is alive.
+
+        Args:
+            client (SSHClient): connection obtained with `acquire()`
+            open_sftp (callable): function that opens a new SFTP session
+
+        Returns:
+            SFTPClient: SFTP session
+        """
+        with self._lock:
+            sftp = self._sftp.get(client)
+        if sftp is not None and not sftp.get_channel().closed:
+            return sftp
+        sftp = open_sftp()
+        with self._lock:
+            self._sftp[client] = sftp
+        return sftp
+
+    def release(self, client):
+        """Return connection to the pool.
+        Connection is closed if it's dead, opened with outdated credentials
+        or the host limit is reached.
+
+        Args:
+            client (SSHClient): connection obtained with `acquire()`
+        """
+        # Check connection outside of the lock because it's a network call
+        alive = self._is_alive(client)
+        with self._lock:
+            info = self._in_use.pop(client, None)
+            keep = False
+            if info:
+                host_key, fingerprint = info
+                idle = self._idle.setdefault(host_key, [])
+                keep = (
+                    alive
+                    and self.idle_timeout
+                    and fingerprint == self._fingerprints.get(host_key)
+                    and len(idle) < self.max_per_host
+                )
+                if keep:
+                    idle.append((client, time.monotonic()))
+            self._evict_expired()
+        if not keep:
+            self._close(client)
+
+    def discard(self, client):
+        """Remove connection from the pool and close it.
+        Use it for connections that are known to be broken.
+
+        Args:
+            client (SSHClient): connection obtained with `acquire()`
+        """
+        with self._lock:
+            self._in_use.pop(client, None)
+        self._close(client)
+
+    def clear(self):
+        """Close all idle connections"""
+        with self._lock:
+            for host_key in list(self._idle):
+                self._discard_host(host_key)
+
+    def _check_pid(self):
+        """Forget connections inherited from the parent process.
+        Sockets cannot be shared between forked workers.
+        """
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._idle = {}
+            self._in_use = {}
+            self._fingerprints = {}
+            self._sftp = {}
+
+    def _evict_expired(self):
+        """Close connections that stayed idle for too long"""
+        expire_before = time.monotonic() - (self.idle_timeout or 0)
+        for host_key, idle in list(self._idle.items()):
+            alive = []
+            for client, last_used in idle:
+                if last_used < expire_before:
+                    self._close(client)
+                else:
+                    alive.append((client, last_used))
+            if alive:
+                self._idle[host_key] = alive
+            else:
+                del self._idle[host_key]
+
+    def _discard_host(self, host_key):
+        """Close all idle connections of the host
+
+        Args:
+            host_key (tuple): (host, port, username)
+        """
+        for client, _last_used in self._idle.pop(host_key, []):
+            self._close(client)
+
+    def _is_alive(self, client):
+        """Check if connection is still usable
+
+        Args:
+            client (SSHClient): connection
+
+        Returns:
+            Bool: True if connection is alive
+        """
+        transport = client.get_transport()
+        if not transport or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def _close(self, client):
+        """Close connection silently
+
+        Args:
+            client (SSHClient): connection
+        """
+        with self._lock:
+            sftp = self._sftp.pop(client, None)
+        try:
+            if sftp is not None:
+                sftp.close()
+            client.close()
+        except Exception as e:
+            _logger.debug("Failed to close SSH connection: %s", e)
+
+
+# Shared by all SSH clients of the current process
+SSH_CONNECTION_POOL = SSHConnectionPool()
+
+
+def _rebind(value, env):
+    """Pass recordsets to another environment and copy containers
+    so parallel workers do not share mutable values"""
+    if isinstance(value, models.BaseModel):
+        return value.with_env(env)
+    if isinstance(value, dict):
+        return {k: _rebind(v, env) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_rebind(v, env) for v in value)
+    return value
+
+
+class HostRateLimiter(object):
+    """
+    Ensures that operations on the same host are started
+    with at least `interval` seconds between them.
+    """
+
+    def __init__(self, interval=0):
+        self.interval = interval
+        self._lock = threading.Lock()
+        # {host: time when the next operation can be started}
+        self._next_start = {}
+
+    def wait(self, host):
+        """Block until an operation can be started on the host.
+
+        Args:
+            host (Char): host name or IP address
+        """
+        if self.interval <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class OutputBuffer(object):
+    """
+    Collects command output keeping only its last `max_size` bytes.
+    Output received since the last `read_new()` call is kept separately
+    so it can be passed on while the command is running.
+    """
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.size = 0
+        # Number of bytes dropped from the beginning of the output
+        self.truncated = 0
+        self._chunks = collections.deque()
+        self._new_chunks = []
+        # Multibyte characters can be split between chunks
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def write(self, data):
+        """Add data to the buffer. Oldest data is dropped if size exceeds limit.
+
+        Args:
+            data (bytes): data received from the channel
+        """
+        self._chunks.append(data)
+        self._new_chunks.append(data)
+        self.size += len(data)
+        if not self.max_size:
+            return
+        while self.size > self.max_size:
+            excess = self.size - self.max_size
+            head = self._chunks[0]
+            if len(head) <= excess:
+                self._chunks.popleft()
+                dropped = len(head)
+            else:
+                self._chunks[0] = head[excess:]
+                dropped = excess
+            self.size -= dropped
+            self.truncated += dropped
+
+    def read_new(self):
+        """Get output received since the previous call
+
+        Returns:
+            Text: new output
+        """
+        data = b"".join(self._new_chunks)
+        self._new_chunks = []
+        return self._decoder.decode(data)
+
+    def get_lines(self):
+        """Get buffer content as list of lines
+
+        Returns:
+            list: lines of text
+        """
+        lines = (
+            b"".join(self._chunks).decode("utf-8", errors="replace").splitlines(True)
+        )
+        if self.truncated:
+            lines.insert(
+                0,
+                _("... %(size)s bytes of output truncated ...\n", size=self.truncated),
+            )
+        return lines
+
+
 class SSH(object):
     """
     This is a class for communicating with remote servers via SSH.
     """
 
+    # Max number of bytes read from the channel at once
+    CHUNK_SIZE = 32768
+
     def __init__(
         self,
         host,
@@ -43,6 +407,7 @@ class SSH(object):
         mode="p",
         allow_agent=False,
         timeout=5000,
+        pool=None,
     ):
         self.host = host
         self.port = port
@@ -54,6 +419,8 @@ class SSH(object):
         # NB: allow_agent=False is for avoiding
         # ssh-agent related connection issues~
         self.allow_agent = allow_agent
+        # Connection pool. New connection is opened for each client if not set
+        self.pool = pool
 
         self._ssh = None
         self._sftp = None
@@ -78,11 +445,24 @@ class SSH(object):
 
     def _connect(self):
         """
-        Connect to remote host
+        Connect to remote host.
+        Connection is taken from the pool if pool is used.
+        """
+        if self.pool is not None:
+            return self.pool.acquire(
+                (self.host, str(self.port), self.username),
+                self.pool.get_fingerprint(self.mode, self.password, self.ssh_key),
+                self._open_connection,
+            )
+        return self._open_connection()
+
+    def _open_connection(self):
+        """
+        Open a new authenticated connection to remote host
         """
-        self._ssh = SSHClient()  # type: ignore
-        self._ssh.load_system_host_keys()
-        self._ssh.set_missing_host_key_policy(AutoAddPolicy())  # type: ignore
+        ssh = SSHClient()  # type: ignore
+        ssh.load_system_host_keys()
+        ssh.set_missing_host_key_policy(AutoAddPolicy())  # type: ignore
         kwargs = {
             "hostname": self.host,
             "port": self.port,
@@ -102,22 +482,40 @@ class SSH(object):
                     "pkey": self._get_ssh_key(),
                 }
             )
-        self._ssh.connect(**kwargs)
-        return self._ssh
+        ssh.connect(**kwargs)
+        return ssh
 
     @property
     def connection(self):
         """
         Open SSH connection to remote host.
+        Connection is opened once and reused while it is alive.
         """
-        return self._connect()
+        if self._ssh is not None:
+            transport = self._ssh.get_transport()
+            if transport and transport.is_active():
+                return self._ssh
+            self.disconnect()
+        self._ssh = self._connect()
+        return self._ssh
 
     @property
     def sftp(self):
         """
         Open SFTP connection to remote host.
+        SFTP session is opened once per SSH connection
+        and is shared by all file operations.
         """
-        self._sftp = SFTPClient.from_transport(self.connection.get_transport())  # type: ignore
+        if self._sftp is not None and not self._sftp.get_channel().closed:
+            return self._sftp
+        connection = self.connection
+        if self.pool is not None:
+            self._sftp = self.pool.get_sftp(
+                connection,
+                lambda: SFTPClient.from_transport(connection.get_transport()),  # type: ignore
+            )
+        else:
+            self._sftp = SFTPClient.from_transport(connection.get_transport())  # type: ignore
         return self._sftp
 
     def disconnect(self):
@@ -125,15 +523,33 @@ class SSH(object):
         Close SSH & SFTP connection.
         """
         logger = logging.getLogger("paramiko")
-        if self._ssh:
-            logger.info("Disconnect SSH connection")
-            self._ssh.close()
         if self._sftp:
-            logger.info("Disconnect SFTP connection")
-            self._sftp.close()
+            # Pooled SFTP session is closed along with its connection
+            if self.pool is None:
+                logger.info("Disconnect SFTP connection")
+                self._sftp.close()
+            self._sftp = None
+        if self._ssh:
+            # Return connection to the pool so it can be reused
+            if self.pool is not None:
+                logger.debug("Release SSH connection")
+                self.pool.release(self._ssh)
+            else:
+                logger.info("Disconnect SSH connection")
+                self._ssh.close()
+            self._ssh = None
 
-    def exec_command(self, command, sudo=None):
-        """_summary_
+    def exec_command(
+        self,
+        command,
+        sudo=None,
+        max_output=0,
+        output_callback=None,
+        flush_interval=0,
+    ):
+        """Execute command and read its output.
+        Output is read while the command is running so the remote side
+        is never blocked by a full channel window.
 
         Args:
             command (text): Command text
@@ -141,6 +557,12 @@ class SSH(object):
                 - 'n': no password
                 - 'p': with password
                 - Defaults to None.
+            max_output (int): max size in bytes of response and error kept
+                in memory. Only the tail of the output is kept. 0 - no limit.
+            output_callback (callable): function called with the output
+                received since the previous call: output_callback(response, error).
+            flush_interval (int): min interval in seconds between
+                `output_callback` calls.
 
         Returns:
             status, response, error
@@ -163,10 +585,40 @@ class SSH(object):
             stdin.flush()
             # TODO: add password error check
 
-        status = stdout.channel.recv_exit_status()
-        response = stdout.readlines()
-        error = stderr.readlines()
-        return status, response, error
+        channel = stdout.channel
+        response = OutputBuffer(max_output)
+        error = OutputBuffer(max_output)
+        last_flush = time.monotonic()
+        # New output not passed to the callback yet
+        pending = False
+        while True:
+            received = False
+            if channel.recv_ready():
+                response.write(channel.recv(self.CHUNK_SIZE))
+                received = pending = True
+            if channel.recv_stderr_ready():
+                error.write(channel.recv_stderr(self.CHUNK_SIZE))
+                received = pending = True
+            if (
+                output_callback
+                and pending
+                and time.monotonic() - last_flush >= flush_interval
+            ):
+                output_callback(response.read_new(), error.read_new())
+                last_flush = time.monotonic()
+                pending = False
+            if received:
+                continue
+            # Exit status is sent after all the output
+            if channel.exit_status_ready():
+                if not channel.recv_ready() and not channel.recv_stderr_ready():
+                    break
+                continue
+            # Wait for new data
+            select.select([channel], [], [], 1)
+
+        status = channel.recv_exit_status()
+        return status, response.get_lines(), error.get_lines()
 
     def delete_file(self, remote_path):
         """
@@ -178,13 +630,27 @@ class SSH(object):
         """
         self.sftp.remove(remote_path)
 
+    def stat_file(self, remote_path):
+        """
+        Get remote file attributes
+
+        Args:
+            remote_path (Text): full path file location with file type
+             (e.g. /test/my_file.txt).
+
+        Returns:
+            Result (class paramiko.sftp_attr.SFTPAttributes): metadata
+             of the file.
+        """
+        return self.sftp.stat(remote_path)
+
     def upload_file(self, file, remote_path):
         """
         Upload file to remote server.
 
         Args:
-            file (Text, Bytes): If bytes - file presented as contents of an
-                                open file object (fl).
+            file (Text, file object): If file object - file contents are read
+                                from it in chunks (eg BytesIO or open file).
                                 if text - file presented as local path to file
             remote_path (Text): full path file location with file type
             (e.g. /test/my_file.txt).
@@ -196,7 +662,7 @@ class SSH(object):
             Result (class paramiko.sftp_attr.SFTPAttributes): metadata
              of the uploaded file.
         """
-        if isinstance(file, io.BytesIO):
+        if hasattr(file, "read"):
             result = self.sftp.putfo(file, remote_path)
         elif isinstance(file, str):
             result = self.sftp.put(file, remote_path=remote_path, recursive=True)
@@ -219,8 +685,24 @@ class SSH(object):
         Returns:
             Result (Bytes): file content.
         """
-        file = self.sftp.open(remote_path)
-        return file.read()
+        with self.sftp.open(remote_path) as file:
+            return file.read()
+
+    def download_fileobj(self, remote_path, file):
+        """
+        Download file from remote server into a file object.
+        File is transferred in chunks with read-ahead enabled
+        so its content is never loaded to memory at once.
+
+        Args:
+            remote_path (Text): full path file location with file type
+             (e.g. /test/my_file.txt).
+            file (file object): file object to write the content to.
+
+        Returns:
+            Result (Int): number of bytes transferred.
+        """
+        return self.sftp.getfo(remote_path, file)
 
 
 class CxTowerServer(models.Model):
@@ -443,6 +925,35 @@ class CxTowerServer(models.Model):
         action["domain"] = [("server_id", "=", self.id)]
         return action
 
+    def _try_lock_run(self, record):
+        """Take a lock that prevents other transactions from starting
+        the same command or flight plan on the server at the same time.
+        Lock is released when the current transaction is finished.
+        Locks are used only if the `cetmix_tower_server.running_check_lock`
+        system parameter is set.
+
+        Args:
+            record (cx.tower.command() or cx.tower.plan()): record to lock
+
+        Returns:
+            bool: True if lock is taken or locks are not used
+        """
+        self.ensure_one()
+        if not str2bool(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("cetmix_tower_server.running_check_lock", "False")
+        ):
+            return True
+        digest = hashlib.sha1(
+            f"{self._name},{self.id},{record._name},{record.id}".encode()
+        ).digest()
+        self.env.cr.execute(
+            "SELECT pg_try_advisory_xact_lock(%s)",
+            (int.from_bytes(digest[:8], "big", signed=True),),
+        )
+        return self.env.cr.fetchone()[0]
+
     def _get_password(self):
         """Get ssh password
         This function prepares and returns ssh password for the ssh connection
@@ -495,6 +1006,7 @@ class CxTowerServer(models.Model):
                 mode=self.ssh_auth_mode,
                 password=self._get_password(),
                 ssh_key=self._get_ssh_key(),
+                pool=self._get_ssh_connection_pool(),
             )
         except Exception as e:
             if raise_on_error:
@@ -503,6 +1015,155 @@ class CxTowerServer(models.Model):
                 return False, e
         return client
 
+    def _get_ssh_connection_pool(self):
+        """Get SSH connection pool used to connect to servers.
+        Pool settings are updated from the system parameters:
+            - `cetmix_tower_server.ssh_pool_idle_timeout`: seconds an idle
+                connection is kept open. Set to 0 to disable pooling.
+            - `cetmix_tower_server.ssh_pool_max_per_host`: max number of
+                idle connections kept open per host. Number of connections
+                used at the same time is not limited.
+
+        Returns:
+            SSHConnectionPool: connection pool or None if pooling is disabled
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        idle_timeout = int(
+            get_param("cetmix_tower_server.ssh_pool_idle_timeout", default=300)
+        )
+        if idle_timeout <= 0:
+            return None
+        max_per_host = int(
+            get_param("cetmix_tower_server.ssh_pool_max_per_host", default=4)
+        )
+        SSH_CONNECTION_POOL.configure(
+            idle_timeout=idle_timeout, max_per_host=max_per_host
+        )
+        return SSH_CONNECTION_POOL
+
+    def _fan_out(self, method, *args, **kwargs):
+        """Call server method for each server in the recordset.
+        Servers are processed in parallel by a pool of threads.
+        Each thread uses its own database cursor which is committed
+        as soon as the server is processed. Worker environments
+        have the `cx_tower_own_cursor` context key set.
+        Settings are taken from the system parameters:
+            - `cetmix_tower_server.fan_out_max_workers`: max number of
+                servers processed at once. Set to 1 to process servers
+                one by one in the current transaction.
+            - `cetmix_tower_server.fan_out_host_interval`: min interval
+                in seconds between operations started on the same host.
+
+        IMPORTANT: because parallel workers use their own transactions
+        they cannot see records that are not committed yet.
+
+        Args:
+            method (Char): name of the server method to call
+            args, kwargs: arguments passed to the method.
+                Recordsets are passed to the worker environment.
+
+        Returns:
+            dict: {server.id: method result}
+        """
+        max_workers = self._get_fan_out_max_workers()
+        if max_workers <= 1:
+            return {
+                server.id: getattr(server, method)(*args, **kwargs) for server in self
+            }
+
+        rate_limiter = HostRateLimiter(
+            float(
+                self.env["ir.config_parameter"]
+                .sudo()
+                .get_param("cetmix_tower_server.fan_out_host_interval", default=0)
+            )
+        )
+        db_name = self.env.cr.dbname
+        uid = self.env.uid
+        context = self.env.context
+
+        def run(server_id, host):
+            rate_limiter.wait(host)
+            with api.Environment.manage(), registry(db_name).cursor() as cr:
+                # Cursor is owned by this worker so it can be committed
+                env = api.Environment(cr, uid, dict(context, cx_tower_own_cursor=True))
+                server = env["cx.tower.server"].browse(server_id)
+                return getattr(server, method)(
+                    *_rebind(args, env), **_rebind(kwargs, env)
+                )
+
+        with ThreadPoolExecutor(
+            max_workers=min(max_workers, len(self)),
+            thread_name_prefix="cetmix_tower",
+        ) as executor:
+            futures = {
+                server.id: executor.submit(
+                    run, server.id, server.ip_v4_address or server.ip_v6_address
+                )
+                for server in self
+            }
+
+        results = {}
+        error = None
+        for server_id, future in futures.items():
+            try:
+                results[server_id] = future.result()
+            except Exception as e:
+                _logger.exception("Failed to process server %s", server_id)
+                error = error or e
+        if error:
+            raise error
+        return results
+
+    def _fan_out_after_commit(self, method, *args, **kwargs):
+        """Same as `_fan_out()` but servers are processed after
+        the current transaction is committed, so parallel workers
+        can see records created in this transaction.
+        If servers are processed one by one `_fan_out()` is called immediately.
+
+        Args:
+            method (Char): name of the server method to call
+            args, kwargs: arguments passed to the method.
+        """
+        if self._get_fan_out_max_workers() <= 1:
+            self._fan_out(method, *args, **kwargs)
+            return
+
+        db_name = self.env.cr.dbname
+        uid = self.env.uid
+        context = self.env.context
+        server_ids = self.ids
+
+        def run():
+            try:
+                with api.Environment.manage(), registry(db_name).cursor() as cr:
+                    env = api.Environment(cr, uid, context)
+                    env["cx.tower.server"].browse(server_ids)._fan_out(
+                        method, *_rebind(args, env), **_rebind(kwargs, env)
+                    )
+            except Exception:
+                _logger.exception("Failed to process servers %s", server_ids)
+
+        self.env.cr.postcommit.add(run)
+
+    def _get_fan_out_max_workers(self):
+        """Get number of servers that can be processed by `_fan_out()` at once.
+
+        Returns:
+            int: number of servers. 1 means servers are processed one by one.
+        """
+        # Threads cannot use the test cursor
+        if len(self) <= 1 or getattr(threading.current_thread(), "testing", False):
+            return 1
+        max_workers = int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("cetmix_tower_server.fan_out_max_workers", default=1)
+        )
+        # Each worker opens its own database connection.
+        # Keep half of the pool for the other requests.
+        return min(max_workers, max(config["db_maxconn"] // 2, 1))
+
     def test_ssh_connection(self):
         """Test SSH connection"""
         self.ensure_one()
@@ -531,11 +1192,11 @@ class CxTowerServer(models.Model):
                 )
             )
 
-        # test upload file
-        self.upload_file("test", "/var/tmp/test.txt")
+        # test upload file using the same connection
+        client.upload_file(io.BytesIO(b"test"), "/var/tmp/test.txt")
 
         # test download loaded file
-        self.download_file("/var/tmp/test.txt")
+        client.download_file("/var/tmp/test.txt")
 
         # remove file from server
         file_remove_result = self._execute_command_using_ssh(
@@ -630,6 +1291,36 @@ class CxTowerServer(models.Model):
 
         return {"rendered_code": rendered_code, "rendered_path": rendered_path}
 
+    def execute_command_multi(self, command, path=None, sudo=None, **kwargs):
+        """Execute command on all servers in the recordset.
+        Servers are processed in parallel. Check `_fan_out()` for details.
+
+        Args:
+            command (cx.tower.command()): Command record
+            path, sudo, kwargs: check `execute_command()`
+
+        Returns:
+            dict: {server.id: `execute_command()` result}
+        """
+        # Users are notified with a single digest when all commands are finished
+        notifications = []
+        results = self.with_context(
+            cx_tower_command_notifications=notifications
+        )._fan_out("execute_command", command, path=path, sudo=sudo, **kwargs)
+        self.env["cx.tower.command.log"]._send_command_notifications(notifications)
+        return results
+
+    def _execute_flight_plans(self, plans, **kwargs):
+        """Execute flight plans on the server one by one
+
+        Args:
+            plans (cx.tower.plan()): Flight Plan records
+            kwargs (dict): check `cx.tower.plan.execute()`
+        """
+        self.ensure_one()
+        for plan in plans:
+            plan._execute_single(self, **kwargs)
+
     def execute_command(
         self, command, path=None, sudo=None, ssh_connection=None, **kwargs
     ):
@@ -686,13 +1377,17 @@ class CxTowerServer(models.Model):
 
             # Check if command is already running and parallel run is not allowed
             if not command.allow_parallel_run:
-                running_count = log_obj.sudo().search_count(
-                    [
-                        ("server_id", "=", self.id),  # pylint: disable=no-member
-                        ("command_id", "=", command.id),
-                        ("is_running", "=", True),
-                    ]
-                )
+                if self._try_lock_run(command):
+                    running_count = log_obj.sudo().search_count(
+                        [
+                            ("server_id", "=", self.id),  # pylint: disable=no-member
+                            ("command_id", "=", command.id),
+                            ("is_running", "=", True),
+                        ]
+                    )
+                else:
+                    # Command is being started by another transaction right now
+                    running_count = 1
                 # Create log record and exit
                 # if the same command is currently running on the same server
                 if running_count > 0:
@@ -970,15 +1665,27 @@ class CxTowerServer(models.Model):
         if not ssh_connection:
             ssh_connection = self._connect(raise_on_error=False)
 
+        # Save output to log while command is running.
+        # Output is saved in a separate transaction
+        # which cannot be used in tests.
+        output_writer = None
+        if log_record and not getattr(threading.current_thread(), "testing", False):
+            output_writer = log_record._get_output_writer()
+            kwargs["output_callback"] = output_writer.write
+
         # Execute command
-        command_result = self._execute_command_using_ssh(
-            client=ssh_connection,
-            command_code=rendered_command_code,
-            command_path=rendered_command_path,
-            raise_on_error=False,
-            sudo=self._context.get("use_sudo"),
-            **kwargs,
-        )
+        try:
+            command_result = self._execute_command_using_ssh(
+                client=ssh_connection,
+                command_code=rendered_command_code,
+                command_path=rendered_command_path,
+                raise_on_error=False,
+                sudo=self._context.get("use_sudo"),
+                **kwargs,
+            )
+        finally:
+            if output_writer:
+                output_writer.close()
 
         # Log result
         if log_record:
@@ -1092,6 +1799,7 @@ class CxTowerServer(models.Model):
         command_path=None,
         raise_on_error=True,
         sudo=None,
+        output_callback=None,
         **kwargs,
     ):
         """This is a low level method for SSH command execution.
@@ -1104,6 +1812,9 @@ class CxTowerServer(models.Model):
             command_path (Char, optional): directory where command should be executed
             raise_on_error (bool, optional): raise error on error
             sudo (selection): use sudo Defaults to None.
+            output_callback (callable, optional): function called periodically
+                with new command output: output_callback(response, error).
+                Secrets are removed from the output.
             kwargs (dict):  extra arguments. Use to pass external values.
                     Following keys are supported by default:
                         - "log": {values passed to logger}
@@ -1137,29 +1848,72 @@ class CxTowerServer(models.Model):
             sudo,
         )
 
-        try:
-            status = []
-            response = []
-            error = []
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        exec_options = {
+            "max_output": int(
+                get_param(
+                    "cetmix_tower_server.command_output_max_size", default=10485760
+                )
+            ),
+        }
+        flush_interval = int(
+            get_param("cetmix_tower_server.command_output_flush_interval", default=5)
+        )
+        status = []
+        response = []
+        error = []
+
+        spoiler = self.env["cx.tower.key"].SECRET_VALUE_SPOILER
+        response_redactor = SecretRedactor(secrets, spoiler)
+        error_redactor = SecretRedactor(secrets, spoiler)
+
+        def flush_output(resp, err, final=False):
+            """Pass new output with secrets removed"""
+            resp = response_redactor.feed(resp)
+            err = error_redactor.feed(err)
+            if final:
+                resp += response_redactor.flush()
+                err += error_redactor.flush()
+            output_callback(resp, err)
+
+        if output_callback and flush_interval > 0:
+            exec_options.update(
+                output_callback=flush_output, flush_interval=flush_interval
+            )
 
+        try:
             # Command is a single sting. No 'sudo' or 'sudo' w/o password
             if isinstance(prepared_command_code, str):
                 status, response, error = client.exec_command(
-                    prepared_command_code, sudo=sudo
+                    prepared_command_code, sudo=sudo, **exec_options
                 )
 
-            # Multiple commands: sudo with password
+            # Multiple commands: sudo with password.
+            # Run them in a single session to send the password only once.
             elif isinstance(prepared_command_code, list):
-                for cmd in prepared_command_code:
-                    st, resp, err = client.exec_command(cmd, sudo=sudo)
+                script, marker = self._prepare_ssh_sudo_script(
+                    command_code, command_path
+                )
+                if exec_options.get("output_callback"):
+                    exec_options["output_callback"] = self._get_ssh_sudo_script_stream(
+                        flush_output, marker
+                    )
+                st, response, error = client.exec_command(
+                    script, sudo=sudo, **exec_options
+                )
+                status, response = self._parse_ssh_sudo_script_output(response, marker)
+                # Script was not started or was interrupted, eg wrong password
+                if not status or (st != 0 and status[-1] == 0):
                     status.append(st)
-                    response += resp
-                    error += err
 
             # Something weird ))
             else:
                 status = -1
 
+            # Pass the end of the output held back by the stream
+            if exec_options.get("output_callback"):
+                exec_options["output_callback"]("", "", final=True)
+
         except Exception as e:
             if raise_on_error:
                 raise ValidationError(
@@ -1253,6 +2007,8 @@ class CxTowerServer(models.Model):
         "pwd && ls -l" will be executed as:
             sudo pwd
             sudo ls -l
+        In the sudo with password mode ('p') commands are run
+        in a single session, check `_prepare_ssh_sudo_script()`.
 
         Args:
             command_code (text): initial command
@@ -1278,21 +2034,11 @@ class CxTowerServer(models.Model):
 
             # Detect command separator
             if "&&" in command_code or ";" in command_code:
-                # If command consists of several commands:
-                # Replace alternative separator to avoid possible issues.
-                # We need to stop always if some command issues error.
-                # Check TODO above
-                command_code.replace(";", "&&")
                 separator = "&&"
-                command_code.replace("\\", "").replace("\n", "").split(separator)
-                result = (
-                    command_code.replace("\\", "").replace("\n", "").split(separator)
-                    if separator
-                    else [command_code]
-                )
+                result = self._split_ssh_command(command_code)
 
                 # Sudo with password expects a list of commands
-                result = [f"{sudo_prefix} {cmd.strip()}" for cmd in result]
+                result = [f"{sudo_prefix} {cmd}" for cmd in result]
 
                 # Merge back into a single command is sudo is without password
                 if sudo == "n":
@@ -1321,6 +2067,98 @@ class CxTowerServer(models.Model):
 
         return result
 
+    def _split_ssh_command(self, command_code):
+        """Split command into separate commands.
+        Commands are split by the '&&' separator.
+
+        Args:
+            command_code (text): initial command
+
+        Returns:
+            list: commands
+        """
+        if "&&" not in command_code and ";" not in command_code:
+            return [command_code]
+        # If command consists of several commands:
+        # Replace alternative separator to avoid possible issues.
+        # We need to stop always if some command issues error.
+        # Check TODO above
+        command_code.replace(";", "&&")
+        return [
+            cmd.strip()
+            for cmd in command_code.replace("\\", "").replace("\n", "").split("&&")
+        ]
+
+    def _prepare_ssh_sudo_script(self, command_code, path=None):
+        """Prepare command for the 'sudo with password' mode.
+        All commands are run in a single remote shell started with sudo,
+        so the password is sent only once and the path change
+        applies to all the commands.
+        Exit status of each command is printed to the output
+        using a marker line. Script is stopped on the first error.
+
+        Args:
+            command_code (text): initial command
+            path (str, optional): directory where command should be executed
+
+        Returns:
+            tuple: (command, marker)
+        """
+        marker = f"CX_TOWER_STEP_{generate_random_id(population=16)}"
+        commands = self._split_ssh_command(command_code)
+        if path:
+            commands = [f"cd {path}"] + commands
+        status_line = (
+            f"cx_status=$?; printf '\\n{marker}:%s\\n' \"$cx_status\"; "
+            '[ "$cx_status" -eq 0 ] || exit "$cx_status"'
+        )
+        script = "\n".join(f"{cmd}\n{status_line}" for cmd in commands)
+        return f"sudo -S -p '' sh -c {shlex.quote(script)}", marker
+
+    def _parse_ssh_sudo_script_output(self, response, marker):
+        """Remove status marker lines from the script output.
+
+        Args:
+            response (list): output lines
+            marker (str): marker returned by `_prepare_ssh_sudo_script()`
+
+        Returns:
+            tuple: (list of command statuses, list of output lines)
+        """
+        text = "".join(str(r) for r in response)
+        pattern = re.compile(f"\\n{marker}:(\\d+)\\n")
+        statuses = [int(st) for st in pattern.findall(text)]
+        text = pattern.sub("", text)
+        return statuses, text.splitlines(keepends=True)
+
+    def _get_ssh_sudo_script_stream(self, output_callback, marker):
+        """Wrap output callback to remove status marker lines
+        from the streamed script output.
+        Text after the last line break is held back until the next call
+        because it can be the beginning of a marker line.
+        Call it with `final=True` when the script is finished
+        to pass the held back text.
+
+        Args:
+            output_callback (callable): callback to pass the output to
+            marker (str): marker returned by `_prepare_ssh_sudo_script()`
+
+        Returns:
+            callable: output_callback(response, error, final=False)
+        """
+        pending = ""
+
+        def stream(resp, err, final=False):
+            nonlocal pending
+            text = "".join(
+                self._parse_ssh_sudo_script_output([pending + resp], marker)[1]
+            )
+            cut = len(text) if final else max(text.rfind("\n"), 0)
+            pending = text[cut:]
+            output_callback(text[:cut], err, final=final)
+
+        return stream
+
     def _parse_ssh_command_results(
         self, status, response, error, key_values=None, **kwargs
     ):
@@ -1359,19 +2197,14 @@ class CxTowerServer(models.Model):
             status = final_status
 
         # This is needed to remove keys
-        if key_values:
-            key_model = self.env["cx.tower.key"]
+        redactor = SecretRedactor(
+            key_values, self.env["cx.tower.key"].SECRET_VALUE_SPOILER
+        )
 
         # Compose response message
         if response and isinstance(response, list):
             # Replace secrets with spoiler
-            response_vals = [
-                key_model._replace_with_spoiler(str(r), key_values)
-                if key_values
-                else str(r)
-                for r in response
-            ]
-            response = "".join(response_vals)
+            response = redactor.redact("".join(str(r) for r in response))
 
         elif not response:
             # For not to save an empty list `[]` in log
@@ -1380,13 +2213,7 @@ class CxTowerServer(models.Model):
         # Compose error message
         if error and isinstance(error, list):
             # Replace secrets with spoiler
-            error_vals = [
-                key_model._replace_with_spoiler(str(e), key_values)
-                if key_values
-                else str(e)
-                for e in error
-            ]
-            error = "".join(error_vals)
+            error = redactor.redact("".join(str(e) for e in error))
         elif not error:
             # For not to save an empty list `[]` in log
             error = None
@@ -1443,15 +2270,64 @@ class CxTowerServer(models.Model):
         """
         self.ensure_one()
         client = self._connect(raise_on_error=False)
-        client.delete_file(remote_path)
+        try:
+            client.delete_file(remote_path)
+        finally:
+            client.disconnect()
+
+    def _pull_files(self, files, deadline=None):
+        """Download files of the server one by one.
+        Files are processed consecutively so they are transferred
+        over the same pooled SSH connection and SFTP session.
+
+        Args:
+            files (cx.tower.file()): Files to download.
+                Files of other servers are ignored.
+            deadline (float, optional): `time.monotonic()` value after which
+                remaining files are left for the next run.
+        """
+        self.ensure_one()
+        for file in files.filtered(lambda f: f.server_id == self):
+            if deadline and time.monotonic() > deadline:
+                break
+            file.download(raise_error=False)
+
+    def stat_file(self, remote_path):
+        """
+        Get size and modification time of a remote file.
+        Used to check if file was modified without downloading it.
+
+        Args:
+            remote_path (Text): full path file location with file type
+             (e.g. /test/my_file.txt).
+
+        Raise:
+            ValidationError: raise if file not found.
+
+        Returns:
+            Dict: {"size": file size in bytes, "mtime": modification timestamp}
+        """
+        self.ensure_one()
+        client = self._connect(raise_on_error=False)
+        try:
+            result = client.stat_file(remote_path)
+        except FileNotFoundError as fe:
+            raise ValidationError(
+                _("The file %(f_path)s not found.", f_path=remote_path)
+            ) from fe
+        finally:
+            client.disconnect()
+        return {"size": result.st_size, "mtime": result.st_mtime}
 
     def upload_file(self, data, remote_path, from_path=False):
         """
         Upload file to remote server.
 
         Args:
-            data (Text, Bytes): If the data are text, they are converted to bytes,
-                                contains a local file path if from_path=True.
+            data (Text, Bytes, file object): If the data are text, they are
+                                converted to bytes, contains a local file path
+                                if from_path=True. File objects are streamed
+                                in chunks.
             remote_path (Text): full path file location with file type
              (e.g. /test/my_file.txt).
             from_path (Boolean): set True if `data` is file path.
@@ -1465,14 +2341,18 @@ class CxTowerServer(models.Model):
         """
         self.ensure_one()
         client = self._connect(raise_on_error=False)
-        if from_path:
-            result = client.upload_file(data, remote_path)
-        else:
-            # Convert string to bytes
-            if isinstance(data, str):
-                data = data.encode()
-            file = io.BytesIO(data)
-            result = client.upload_file(file, remote_path)
+        try:
+            if from_path or hasattr(data, "read"):
+                result = client.upload_file(data, remote_path)
+            else:
+                # Convert string to bytes
+                if isinstance(data, str):
+                    data = data.encode()
+                file = io.BytesIO(data)
+                result = client.upload_file(file, remote_path)
+        finally:
+            # Release connection so its SFTP session is reused by the next operation
+            client.disconnect()
         return result
 
     def download_file(self, remote_path):
@@ -1497,6 +2377,36 @@ class CxTowerServer(models.Model):
             raise ValidationError(
                 _("The file %(f_path)s not found.", f_path=remote_path)
             ) from fe
+        finally:
+            client.disconnect()
+        return result
+
+    def download_fileobj(self, remote_path, file):
+        """
+        Download file from remote server into a file object.
+        File content is streamed in chunks.
+
+        Args:
+            remote_path (Text): full path file location with file type
+             (e.g. /test/my_file.txt).
+            file (file object): file object to write the content to.
+
+        Raise:
+            ValidationError: raise if file not found.
+
+        Returns:
+            Result (Int): number of bytes transferred.
+        """
+        self.ensure_one()
+        client = self._connect(raise_on_error=False)
+        try:
+            result = client.download_fileobj(remote_path, file)
+        except FileNotFoundError as fe:
+            raise ValidationError(
+                _("The file %(f_path)s not found.", f_path=remote_path)
+            ) from fe
+        finally:
+            client.disconnect()
         return result
 
     def action_open_files(self):
@@ -1,7 +1,9 @@
 # Copyright (C) 2024 Cetmix OÜ
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import copy
 
 from odoo import _, api, fields, models
+from odoo.exceptions import ValidationError
 
 
 class CxTowerServerTemplate(models.Model):
@@ -158,6 +160,61 @@ class CxTowerServerTemplate(models.Model):
         template = self.get_by_reference(template_reference)
         return template._create_new_server(server_name, **kwargs)
 
+    @api.model
+    def create_servers_from_templates(self, server_specs):
+        """Create several servers at once.
+        Bulk version of `create_server_from_template()`.
+        Servers are created with a single `create()` call.
+        All specs are checked before any server is created.
+
+        Args:
+            server_specs (List of Dict): Servers to create. Each dict contains:
+                template_reference (Char): Server template reference
+                server_name (Char): Name of the new server
+                and optional values supported by `create_server_from_template()`
+                eg:
+                [
+                    {
+                        "template_reference": "odoo",
+                        "server_name": "Odoo 1",
+                        "ip_v4_address": "10.0.0.1",
+                        "configuration_variables": {"branch": "prod"},
+                    },
+                ]
+
+        Raises:
+            ValidationError: if server name is missing or template is not found
+
+        Returns:
+            cx.tower.server: newly created server records
+        """
+        templates = self.get_by_references(
+            [spec.get("template_reference") for spec in server_specs]
+        )
+        for index, spec in enumerate(server_specs, start=1):
+            if not spec.get("server_name"):
+                raise ValidationError(
+                    _("Server #%(index)s: server name is not set", index=index)
+                )
+            if not templates.get(spec.get("template_reference")):
+                raise ValidationError(
+                    _(
+                        "Server '%(name)s': template '%(reference)s' is not found",
+                        name=spec["server_name"],
+                        reference=spec.get("template_reference"),
+                    )
+                )
+
+        specs = []
+        for server_spec in server_specs:
+            spec = dict(server_spec)
+            template = templates[spec.pop("template_reference")]
+            spec.update(
+                {"name": spec.pop("server_name"), "server_template_id": template.id}
+            )
+            specs.append(spec)
+        return self._create_new_servers(specs)
+
     def _create_new_server(self, name, **kwargs):
         """Creates a new server from template
 
@@ -183,10 +240,29 @@ class CxTowerServerTemplate(models.Model):
         Returns:
             cx.tower.server: newly created server record
         """
+        return self._create_new_servers(
+            [
+                dict(kwargs, name=name, server_template_id=template.id)
+                for template in self
+            ]
+        )
+
+    @api.model
+    def _create_new_servers(self, server_specs):
+        """Creates new servers from templates.
+        Flight plans of the templates are run on all new servers
+        of the same template at once.
+
+        Args:
+            server_specs (List of Dict): values of the new servers.
+                Each dict must contain `name` and `server_template_id`.
+                Check `_create_new_server()` for other values.
+
+        Returns:
+            cx.tower.server: newly created server records
+        """
         servers = self.env["cx.tower.server"].create(
-            self._prepare_server_values(
-                name=name, server_template_id=self.id, **kwargs
-            ),
+            self._prepare_servers_values(server_specs)
         )
 
         for server in servers:
@@ -196,9 +272,14 @@ class CxTowerServerTemplate(models.Model):
                     server=server, raise_if_exists=False
                 ).id
 
-            flight_plan = server.server_template_id.flight_plan_id
-            if flight_plan:
-                flight_plan.execute(server)
+        for flight_plan in servers.server_template_id.flight_plan_id:
+            plan_servers = servers.filtered(
+                lambda server, plan=flight_plan: (
+                    server.server_template_id.flight_plan_id == plan
+                )
+            )
+            # New servers are not visible to parallel workers until committed
+            plan_servers._fan_out_after_commit("_execute_flight_plans", flight_plan)
 
         return servers
 
@@ -234,69 +315,61 @@ class CxTowerServerTemplate(models.Model):
             list: A list of dictionaries representing the values for the new server
                   records.
         """
-        model_fields = self._fields
-        field_o2m_type = fields.One2many
+        return self._prepare_servers_values(
+            [dict(kwargs, server_template_id=template.id) for template in self]
+        )
 
-        # define the magic fields that should not be copied
-        # (including ID and concurrency fields)
-        MAGIC_FIELDS = models.MAGIC_COLUMNS + [self.CONCURRENCY_CHECK_FIELD]
+    @api.model
+    def _prepare_servers_values(self, server_specs):
+        """
+        Prepare values to create new servers.
+        Each template is read only once regardless of the number of servers.
 
-        # read all values required to create a new server from the template
-        vals_list = self.read(self._get_fields_tower_server(), load=False)
+        Args:
+            server_specs (List of Dict): values of the new servers.
+                Each dict must contain `server_template_id`.
+                `configuration_variables` are merged with the template
+                variable values, other values are set as is.
+
+        Returns:
+            list: A list of dictionaries representing the values for the new server
+                  records.
+        """
+        templates = self.browse(
+            list({spec["server_template_id"] for spec in server_specs})
+        )
+        template_values = templates._read_server_values()
+
+        # Get all configuration variables at once
+        variables = self._get_configuration_variables(
+            [
+                variable_reference
+                for spec in server_specs
+                for variable_reference in spec.get("configuration_variables") or {}
+            ]
+        )
 
-        # process each template record
-        for values in vals_list:
-            template = self.browse(values["id"])
-
-            for field in values.keys():
-                if isinstance(model_fields[field], field_o2m_type):
-                    # get related records for One2many field
-                    related_records = getattr(template, field)
-                    new_records = []
-                    # for each related record, read its data and prepare it for copying
-                    for record in related_records:
-                        record_data = {
-                            k: v
-                            for k, v in record.read(load=False)[0].items()
-                            if k not in MAGIC_FIELDS
-                        }
-                        # set the inverse field (link back to the template)
-                        # to False to unlink from the original template
-                        record_data[model_fields[field].inverse_name] = False
-                        new_records.append((0, 0, record_data))
-
-                    values[field] = new_records
+        vals_list = []
+        for spec in server_specs:
+            kwargs = dict(spec)
+            values = copy.deepcopy(template_values[kwargs["server_template_id"]])
 
             # custom specific variable values
             configuration_variables = kwargs.pop("configuration_variables", None)
             if configuration_variables:
-                variable_vals_list = []
-                variable_obj = self.env["cx.tower.variable"]
-
-                for (
-                    variable_reference,
-                    variable_value,
-                ) in configuration_variables.items():
-                    variable = variable_obj.search(
-                        [("reference", "=", variable_reference)]
+                variable_vals_list = [
+                    (
+                        0,
+                        0,
+                        {
+                            "variable_id": variables[variable_reference].id,
+                            "value_char": variable_value,
+                        },
                     )
-                    if not variable:
-                        variable = variable_obj.create(
-                            {
-                                "name": variable_reference,
-                            }
-                        )
-
-                    variable_vals_list.append(
-                        (
-                            0,
-                            0,
-                            {
-                                "variable_id": variable.id,
-                                "value_char": variable_value,
-                            },
-                        )
+                    for variable_reference, variable_value in (
+                        configuration_variables.items()
                     )
+                ]
 
                 # update or add variable values
                 existing_variable_values = values.get("variable_value_ids", [])
@@ -318,10 +391,81 @@ class CxTowerServerTemplate(models.Model):
 
                 values["variable_value_ids"] = existing_variable_values
 
-            # remove the `id` field to ensure a new record is created
-            # instead of updating the existing one
-            del values["id"]
             # update the values with additional arguments from kwargs
             values.update(kwargs)
+            vals_list.append(values)
 
         return vals_list
+
+    def _read_server_values(self):
+        """
+        Read template values used to create new servers.
+        Related records of each One2many field are read at once for all templates.
+
+        Returns:
+            dict: {template.id: server values}
+        """
+        model_fields = self._fields
+
+        # define the magic fields that should not be copied
+        # (including ID and concurrency fields)
+        MAGIC_FIELDS = models.MAGIC_COLUMNS + [self.CONCURRENCY_CHECK_FIELD]
+
+        # read all values required to create a new server from the template
+        vals_list = self.read(self._get_fields_tower_server(), load=False)
+
+        o2m_fields = [
+            field
+            for field in self._get_fields_tower_server()
+            if isinstance(model_fields[field], fields.One2many)
+        ]
+        for field in o2m_fields:
+            # read data of all related records at once
+            related_data = {
+                record_data["id"]: record_data
+                for record_data in self.mapped(field).read(load=False)
+            }
+            for values in vals_list:
+                new_records = []
+                for record_id in values[field]:
+                    record_data = {
+                        k: v
+                        for k, v in related_data[record_id].items()
+                        if k not in MAGIC_FIELDS
+                    }
+                    # set the inverse field (link back to the template)
+                    # to False to unlink from the original template
+                    record_data[model_fields[field].inverse_name] = False
+                    new_records.append((0, 0, record_data))
+
+                values[field] = new_records
+
+        # remove the `id` field to ensure a new record is created
+        # instead of updating the existing one
+        return {values.pop("id"): values for values in vals_list}
+
+    @api.model
+    def _get_configuration_variables(self, variable_references):
+        """Get variables by their references.
+        Variables that don't exist are created.
+
+        Args:
+            variable_references (List of Char): variable references
+
+        Returns:
+            dict: {variable_reference: cx.tower.variable()}
+        """
+        if not variable_references:
+            return {}
+        variable_obj = self.env["cx.tower.variable"]
+        variables = variable_obj.get_by_references(variable_references)
+        missing_references = [
+            reference for reference, variable in variables.items() if not variable
+        ]
+        if missing_references:
+            new_variables = variable_obj.create(
+                [{"name": reference} for reference in missing_references]
+            )
+            for index, reference in enumerate(missing_references):
+                variables[reference] = new_variables[index]
+        return variables
@@ -1,11 +1,34 @@
 # Copyright (C) 2024 Cetmix OÜ
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
-from jinja2 import Environment, Template, meta
+from hashlib import sha256
+
+from jinja2 import Environment, meta
 from jinja2 import exceptions as jn_exceptions
 
 from odoo import fields, models
 from odoo.exceptions import UserError
 
+from .tools import LRUCache
+
+# Shared by all templates. Same options as `jinja2.Template(code, trim_blocks=True)`
+TEMPLATE_ENV = Environment(trim_blocks=True)
+
+# Compiled templates and variables used in them. Keyed by code hash
+TEMPLATE_CACHE = LRUCache(max_size=512)
+TEMPLATE_VARIABLES_CACHE = LRUCache(max_size=512)
+
+
+def _get_code_hash(code):
+    """Get cache key for the template code
+
+    Args:
+        code (Text): template code
+
+    Returns:
+        Char: code hash
+    """
+    return sha256(str(code).encode()).hexdigest()
+
 
 class CxTowerTemplateMixin(models.AbstractModel):
     """Used to implement template rendering functions.
@@ -25,7 +48,6 @@ class CxTowerTemplateMixin(models.AbstractModel):
             dict {'record_id': {variables}...}
                 NB: 'record_id' is String
         """
-        Environment()
         res = {}
         for rec in self:
             res.update({str(rec.id): self.get_variables_from_code(rec.code)})
@@ -40,10 +62,13 @@ class CxTowerTemplateMixin(models.AbstractModel):
         Returns:
             variables (List) variables (eg ['var','var2',..])
         """
-        env = Environment()
-        ast = env.parse(code)
-        undeclared_variables = meta.find_undeclared_variables(ast)
-        return list(undeclared_variables) if undeclared_variables else []
+        code_hash = _get_code_hash(code)
+        undeclared_variables = TEMPLATE_VARIABLES_CACHE.get(code_hash)
+        if undeclared_variables is None:
+            ast = TEMPLATE_ENV.parse(code)
+            undeclared_variables = frozenset(meta.find_undeclared_variables(ast))
+            TEMPLATE_VARIABLES_CACHE.set(code_hash, undeclared_variables)
+        return list(undeclared_variables)
 
     def _prepare_variable_commands(self, field_names, force_record=None):
         """
@@ -118,10 +143,27 @@ class CxTowerTemplateMixin(models.AbstractModel):
                     key: self._make_value_pythonic(value)
                     for key, value in kwargs.items()
                 }
-            return Template(code, trim_blocks=True).render(kwargs)
+            return self._get_template(code).render(kwargs)
         except jn_exceptions.UndefinedError as e:
             raise UserError(e) from e
 
+    def _get_template(self, code):
+        """Get compiled template.
+        Templates are compiled once and kept in cache.
+
+        Args:
+            code (Text): template code
+
+        Returns:
+            jinja2.Template: compiled template
+        """
+        code_hash = _get_code_hash(code)
+        template = TEMPLATE_CACHE.get(code_hash)
+        if template is None:
+            template = TEMPLATE_ENV.from_string(code)
+            TEMPLATE_CACHE.set(code_hash, template)
+        return template
+
     def _make_value_pythonic(self, value):
         """Prepares value for use in 'pythonic' mode
             by enclosing strings into double quotes
@@ -2,7 +2,11 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 import uuid
 
-from odoo import fields, models
+from odoo import _, fields, models
+from odoo.exceptions import UserError
+from odoo.osv.expression import OR
+
+from .tools import topological_sort
 
 
 class TowerVariableMixin(models.AbstractModel):
@@ -31,36 +35,17 @@ class TowerVariableMixin(models.AbstractModel):
         """
         res = {}
 
-        # Get global values first
         if variable_references:
-            global_values = self.get_global_variable_values(variable_references)
-
-            # Get record wise values
+            record_values, global_values = self._get_variable_value_data(
+                variable_references
+            )
             for rec in self:
-                res_vars = global_values.get(
-                    rec.id, {}
-                )  # set global values as defaults
-                for variable_reference in variable_references:
-                    # Check if this is a system variable
-                    system_value = self._get_system_variable_value(variable_reference)
-                    if system_value:
-                        res_vars.update({variable_reference: system_value})
-
-                    # Get regular value
-                    else:
-                        value = rec.variable_value_ids.filtered(
-                            lambda v,
-                            variable_reference=variable_reference: v.variable_reference
-                            == variable_reference
-                        )
-                        if value:
-                            res_vars.update({variable_reference: value.value_char})
-
-                res.update({rec.id: res_vars})
-
-            # Render templates in values
-            for variables in res.values():
-                self._render_variable_values(variables)
+                # Global values are used as defaults
+                values = dict(global_values)
+                values.update(record_values.get(rec.id, {}))
+                res.update(
+                    {rec.id: rec._render_variable_values(variable_references, values)}
+                )
 
         return res
 
@@ -68,9 +53,6 @@ class TowerVariableMixin(models.AbstractModel):
         """Get global values for variables.
             Such values do not belong to any record.
 
-        This function is used by get_variable_values()
-        to compute fallback values.
-
         Args:
             variable_references (list of Char): variable names
 
@@ -80,22 +62,150 @@ class TowerVariableMixin(models.AbstractModel):
         res = {}
 
         if variable_references:
-            values = self.env["cx.tower.variable.value"].search(
-                self._compose_variable_global_values_domain(variable_references)
-            )
+            values = {
+                vals["variable_reference"]: vals["value_char"]
+                for vals in self.env["cx.tower.variable.value"].search_read(
+                    self._compose_variable_global_values_domain(variable_references),
+                    ["variable_reference", "value_char"],
+                )
+            }
             for rec in self:
-                res_vars = {}
-                for variable_reference in variable_references:
-                    # Get variable value
-                    value = values.filtered(
-                        lambda v,
-                        variable_reference=variable_reference: v.variable_reference
-                        == variable_reference
-                    )
-                    res_vars.update({variable_reference: value.value_char or None})
-                res.update({rec.id: res_vars})
+                res.update(
+                    {
+                        rec.id: {
+                            variable_reference: values.get(variable_reference) or None
+                            for variable_reference in variable_references
+                        }
+                    }
+                )
         return res
 
+    def _get_variable_value_data(self, variable_references):
+        """Read record and global values of the variables for all records at once.
+        Values of the variables used in other values
+        (eg "{{ server_root }}/assets") are read too.
+
+        Args:
+            variable_references (list of Char): variable names
+
+        Returns:
+            tuple: (
+                {record_id: {variable_reference: value}},
+                {variable_reference: value}
+            )
+        """
+        inverse_name = self._fields["variable_value_ids"].inverse_name
+        record_ids = [record_id for record_id in self.ids if isinstance(record_id, int)]
+        value_obj = self.env["cx.tower.variable.value"]
+        TemplateMixin = self.env["cx.tower.template.mixin"]
+
+        record_values = {}
+        global_values = {}
+        references = set(variable_references)
+        loaded_references = set()
+
+        # Each iteration reads variables referenced by the values read before
+        while references - loaded_references:
+            references_to_load = list(references - loaded_references)
+            loaded_references |= references
+
+            domain = OR(
+                [
+                    self._compose_variable_global_values_domain(references_to_load),
+                    [
+                        (inverse_name, "in", record_ids),
+                        ("variable_reference", "in", references_to_load),
+                    ],
+                ]
+            )
+            for vals in value_obj.search_read(
+                domain, [inverse_name, "variable_reference", "value_char"]
+            ):
+                variable_reference = vals["variable_reference"]
+                value = vals["value_char"]
+                if vals[inverse_name]:
+                    record_values.setdefault(vals[inverse_name][0], {}).update(
+                        {variable_reference: value}
+                    )
+                else:
+                    global_values.update({variable_reference: value or None})
+                if value and "{{ " in value:
+                    references.update(TemplateMixin.get_variables_from_code(value))
+
+        return record_values, global_values
+
+    def _render_variable_values(self, variable_references, values):
+        """Renders variable values using other variable values.
+        For example we have the following values:
+            "server_root": "/opt/server"
+            "server_assets": "{{ server_root }}/assets"
+
+        This function will render the "server_assets" variable:
+            "server_assets": "/opt/server/assets"
+
+        Variables are rendered in the order of their dependencies
+        so each value is rendered only once.
+
+        Args:
+            variable_references (list of Char): variable names
+            values (dict): raw variable values {variable_reference: value}
+
+        Raises:
+            UserError: if variable values reference each other
+
+        Returns:
+            dict {variable_reference: value}
+        """
+        self.ensure_one()
+        TemplateMixin = self.env["cx.tower.template.mixin"]
+
+        # Compose dependency graph {variable_reference: (value, [dependencies])}
+        graph = {}
+        references = list(variable_references)
+        while references:
+            variable_reference = references.pop()
+            if variable_reference in graph:
+                continue
+
+            # Check if this is a system variable
+            value = self._get_system_variable_value(variable_reference) or values.get(
+                variable_reference
+            )
+            dependencies = (
+                TemplateMixin.get_variables_from_code(value)
+                if isinstance(value, str) and "{{ " in value
+                else []
+            )
+            graph.update({variable_reference: (value, dependencies)})
+            references += dependencies
+
+        try:
+            sorted_references = topological_sort(
+                {reference: graph[reference][1] for reference in graph}
+            )
+        except ValueError as e:
+            raise UserError(
+                _(
+                    "Variable values reference each other: %(cycle)s",
+                    cycle=" -> ".join(e.args[0]),
+                )
+            ) from e
+
+        rendered = {}
+        for variable_reference in sorted_references:
+            value, dependencies = graph[variable_reference]
+            if dependencies:
+                value = TemplateMixin.render_code_custom(
+                    value,
+                    **{reference: rendered[reference] for reference in dependencies},
+                )
+            rendered.update({variable_reference: value})
+
+        return {
+            variable_reference: rendered[variable_reference]
+            for variable_reference in variable_references
+        }
+
     def _get_current_server(self):
         """Get current server record.
             This is needed to render system variables properly.
@@ -188,32 +298,3 @@ class TowerVariableMixin(models.AbstractModel):
             ("variable_reference", "in", variable_references),
         ]
         return domain
-
-    def _render_variable_values(self, variables):
-        """Renders variable values using other variable values.
-        For example we have the following values:
-            "server_root": "/opt/server"
-            "server_assets": "{{ server_root }}/assets"
-
-        This function will render the "server_assets" variable:
-            "server_assets": "/opt/server/assets"
-
-        Args:
-            variables (dict): values to complete
-        """
-        self.ensure_one()
-        TemplateMixin = self.env["cx.tower.template.mixin"]
-        for key in variables:
-            var_value = variables[key]
-            # Render only if template is found
-            if var_value and "{{ " in var_value:
-                # Get variables used in value
-                value_vars = TemplateMixin.get_variables_from_code(var_value)
-
-                # Render variables used in value
-                res = self.get_variable_values(value_vars)
-
-                # Render value using variables
-                variables[key] = TemplateMixin.render_code_custom(
-                    var_value, **res[self.id]
-                )
@@ -1,5 +1,9 @@
 # Copyright (C) 2022 Cetmix OÜ
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import hashlib
+import re
+import threading
+from collections import OrderedDict
 from random import choices
 
 CHARS = "23456789acefhjkmnprtvwxyz"
@@ -34,3 +38,212 @@ def generate_random_id(sections=1, population=4, separator="-"):
         i += 1
 
     return separator.join(result)
+
+
+def topological_sort(graph):
+    """Sort graph nodes so each node goes after the nodes it depends on
+
+    Args:
+        graph (dict): {node: [nodes it depends on]}
+
+    Raises:
+        ValueError: if graph has a cycle. First argument is the list
+            of nodes that form the cycle, eg ['a', 'b', 'a']
+
+    Returns:
+        list: sorted nodes
+    """
+    result = []
+    # Nodes being visited and visited nodes
+    visiting = set()
+    visited = set()
+
+    for root in graph:
+        if root in visited:
+            continue
+        path = [root]
+        stack = [iter(graph.get(root, ()))]
+        visiting.add(root)
+        while stack:
+            for node in stack[-1]:
+                if node in visiting:
+                    raise ValueError(path[path.index(node) :] + [node])
+                if node not in visited:
+                    path.append(node)
+                    stack.append(iter(graph.get(node, ())))
+                    visiting.add(node)
+                    break
+            else:
+                # All dependencies are sorted
+                node = path.pop()
+                stack.pop()
+                visiting.discard(node)
+                visited.add(node)
+                result.append(node)
+    return result
+
+
+class LRUCache(object):
+    """
+    Thread safe dictionary that keeps `max_size` recently used items.
+    Counts cache hits and misses.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Get cached value and mark it as recently used
+
+        Args:
+            key (hashable): cache key
+            default (any, optional): value returned if key is not cached
+
+        Returns:
+            any: cached value or default
+        """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Put value into the cache. Least recently used value
+        is dropped if cache is full.
+
+        Args:
+            key (hashable): cache key
+            value (any): value to cache
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Remove all values and reset counters"""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class SecretRedactor(object):
+    """
+    Replaces secret values in text with spoiler.
+    All secrets are replaced in a single pass.
+    Text can be processed at once using `redact()`
+    or as a stream of chunks using `feed()` and `flush()`.
+    """
+
+    def __init__(self, secrets, spoiler="*****"):
+        # Longer secrets go first so they are matched before their parts
+        secrets = sorted(
+            {str(secret) for secret in secrets or [] if secret}, key=len, reverse=True
+        )
+        self.spoiler = spoiler
+        self._pattern = (
+            re.compile("|".join(re.escape(secret) for secret in secrets))
+            if secrets
+            else None
+        )
+        # Max length of a secret part that can be left at the end of a chunk
+        self._tail_size = len(secrets[0]) - 1 if secrets else 0
+        self._tail = ""
+
+    def redact(self, text):
+        """Replace secrets in text
+
+        Args:
+            text (Text): text to process
+
+        Returns:
+            Text: text with secrets replaced
+        """
+        if not self._pattern or not text:
+            return text
+        return self._pattern.sub(self.spoiler, text)
+
+    def feed(self, chunk):
+        """Process next chunk of a stream.
+        End of the chunk which can be a beginning of a secret is kept
+        until the next chunk is received or `flush()` is called.
+
+        Args:
+            chunk (Text): next chunk
+
+        Returns:
+            Text: processed part of the stream
+        """
+        if not self._pattern:
+            return chunk
+        text = self._tail + chunk
+        cut = max(len(text) - self._tail_size, 0)
+        result = []
+        position = 0
+        for match in self._pattern.finditer(text):
+            if match.start() >= cut:
+                break
+            result.append(text[position : match.start()])
+            result.append(self.spoiler)
+            position = match.end()
+        cut = max(cut, position)
+        result.append(text[position:cut])
+        self._tail = text[cut:]
+        return "".join(result)
+
+    def flush(self):
+        """Process the rest of the stream
+
+        Returns:
+            Text: processed end of the stream
+        """
+        text = self.redact(self._tail)
+        self._tail = ""
+        return text
+
+
+def escape_like(value):
+    """Escape special characters of the SQL `LIKE` pattern.
+    Use it with the `=like` and `=ilike` domain operators.
+
+    Args:
+        value (Char): value to escape
+
+    Returns:
+        Char: escaped value
+    """
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class HashingFile(object):
+    """
+    File object wrapper that computes hash and size of the written data.
+    Used to hash file content while it is streamed.
+    """
+
+    def __init__(self, file, algorithm="sha1"):
+        self.file = file
+        self.hash = hashlib.new(algorithm)
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
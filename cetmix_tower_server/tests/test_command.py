@@ -1,8 +1,13 @@
-from unittest.mock import patch
+import re
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
 
+from odoo import fields
 from odoo.exceptions import AccessError
 from odoo.tests.common import Form
 
+from ..models.constants import ANOTHER_COMMAND_RUNNING
+from ..models.cx_tower_template_mixin import TEMPLATE_CACHE
 from .common import TestTowerCommon
 
 
@@ -214,6 +219,75 @@ else:
             ),
         )
 
+    def test_execute_command_sudo_password_single_session(self):
+        """Test that sudo with password commands are run in a single session"""
+
+        class FakeClient:
+            def __init__(self):
+                self.commands = []
+
+            def exec_command(self, command, sudo=None, **kwargs):
+                self.commands.append((command, sudo))
+                marker = re.search(r"CX_TOWER_STEP_\w+", command).group()
+                return (
+                    2,
+                    [
+                        "/opt/tower\n",
+                        f"\n{marker}:0\n",
+                        f"\n{marker}:0\n",
+                        "done",
+                        f"\n{marker}:2\n",
+                    ],
+                    ["error\n"],
+                )
+
+        client = FakeClient()
+        # Use the original method instead of the test patch
+        execute_command_using_ssh = self.Server._execute_command_using_ssh.origin
+        result = execute_command_using_ssh(
+            self.server_test_1,
+            client,
+            "pwd && ls -a && mkdir /tmp/test",
+            command_path="/opt/tower",
+            sudo="p",
+        )
+        self.assertEqual(len(client.commands), 1, "Single session must be used")
+        command, sudo = client.commands[0]
+        self.assertEqual(sudo, "p")
+        self.assertTrue(command.startswith(f"{self.sudo_prefix} sh -c "))
+        self.assertIn("cd /opt/tower\n", command)
+        self.assertEqual(result["status"], 2)
+        self.assertEqual(result["response"], "/opt/tower\ndone")
+        self.assertEqual(result["error"], "error\n")
+
+    def test_execute_command_output_stream(self):
+        """Test that streamed command output has secrets removed"""
+
+        class FakeClient:
+            def exec_command(self, command, output_callback=None, **kwargs):
+                # Secret is split between chunks
+                output_callback("mkdir secret", "")
+                output_callback("Folder\ndone\n", "")
+                return 0, ["mkdir secretFolder\ndone\n"], []
+
+        self.env["ir.config_parameter"].sudo().set_param(
+            "cetmix_tower_server.command_output_flush_interval", 1
+        )
+        flushed = []
+        execute_command_using_ssh = self.Server._execute_command_using_ssh.origin
+        result = execute_command_using_ssh(
+            self.server_test_1,
+            FakeClient(),
+            "mkdir #!cxtower.secret.FOLDER!#",
+            output_callback=lambda resp, err: flushed.append(resp),
+        )
+        self.assertEqual(
+            "".join(flushed),
+            f"mkdir {self.Key.SECRET_VALUE_SPOILER}\ndone\n",
+            "Whole output must be passed when the command is finished",
+        )
+        self.assertNotIn("secretFolder", result["response"])
+
     def test_server_render_command(self):
         """Test rendering command using `_render_command` method
         of cx.tower.server
@@ -290,6 +364,34 @@ else:
             msg="Must be rendered as 'cd /tmp && mkdir odoo'",
         )
 
+    def test_render_code_cache(self):
+        """Template is compiled once and reused from cache"""
+        code = "cd {{ test_path_ }} && mkdir {{ test_dir }} # cache test"
+        template = self.command_create_dir._get_template(code)
+        hits = TEMPLATE_CACHE.hits
+        self.assertIs(
+            self.command_create_dir._get_template(code),
+            template,
+            "Compiled template must be reused",
+        )
+        self.assertEqual(TEMPLATE_CACHE.hits, hits + 1, "Cache hit must be counted")
+        self.assertEqual(
+            self.command_create_dir.render_code_custom(
+                code, test_path_="/tmp", test_dir="odoo"
+            ),
+            "cd /tmp && mkdir odoo # cache test",
+            "Template is rendered incorrectly",
+        )
+
+        # Variables are extracted from cache as a new list
+        variables = self.command_create_dir.get_variables_from_code(code)
+        variables.append("test_extra")
+        self.assertEqual(
+            sorted(self.command_create_dir.get_variables_from_code(code)),
+            ["test_dir", "test_path_"],
+            "Cached variables must not be modified",
+        )
+
     def test_execute_command_with_variables(self):
         """Test code execution using command log records"""
 
@@ -755,6 +857,166 @@ else:
             command_result["error"], "Command error doesn't match expected one"
         )
 
+    def test_execute_command_running_check_lock(self):
+        """Command is not run if it is being started by another transaction"""
+        self.assertTrue(self.server_test_1._try_lock_run(self.command_create_dir))
+        self.env["ir.config_parameter"].sudo().set_param(
+            "cetmix_tower_server.running_check_lock", "True"
+        )
+        # Lock can be taken again by the same transaction
+        self.assertTrue(self.server_test_1._try_lock_run(self.command_create_dir))
+        self.assertTrue(self.server_test_1._try_lock_run(self.command_create_dir))
+
+        command_label = "Test running check lock"
+        with patch.object(
+            self.registry["cx.tower.server"], "_try_lock_run", return_value=False
+        ):
+            self.server_test_1.execute_command(
+                self.command_create_dir, log={"label": command_label}
+            )
+        log_record = self.CommandLog.search([("label", "=", command_label)])
+        self.assertEqual(len(log_record), 1)
+        self.assertEqual(log_record.command_status, ANOTHER_COMMAND_RUNNING)
+
+    def test_command_log_output_compression(self):
+        """Large command output is saved in compressed attachments"""
+        self.env["ir.config_parameter"].sudo().set_param(
+            "cetmix_tower_server.command_output_compress_threshold", "100"
+        )
+        self.env["ir.config_parameter"].sudo().set_param(
+            "cetmix_tower_server.command_output_preview_size", "10"
+        )
+        response = "head-12345" + "x" * 200 + "tail-12345"
+        now = fields.Datetime.now()
+        log_record = self.CommandLog.record(
+            self.server_test_1.id,
+            self.command_create_dir.id,
+            now,
+            now,
+            response=response,
+            error="Small error",
+        )
+        self.assertTrue(log_record.response_attachment_id)
+        self.assertEqual(log_record.response_attachment_id.res_id, log_record.id)
+        self.assertFalse(log_record.error_attachment_id)
+        self.assertTrue(log_record.command_response.startswith("head-12345\n"))
+        self.assertTrue(log_record.command_response.endswith("\ntail-12345"))
+        self.assertNotIn("x" * 20, log_record.command_response)
+        self.assertEqual(log_record.command_response_full, response)
+        self.assertEqual(log_record.command_error, "Small error")
+        self.assertEqual(log_record.command_error_full, "Small error")
+
+        # Output of the running command is compressed when it is finished
+        log_record = self.CommandLog.start(
+            self.server_test_1.id, self.command_create_dir.id
+        )
+        log_record.finish(status=1, error=response)
+        self.assertEqual(log_record.error_attachment_id.res_id, log_record.id)
+        self.assertEqual(log_record.command_error_full, response)
+        self.assertNotEqual(log_record.command_error, response)
+
+    def test_command_log_finish_bulk(self):
+        """Several command logs are finished at once with a single digest"""
+        log_records = self.CommandLog
+        start_date = fields.Datetime.now() - timedelta(minutes=5)
+        for command in (self.command_create_dir, self.command_create_new_command):
+            log_records |= self.CommandLog.start(
+                self.server_test_1.id, command.id, start_date=start_date
+            )
+
+        notify_success = MagicMock()
+        notify_danger = MagicMock()
+        with patch.multiple(
+            self.registry["res.users"],
+            notify_success=notify_success,
+            notify_danger=notify_danger,
+        ):
+            log_records.finish(
+                start_date + timedelta(seconds=90), status=0, response="ok"
+            )
+        self.assertEqual(notify_success.call_count, 1, "Single digest must be sent")
+        self.assertIn(
+            "2 commands finished successfully", notify_success.call_args[1]["message"]
+        )
+        notify_danger.assert_not_called()
+        for log_record in log_records:
+            self.assertFalse(log_record.is_running)
+            self.assertEqual(log_record.command_status, 0)
+            self.assertEqual(log_record.command_response, "ok")
+            self.assertEqual(log_record.duration, 90, "Duration must be computed")
+
+        # Notifications are collected instead of being sent
+        notifications = []
+        log_record = self.CommandLog.with_context(
+            cx_tower_command_notifications=notifications
+        ).start(self.server_test_1.id, self.command_create_dir.id)
+        with patch.object(self.registry["res.users"], "notify_danger") as notify_danger:
+            log_record.finish(status=1)
+        notify_danger.assert_not_called()
+        self.assertEqual(len(notifications), 1)
+        self.assertFalse(notifications[0]["success"])
+        self.assertEqual(notifications[0]["user_id"], self.env.user.id)
+
+    def test_command_log_running_output(self):
+        """Output of the running command is saved apart from its log record"""
+        self.env["ir.config_parameter"].sudo().set_param(
+            "cetmix_tower_server.command_output_max_size", "10"
+        )
+        log_record = self.CommandLog.start(
+            self.server_test_1.id, self.command_create_dir.id
+        )
+        log_record.flush()
+
+        # Output is saved using the test transaction
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+        output_writer = log_record._get_output_writer()
+        output_writer.write("12345", "")
+        output_writer.write("67890", "error")
+        output_writer.write("abcdefghijk", "")
+        output_writer.close()
+        log_record.invalidate_cache()
+        self.assertFalse(log_record.command_response, "Log must not be updated")
+        self.assertEqual(log_record.command_response_full, "bcdefghijk")
+        self.assertEqual(log_record.command_error_full, "error")
+        self.assertTrue(log_record.output_date)
+        self.env.cr.execute(
+            "SELECT COUNT(*) FROM cx_tower_command_log_output "
+            "WHERE command_log_id = %s",
+            (log_record.id,),
+        )
+        self.assertEqual(
+            self.env.cr.fetchone()[0], 2, "Chunks out of max size must be removed"
+        )
+
+        # Log is finished after its partial output is committed
+        log_record.finish(status=0, response="final")
+        self.assertEqual(log_record.command_response, "final")
+        self.assertEqual(log_record.command_response_full, "final")
+        self.env.cr.postcommit.run()
+        log_record.invalidate_cache()
+        self.assertFalse(log_record.output_date, "Saved output must be deleted")
+
+    def test_execute_command_multi(self):
+        """Execute command on several servers at once"""
+        server_test_2 = self.server_test_1.copy()
+        servers = self.server_test_1 | server_test_2
+        command_results = servers.with_context(no_log=True).execute_command_multi(
+            self.command_create_dir
+        )
+        self.assertEqual(
+            set(command_results), set(servers.ids), "Each server must return a result"
+        )
+        for command_result in command_results.values():
+            self.assertEqual(
+                command_result["status"], 0, "Command status doesn't match expected one"
+            )
+            self.assertEqual(
+                command_result["response"],
+                "ok",
+                "Command response doesn't match expected one",
+            )
+
     # ---------------------
     # *********************
     #   Python commands
@@ -1,3 +1,6 @@
+import hashlib
+from base64 import b64decode, b64encode
+from types import SimpleNamespace
 from unittest.mock import patch
 
 from odoo import exceptions
@@ -94,6 +97,184 @@ class TestTowerFile(TestTowerCommon):
                 ),
             )
 
+    def test_sync_unchanged_file(self):
+        """
+        Files are not transferred if they were not modified since the latest sync
+        """
+        stat = {"size": 13, "mtime": 1}
+        transfers = []
+
+        def stat_file(this, remote_path):
+            return dict(stat)
+
+        def download_file(this, remote_path):
+            transfers.append(remote_path)
+            return b"Hello, world!"
+
+        def upload_file(this, file, remote_path):
+            transfers.append(remote_path)
+            return SimpleNamespace(st_size=stat["size"], st_mtime=stat["mtime"])
+
+        with patch.multiple(
+            self.registry["cx.tower.server"],
+            stat_file=stat_file,
+            download_file=download_file,
+            upload_file=upload_file,
+        ):
+            # Server file
+            self.file_2.download()
+            self.file_2.download()
+            self.assertEqual(len(transfers), 1, "File must be downloaded once")
+            self.assertEqual(self.file_2.code, "Hello, world!")
+
+            # File is modified on server
+            stat["mtime"] = 2
+            self.file_2.download()
+            self.assertEqual(len(transfers), 2, "Modified file must be downloaded")
+
+            # Manual pull is always done
+            self.file_2.action_pull_from_server()
+            self.assertEqual(len(transfers), 3, "File must be downloaded")
+
+            # Tower file
+            transfers.clear()
+            self.file.upload()
+            self.file.upload()
+            self.assertEqual(len(transfers), 1, "File must be uploaded once")
+
+            # Manual push is always done
+            self.file.action_push_to_server()
+            self.assertEqual(len(transfers), 2, "File must be uploaded")
+
+            # File content is modified
+            self.file.code = "Hello, doge!"
+            self.file.upload()
+            self.assertEqual(len(transfers), 3, "Modified file must be uploaded")
+
+            # File is modified on server
+            stat["size"] = 42
+            self.file.upload()
+            self.assertEqual(len(transfers), 4, "File must be uploaded")
+
+    def test_run_auto_pull_files(self):
+        """
+        Auto sync files are pulled by cron
+        """
+        server_test_2 = self.server_test_1.copy()
+        files = self.file_2 | self.File.create(
+            {
+                "name": "test_2.txt",
+                "source": "server",
+                "server_id": server_test_2.id,
+                "server_dir": "/var/tmp",
+            }
+        )
+        files.write(
+            {
+                "auto_sync": True,
+                "auto_sync_interval": "10-minutes",
+                "sync_date_next": "2024-01-01 00:00:00",
+            }
+        )
+        downloaded = []
+
+        def download_file(this, remote_path):
+            downloaded.append((this.id, remote_path))
+            return b"Hello, world!"
+
+        with patch.object(
+            self.registry["cx.tower.server"], "download_file", download_file
+        ):
+            # Only one file is pulled in a single run
+            self.env["ir.config_parameter"].sudo().set_param(
+                "cetmix_tower_server.file_auto_pull_batch_size", 1
+            )
+            self.File._run_auto_pull_files()
+            self.assertEqual(len(downloaded), 1, "One file must be pulled")
+
+            self.File._run_auto_pull_files()
+            self.assertEqual(
+                sorted(downloaded),
+                sorted(
+                    [
+                        (self.server_test_1.id, "/var/tmp/test.txt"),
+                        (server_test_2.id, "/var/tmp/test_2.txt"),
+                    ]
+                ),
+                "Files must be pulled from their servers",
+            )
+
+            # Files are not pulled before the next sync date
+            self.File._run_auto_pull_files()
+            self.assertEqual(len(downloaded), 2, "Files must not be pulled again")
+
+    def test_binary_file_transfer(self):
+        """
+        Binary files are streamed between the filestore and server
+        """
+        content = b"\x00Doge\x01" * 1000
+        uploaded = []
+
+        def upload_file(this, file, remote_path):
+            uploaded.append(file.read())
+            return "ok"
+
+        def download_fileobj(this, remote_path, file):
+            for i in range(0, len(content), 1024):
+                file.write(content[i : i + 1024])
+            return len(content)
+
+        file_values = {
+            "name": "doge.bin",
+            "file_type": "binary",
+            "server_id": self.server_test_1.id,
+            "server_dir": "/var/tmp",
+        }
+        tower_file = self.File.create(
+            dict(file_values, source="tower", file=b64encode(content))
+        )
+        server_file = self.File.create(dict(file_values, source="server"))
+        with patch.multiple(
+            self.registry["cx.tower.server"],
+            upload_file=upload_file,
+            download_fileobj=download_fileobj,
+        ):
+            tower_file.upload()
+            self.assertEqual(uploaded, [content], "Wrong content uploaded")
+
+            server_file.download()
+            self.assertEqual(
+                b64decode(server_file.file), content, "Wrong content downloaded"
+            )
+            self.assertEqual(
+                server_file.content_hash,
+                hashlib.sha1(content).hexdigest(),
+                "Content hash must be saved",
+            )
+            self.assertEqual(
+                server_file._get_file_attachment().mimetype,
+                "application/octet-stream",
+                "Attachment mimetype must be set",
+            )
+
+            # Modified file replaces the attachment
+            content = b"\x00Doge\x02" * 1000
+            server_file.download()
+            self.assertEqual(
+                b64decode(server_file.file), content, "Wrong content downloaded"
+            )
+            self.assertEqual(
+                self.env["ir.attachment"].search_count(
+                    [
+                        ("res_model", "=", server_file._name),
+                        ("res_field", "=", "file"),
+                        ("res_id", "=", server_file.id),
+                    ]
+                ),
+                1,
+                "Old attachment must be removed",
+            )
+
     def test_get_current_server_code(self):
         """
         Download file from server to tower
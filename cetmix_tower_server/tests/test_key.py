@@ -1,5 +1,8 @@
+from unittest.mock import patch
+
 from odoo.exceptions import AccessError
 
+from ..models.tools import SecretRedactor
 from .common import TestTowerCommon
 
 
@@ -82,6 +85,12 @@ class TestTowerKey(TestTowerCommon):
             "Key string must be in key strings",
         )
 
+        # Key string at the very beginning of the code
+        key_strings = self.Key._extract_key_strings("#!cxtower.secret.MEME_KEY!# &")
+        self.assertEqual(
+            key_strings, ["#!cxtower.secret.MEME_KEY!#"], "Key string must be found"
+        )
+
     def test_parse_key_string(self):
         """Check if key string is parsed correctly"""
 
@@ -220,6 +229,45 @@ class TestTowerKey(TestTowerCommon):
         key_value = self.Key._resolve_key_type_secret("DOGE_KEY", **kwargs)
         self.assertEqual(key_value, "Doge server", "Key value doesn't match")
 
+    def test_secret_cache(self):
+        """Secrets used in code are fetched at once and cached"""
+        key = self.Key.create(
+            {
+                "name": "doge key",
+                "reference": "DOGE_KEY",
+                "secret_value": "Doge dog",
+                "key_type": "s",
+            }
+        )
+        self.Key.create(
+            {
+                "name": "pepe key",
+                "reference": "PEPE_KEY",
+                "secret_value": "Pepe frog",
+                "key_type": "s",
+            }
+        )
+        code = "echo #!cxtower.secret.DOGE_KEY!# #!cxtower.secret.PEPE_KEY!#"
+        self.assertEqual(
+            self.Key._parse_code(code), "echo Doge dog Pepe frog", "Wrong code"
+        )
+
+        # Values are taken from cache now
+        with patch.object(
+            type(self.Key), "search", side_effect=AssertionError("Cache not used")
+        ):
+            self.assertEqual(
+                self.Key._parse_code(code), "echo Doge dog Pepe frog", "Wrong code"
+            )
+
+        # Cache is cleared when key is modified
+        key.secret_value = "Doge cat"
+        self.assertEqual(
+            self.Key._resolve_key_type_secret("DOGE_KEY"),
+            "Doge cat",
+            "Key value doesn't match",
+        )
+
     def test_parse_code(self):
         """Test code parsing"""
 
@@ -397,3 +445,38 @@ class TestTowerKey(TestTowerCommon):
         key_values = ["Wow much", "No like"]
         result = self.Key._replace_with_spoiler(code, key_values)
         self.assertEqual(result, code, "Result doesn't match expected code")
+
+        # ----------------------------------------
+        # Replace repeated key values
+        # ---------------------------
+        self.Key.create(
+            {
+                "name": "Meme key",
+                "reference": "MEME_KEY",
+                "secret_value": "Pepe Frog",
+                "key_type": "s",
+            }
+        )
+        result = self.Key._parse_code_and_return_key_values(
+            "#!cxtower.secret.MEME_KEY!# likes #!cxtower.secret.MEME_KEY!#s"
+        )
+        self.assertEqual(result["code"], "Pepe Frog likes Pepe Frogs")
+        self.assertEqual(result["key_values"], ["Pepe Frog"], "Wrong key values")
+        result = self.Key._replace_with_spoiler(result["code"], result["key_values"])
+        self.assertEqual(
+            result,
+            f"{self.Key.SECRET_VALUE_SPOILER} likes {self.Key.SECRET_VALUE_SPOILER}s",
+            "Result doesn't match expected code",
+        )
+
+    def test_replace_with_spoiler_stream(self):
+        """Check if secrets split between chunks are replaced"""
+        spoiler = self.Key.SECRET_VALUE_SPOILER
+        redactor = SecretRedactor(["Pepe Frog", "Doge much", "Doge"], spoiler)
+        chunks = ["Hey Pe", "pe Frog & Doge", " Doge mu", "ch so like Pepe", " Fr"]
+        result = "".join(redactor.feed(chunk) for chunk in chunks) + redactor.flush()
+        self.assertEqual(
+            result,
+            f"Hey {spoiler} & {spoiler} {spoiler} so like Pepe Fr",
+            "Result doesn't match expected code",
+        )
@@ -0,0 +1,133 @@
+import gzip
+import json
+from datetime import timedelta
+from unittest.mock import patch
+
+from odoo import fields
+
+from .common import TestTowerCommon
+
+
+class TestTowerLogRetention(TestTowerCommon):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.LogRetention = self.env["cx.tower.log.retention"]
+        self.PlanLog = self.env["cx.tower.plan.log"]
+
+    def _create_command_logs(self, count, start_date, **kwargs):
+        """Create finished command logs of Server 1"""
+        return self.CommandLog.create(
+            [
+                dict(
+                    {
+                        "server_id": self.server_test_1.id,
+                        "command_id": self.command_create_dir.id,
+                        "start_date": start_date - timedelta(minutes=i),
+                        "command_response": "Ok",
+                    },
+                    **kwargs,
+                )
+                for i in range(count)
+            ]
+        )
+
+    def test_command_log_retention(self):
+        """Test that command logs are removed according to the policy"""
+        now = fields.Datetime.now()
+        old_logs = self._create_command_logs(3, now - timedelta(days=10))
+        running_log = self._create_command_logs(
+            1, now - timedelta(days=10), is_running=True
+        )
+        recent_logs = self._create_command_logs(4, now)
+
+        policy = self.LogRetention.create(
+            {
+                "name": "Test",
+                "server_ids": [(4, self.server_test_1.id)],
+                "max_age": 5,
+                "archive": True,
+            }
+        )
+        # Batches are smaller than the number of logs to remove.
+        # Expired logs are selected only once.
+        LogRetention = self.registry["cx.tower.log.retention"]
+        with patch.object(
+            LogRetention,
+            "_get_expired_log_ids",
+            autospec=True,
+            side_effect=LogRetention._get_expired_log_ids,
+        ) as get_expired_log_ids:
+            self.assertEqual(policy._apply_log_retention(2), 3)
+        get_expired_log_ids.assert_called_once()
+        self.assertFalse(old_logs.exists(), "Old logs must be removed")
+        self.assertTrue(running_log.exists(), "Running logs must be kept")
+
+        # Logs are saved into archives
+        attachments = self.env["ir.attachment"].search(
+            [("res_model", "=", policy._name), ("res_id", "=", policy.id)]
+        )
+        self.assertEqual(len(attachments), 2)
+        self.assertEqual(policy.archive_count, 2)
+        archived_ids = []
+        for attachment in attachments:
+            for line in gzip.decompress(attachment.raw).decode().splitlines():
+                vals = json.loads(line)
+                self.assertEqual(vals["model"], "cx.tower.command.log")
+                self.assertEqual(vals["command_response"], "Ok")
+                archived_ids.append(vals["id"])
+        self.assertEqual(sorted(archived_ids), sorted(old_logs.ids))
+
+        # Newest logs are kept
+        policy.write({"max_age": 0, "max_count": 2, "archive": False})
+        self.LogRetention._cron_apply_log_retention()
+        self.assertEqual(len(recent_logs.exists()), 2)
+        self.assertEqual(recent_logs.exists(), recent_logs[:2])
+        self.assertTrue(running_log.exists(), "Running logs must be kept")
+
+    def test_plan_log_retention(self):
+        """Test that flight plan logs are removed with their command logs"""
+        now = fields.Datetime.now()
+        plan_log = self.PlanLog.create(
+            {
+                "server_id": self.server_test_1.id,
+                "plan_id": self.plan_1.id,
+                "start_date": now - timedelta(days=10),
+            }
+        )
+        nested_plan_log = self.PlanLog.create(
+            {
+                "server_id": self.server_test_1.id,
+                "plan_id": self.plan_1.id,
+                "start_date": now - timedelta(days=10),
+                "parent_flight_plan_log_id": plan_log.id,
+            }
+        )
+        command_logs = self._create_command_logs(
+            2, now - timedelta(days=10), plan_log_id=plan_log.id
+        )
+        recent_plan_log = self.PlanLog.create(
+            {
+                "server_id": self.server_test_1.id,
+                "plan_id": self.plan_1.id,
+                "start_date": now,
+            }
+        )
+
+        # Command logs of flight plans are not removed by command policies
+        command_policy = self.LogRetention.create({"name": "Commands", "max_age": 5})
+        command_policy._apply_log_retention(100)
+        self.assertTrue(command_logs.exists())
+
+        plan_policy = self.LogRetention.create(
+            {
+                "name": "Plans",
+                "log_type": "plan",
+                "plan_ids": [(4, self.plan_1.id)],
+                "max_age": 5,
+            }
+        )
+        self.assertEqual(plan_policy._apply_log_retention(100), 2)
+        self.assertFalse(plan_log.exists())
+        self.assertFalse(nested_plan_log.exists())
+        self.assertFalse(command_logs.exists())
+        self.assertTrue(recent_plan_log.exists())
@@ -1,5 +1,6 @@
 # Copyright (C) 2022 Cetmix OÜ
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+import threading
 from unittest.mock import patch
 
 from odoo import _, fields
@@ -267,6 +268,25 @@ class TestTowerPlan(TestTowerCommon):
             "Path in command log must be the same as in the flight plan line",
         )
 
+    def test_plan_execute_many_lines(self):
+        """Lines are executed in a loop so long plans do not grow the stack"""
+        plan = self.Plan.create(
+            {
+                "name": "Long plan",
+                "line_ids": [
+                    (0, 0, {"sequence": i, "command_id": self.command_create_dir.id})
+                    for i in range(300)
+                ],
+            }
+        )
+        plan._execute_single(self.server_test_1)
+        plan_log = self.PlanLog.search(
+            [("server_id", "=", self.server_test_1.id), ("plan_id", "=", plan.id)]
+        )
+        self.assertEqual(len(plan_log.command_log_ids), 300, "All lines must be run")
+        self.assertFalse(plan_log.is_running, "Plan must be finished")
+        self.assertEqual(plan_log.plan_status, 0, "Plan status must be 0")
+
     def test_plan_user_access_rule(self):
         """Test plan user access rule"""
         # Create the test plan without assigned plan.lines
@@ -1198,3 +1218,23 @@ class TestTowerPlan(TestTowerCommon):
             plan_log_records.command_log_ids.command_status,
             "Command status should be skipped",
         )
+
+    def test_commit_plan_progress(self):
+        """Only cursors owned by Cetmix Tower are committed between plan lines"""
+        self.env["ir.config_parameter"].sudo().set_param(
+            "cetmix_tower_server.plan_commit_between_lines", "True"
+        )
+        plan_log = self.PlanLog.create(
+            {
+                "server_id": self.server_test_1.id,
+                "plan_id": self.plan_1.id,
+                "start_date": fields.Datetime.now(),
+            }
+        )
+        with patch.object(threading.current_thread(), "testing", False):
+            with patch.object(type(self.env.cr), "commit") as commit:
+                plan_log._commit_plan_progress()
+                commit.assert_not_called()
+
+                plan_log.with_context(cx_tower_own_cursor=True)._commit_plan_progress()
+                commit.assert_called_once()
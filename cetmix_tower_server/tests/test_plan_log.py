@@ -1,5 +1,11 @@
+import threading
+from datetime import timedelta
+from unittest.mock import call, patch
+
+from odoo import fields
 from odoo.exceptions import AccessError
 
+from ..models.constants import PLAN_INTERRUPTED
 from .common import TestTowerCommon
 
 
@@ -55,3 +61,126 @@ class TestTowerPlanlog(TestTowerCommon):
                                 not be able to unlink log entries",
         ):
             test_plan_log_as_bob.unlink()
+
+    def test_plan_log_resume(self):
+        """Interrupted flight plan is marked as stale and resumed"""
+        now = fields.Datetime.now()
+        plan_log = self.PlanLog.create(
+            {
+                "server_id": self.server_test_1.id,
+                "plan_id": self.plan_1.id,
+                "is_running": True,
+                "start_date": now,
+                "plan_line_executed_id": self.plan_line_1.id,
+            }
+        )
+        command_log = self.CommandLog.create(
+            {
+                "server_id": self.server_test_1.id,
+                "command_id": self.command_create_dir.id,
+                "plan_log_id": plan_log.id,
+                "is_running": True,
+                "start_date": now,
+            }
+        )
+
+        # Plan is not stale while it's being updated
+        self.env["ir.config_parameter"].sudo().set_param(
+            "cetmix_tower_server.plan_stale_timeout", 10
+        )
+        self.PlanLog._cron_check_stale_plans()
+        self.assertFalse(plan_log.is_stale, "Plan must not be stale")
+
+        # No progress for an hour
+        plan_log.flush()
+        self.env.cr.execute(
+            """
+            UPDATE cx_tower_plan_log SET write_date = write_date - interval '1 hour'
+            WHERE id = %(plan_log_id)s;
+            UPDATE cx_tower_command_log SET write_date = write_date - interval '1 hour'
+            WHERE plan_log_id = %(plan_log_id)s;
+            """,
+            {"plan_log_id": plan_log.id},
+        )
+        plan_log.invalidate_cache()
+
+        # Command is still running and its output is being saved
+        self.env.cr.execute(
+            """
+            INSERT INTO cx_tower_command_log_output (command_log_id, create_date)
+            VALUES (%s, %s)
+            """,
+            (command_log.id, now),
+        )
+        command_log.invalidate_cache()
+        self.PlanLog._cron_check_stale_plans()
+        self.assertFalse(plan_log.is_stale, "Plan with running command is not stale")
+
+        self.env.cr.execute(
+            "UPDATE cx_tower_command_log_output SET create_date = %s "
+            "WHERE command_log_id = %s",
+            (now - timedelta(hours=1), command_log.id),
+        )
+        command_log.invalidate_cache()
+        self.PlanLog._cron_check_stale_plans()
+        self.assertTrue(plan_log.is_stale, "Plan must be stale")
+
+        # Interrupted line is run again and plan continues
+        plan_log._resume()
+        self.assertEqual(
+            command_log.command_status,
+            PLAN_INTERRUPTED,
+            "Interrupted command must be marked accordingly",
+        )
+        self.assertFalse(plan_log.is_stale, "Plan must not be stale")
+        self.assertFalse(plan_log.is_running, "Plan must be finished")
+        self.assertEqual(plan_log.plan_status, 0, "Plan status must be 0")
+        self.assertEqual(
+            len(plan_log.command_log_ids), 3, "Both plan lines must be executed"
+        )
+
+    def test_plan_log_auto_resume(self):
+        """Stale flight plans are resumed without committing the cron transaction"""
+        plan_log = self.PlanLog.create(
+            {
+                "server_id": self.server_test_1.id,
+                "plan_id": self.plan_1.id,
+                "is_running": True,
+                "start_date": fields.Datetime.now(),
+                "plan_line_executed_id": self.plan_line_1.id,
+            }
+        )
+        plan_log.flush()
+        self.env.cr.execute(
+            """
+            UPDATE cx_tower_plan_log SET write_date = write_date - interval '1 hour'
+            WHERE id = %s
+            """,
+            (plan_log.id,),
+        )
+        plan_log.invalidate_cache()
+        set_param = self.env["ir.config_parameter"].sudo().set_param
+        set_param("cetmix_tower_server.plan_stale_timeout", 10)
+        set_param("cetmix_tower_server.plan_stale_auto_resume", "True")
+        set_param("cetmix_tower_server.plan_commit_between_lines", "True")
+
+        with patch.object(threading.current_thread(), "testing", False):
+            with patch.object(type(self.env.cr), "commit", autospec=True) as commit:
+                self.PlanLog._cron_check_stale_plans()
+                self.assertNotIn(
+                    call(self.env.cr),
+                    commit.call_args_list,
+                    "Cron must not be committed",
+                )
+                self.assertTrue(
+                    plan_log.is_running,
+                    "Rest of the plan must be run after the cron is committed",
+                )
+
+                # Plan is continued in its own cursor
+                self.registry.enter_test_mode(self.cr)
+                self.addCleanup(self.registry.leave_test_mode)
+                self.env.cr.postcommit.run()
+        plan_log.invalidate_cache()
+        self.assertFalse(plan_log.is_running, "Plan must be resumed and finished")
+        self.assertEqual(plan_log.plan_status, 0, "Plan status must be 0")
@@ -77,6 +77,32 @@ class TestTowerReference(TestTowerCommon):
         yet_another_template_copy.write({"reference": "chad"})
         self.assertEqual(yet_another_template_copy.reference, "chad")
 
+    def test_reference_generation_bulk(self):
+        """Test reference generation for several records at once"""
+        templates = self.ServerTemplate.create(
+            [{"name": "Such Much Template"} for i in range(3)]
+            + [{"name": "Wow", "reference": "such_much_template"}]
+        )
+        self.assertEqual(
+            templates.mapped("reference"),
+            [
+                "such_much_template",
+                "such_much_template_2",
+                "such_much_template_3",
+                "such_much_template_4",
+            ],
+            "References must be unique",
+        )
+
+        # Copy name counter must consider existing copies
+        template = templates[0]
+        template.copy()
+        self.assertEqual(
+            template.copy().name,
+            "Such Much Template (copy 2)",
+            "Copied name must be unique",
+        )
+
     def test_search_by_reference(self):
         """Search record by its reference"""
 
@@ -92,3 +118,29 @@ class TestTowerReference(TestTowerCommon):
         # Search using malformed (case sensitive)
         search_result = self.ServerTemplate.get_by_reference("not_much_template")
         self.assertEqual(len(search_result), 0, "Result should be empty")
+
+        # Search using old reference after the reference is modified
+        server_template.write({"reference": "wow_much_template"})
+        search_result = self.ServerTemplate.get_by_reference("such_much_template")
+        self.assertEqual(len(search_result), 0, "Result should be empty")
+        search_result = self.ServerTemplate.get_by_reference("wow_much_template")
+        self.assertEqual(server_template, search_result, "Template must be found")
+
+        # Search for several references at once
+        result = self.ServerTemplate.get_by_references(
+            ["wow_much_template", self.server_template_sample.reference, "no_such"]
+        )
+        self.assertEqual(
+            result,
+            {
+                "wow_much_template": server_template,
+                self.server_template_sample.reference: self.server_template_sample,
+                "no_such": self.ServerTemplate,
+            },
+            "Wrong records",
+        )
+
+        # Search using reference after the record is deleted
+        server_template.unlink()
+        search_result = self.ServerTemplate.get_by_reference("wow_much_template")
+        self.assertEqual(len(search_result), 0, "Result should be empty")
@@ -1,4 +1,7 @@
-from odoo.exceptions import AccessError
+import threading
+from unittest.mock import patch
+
+from odoo.exceptions import AccessError, ValidationError
 
 from .common import TestTowerCommon
 
@@ -251,3 +254,50 @@ class TestTowerServer(TestTowerCommon):
         server.toggle_active()
         server.toggle_active()
         self.assertTrue(server, msg="Server must be unarchived")
+
+    def test_fan_out_parallel(self):
+        """Servers are processed by parallel workers using their own cursors"""
+        servers = self.server_test_1 | self.server_test_2
+        calls = []
+
+        def fan_out_target(server, value, fail_server_id=None):
+            calls.append((server.id, server.env.cr, threading.current_thread().name))
+            if server.id == fail_server_id:
+                raise ValidationError("Test error")
+            return f"{server.name}: {value}"
+
+        # Let worker threads use the test transaction
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+        with patch.multiple(
+            self.registry["cx.tower.server"],
+            _get_fan_out_max_workers=lambda server: 2,
+            _fan_out_test_target=fan_out_target,
+            create=True,
+        ):
+            results = servers._fan_out("_fan_out_test_target", "ok")
+            self.assertEqual(
+                results,
+                {
+                    self.server_test_1.id: "Test 1: ok",
+                    self.server_test_2.id: "Test Server #2: ok",
+                },
+            )
+            self.assertEqual(len(calls), 2)
+            for _server_id, cr, thread_name in calls:
+                self.assertIsNot(cr, self.env.cr, "Worker must use its own cursor")
+                self.assertTrue(thread_name.startswith("cetmix_tower"))
+
+            # Error of a worker is raised when all servers are processed
+            calls.clear()
+            with self.assertLogs(
+                "odoo.addons.cetmix_tower_server.models.cx_tower_server",
+                level="ERROR",
+            ):
+                with self.assertRaises(ValidationError):
+                    servers._fan_out(
+                        "_fan_out_test_target",
+                        "ok",
+                        fail_server_id=self.server_test_1.id,
+                    )
+            self.assertEqual(len(calls), 2, "All servers must be processed")
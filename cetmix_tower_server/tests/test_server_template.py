@@ -1,3 +1,5 @@
+from odoo.exceptions import ValidationError
+
 from .common import TestTowerCommon
 
 
@@ -199,3 +201,82 @@ class TestTowerServerTemplate(TestTowerCommon):
             "new_value",
             "New variable values should be 'new_values'",
         )
+
+    def test_create_servers_from_templates(self):
+        """
+        Create several servers at once
+        """
+        self.VariableValues.create(
+            {
+                "variable_id": self.variable_url.id,
+                "server_template_id": self.server_template_sample.id,
+                "value_char": "test template url",
+            }
+        )
+        self.server_template_sample.flight_plan_id = self.plan_1
+
+        servers = self.CetmixTower.servers_create_from_templates(
+            [
+                {
+                    "template_reference": self.server_template_sample.reference,
+                    "server_name": f"Fleet server {i}",
+                    "ip_v4_address": f"10.0.0.{i}",
+                    "configuration_variables": {"fleet_number": str(i)},
+                }
+                for i in range(3)
+            ]
+        )
+        self.assertEqual(len(servers), 3, "3 servers must be created")
+        self.assertEqual(
+            servers.mapped("ip_v4_address"),
+            ["10.0.0.0", "10.0.0.1", "10.0.0.2"],
+            "Server values must be set",
+        )
+        for i, server in enumerate(servers):
+            self.assertEqual(
+                server.server_template_id,
+                self.server_template_sample,
+                "Server must be created from template",
+            )
+            values = {
+                value.variable_id.reference: value.value_char
+                for value in server.variable_value_ids
+            }
+            self.assertEqual(
+                values,
+                {"test_url": "test template url", "fleet_number": str(i)},
+                "Wrong variable values",
+            )
+
+        # New variable is created only once
+        self.assertEqual(
+            self.Variable.search_count([("reference", "=like", "fleet_number%")]),
+            1,
+            "Variable must be created once",
+        )
+
+        # Flight plan is run on every new server
+        plan_logs = self.env["cx.tower.plan.log"].search(
+            [("plan_id", "=", self.plan_1.id), ("server_id", "in", servers.ids)]
+        )
+        self.assertEqual(plan_logs.server_id, servers, "Plan must run on all servers")
+
+    def test_create_servers_from_templates_invalid(self):
+        """
+        No servers are created if any spec is invalid
+        """
+        valid_spec = {
+            "template_reference": self.server_template_sample.reference,
+            "server_name": "Fleet server",
+        }
+        server_count = self.Server.search_count([])
+        for spec in (
+            {"template_reference": "no_such_template", "server_name": "Nope"},
+            {"template_reference": self.server_template_sample.reference},
+            {"server_name": "Nope"},
+        ):
+            with self.assertRaises(ValidationError):
+                self.CetmixTower.servers_create_from_templates([valid_spec, spec])
+        self.assertEqual(
+            self.Server.search_count([]), server_count, "No servers must be created"
+        )
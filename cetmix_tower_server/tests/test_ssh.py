@@ -0,0 +1,279 @@
+import threading
+import time
+
+from odoo.tests import TransactionCase
+
+from ..models.cx_tower_server import (
+    SSH,
+    HostRateLimiter,
+    OutputBuffer,
+    SSHConnectionPool,
+)
+
+
+class FakeTransport:
+    """Mimics paramiko Transport"""
+
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def send_ignore(self):
+        if not self.active:
+            raise EOFError()
+
+
+class FakeClient:
+    """Mimics paramiko SSHClient"""
+
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.closed = False
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.closed = True
+        self.transport.active = False
+
+
+class FakeChannel:
+    """Mimics paramiko Channel of the executed command"""
+
+    def __init__(self, stdout, stderr, status=0):
+        self.stdout = list(stdout)
+        self.stderr = list(stderr)
+        self.status = status
+
+    def recv_ready(self):
+        return bool(self.stdout)
+
+    def recv(self, size):
+        return self.stdout.pop(0)
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def recv_stderr(self, size):
+        return self.stderr.pop(0)
+
+    def exit_status_ready(self):
+        return not self.stdout and not self.stderr
+
+    def recv_exit_status(self):
+        return self.status
+
+
+class FakeStream:
+    """Mimics paramiko ChannelFile"""
+
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class TestTowerSSH(TransactionCase):
+    def setUp(self):
+        super().setUp()
+        self.pool = SSHConnectionPool(idle_timeout=300, max_per_host=2)
+        self.host_key = ("localhost", "22", "admin")
+        self.fingerprint = self.pool.get_fingerprint("p", "password")
+        self.opened = []
+
+    def connect(self):
+        client = FakeClient()
+        self.opened.append(client)
+        return client
+
+    def test_pool_reuse_connection(self):
+        """Released connection is reused for the same host"""
+        client = self.pool.acquire(self.host_key, self.fingerprint, self.connect)
+        self.pool.release(client)
+        client_2 = self.pool.acquire(self.host_key, self.fingerprint, self.connect)
+        self.assertIs(client, client_2, "Connection must be reused")
+        self.assertEqual(len(self.opened), 1, "Only one connection must be opened")
+
+        # Connection in use is not shared
+        client_3 = self.pool.acquire(self.host_key, self.fingerprint, self.connect)
+        self.assertIsNot(client_2, client_3, "New connection must be opened")
+
+    def test_pool_dead_connection(self):
+        """Dead connection is not reused"""
+        client = self.pool.acquire(self.host_key, self.fingerprint, self.connect)
+        self.pool.release(client)
+        client.transport.active = False
+        client_2 = self.pool.acquire(self.host_key, self.fingerprint, self.connect)
+        self.assertIsNot(client, client_2, "Dead connection must not be reused")
+        self.assertTrue(client.closed, "Dead connection must be closed")
+
+    def test_pool_credentials_changed(self):
+        """Connections are evicted when credentials change"""
+        client = self.pool.acquire(self.host_key, self.fingerprint, self.connect)
+        self.pool.release(client)
+        new_fingerprint = self.pool.get_fingerprint("p", "new_password")
+        client_2 = self.pool.acquire(self.host_key, new_fingerprint, self.connect)
+        self.assertIsNot(client, client_2, "Connection must not be reused")
+        self.assertTrue(client.closed, "Outdated connection must be closed")
+
+        # Connection opened with outdated credentials is closed on release
+        client_3 = self.pool.acquire(
+            self.host_key, self.fingerprint, self.connect
+        )  # old credentials again
+        self.pool.acquire(self.host_key, new_fingerprint, self.connect)
+        self.pool.release(client_3)
+        self.assertTrue(client_3.closed, "Outdated connection must be closed")
+
+    def test_pool_limits(self):
+        """Idle timeout and max connections per host"""
+        clients = [
+            self.pool.acquire(self.host_key, self.fingerprint, self.connect)
+            for i in range(3)
+        ]
+        for client in clients:
+            self.pool.release(client)
+        self.assertTrue(clients[2].closed, "Connection above the limit must be closed")
+        self.assertFalse(clients[0].closed, "Connection must be kept")
+
+        # Expire idle connections
+        self.pool.configure(idle_timeout=-1)
+        self.pool.acquire(self.host_key, self.fingerprint, self.connect)
+        self.assertTrue(clients[0].closed, "Expired connection must be closed")
+        self.assertTrue(clients[1].closed, "Expired connection must be closed")
+
+    def test_pool_check_connection_without_lock(self):
+        """Connection is checked without holding the pool lock"""
+        locked = []
+
+        def try_lock():
+            if self.pool._lock.acquire(timeout=1):
+                self.pool._lock.release()
+                locked.append(False)
+            else:
+                locked.append(True)
+
+        def send_ignore():
+            # Lock must be available to other threads during the network call
+            thread = threading.Thread(target=try_lock)
+            thread.start()
+            thread.join()
+
+        client = self.pool.acquire(self.host_key, self.fingerprint, self.connect)
+        client.transport.send_ignore = send_ignore
+        self.pool.release(client)
+        self.assertIs(
+            self.pool.acquire(self.host_key, self.fingerprint, self.connect), client
+        )
+        self.assertEqual(locked, [False, False], "Lock must not be held")
+
+    def test_pool_sftp_session(self):
+        """SFTP session is shared while the connection is alive"""
+        sessions = []
+
+        class FakeChannel:
+            closed = False
+
+        class FakeSFTP:
+            def __init__(self):
+                self.channel = FakeChannel()
+                sessions.append(self)
+
+            def get_channel(self):
+                return self.channel
+
+            def close(self):
+                self.channel.closed = True
+
+        client = self.pool.acquire(self.host_key, self.fingerprint, self.connect)
+        sftp = self.pool.get_sftp(client, FakeSFTP)
+        self.pool.release(client)
+        client = self.pool.acquire(self.host_key, self.fingerprint, self.connect)
+        self.assertIs(
+            self.pool.get_sftp(client, FakeSFTP), sftp, "SFTP session must be reused"
+        )
+
+        # Closed session is reopened
+        sftp.close()
+        self.assertIsNot(
+            self.pool.get_sftp(client, FakeSFTP), sftp, "New session must be opened"
+        )
+        self.assertEqual(len(sessions), 2, "Two sessions must be opened")
+
+        # Session is closed along with its connection
+        self.pool.discard(client)
+        self.assertTrue(sessions[1].channel.closed, "SFTP session must be closed")
+
+    def test_host_rate_limiter(self):
+        """Operations on the same host are spread by interval"""
+        rate_limiter = HostRateLimiter(interval=0.05)
+        start = time.monotonic()
+        rate_limiter.wait("host_1")
+        rate_limiter.wait("host_2")
+        self.assertLess(time.monotonic() - start, 0.05, "Different hosts must not wait")
+        rate_limiter.wait("host_1")
+        self.assertGreaterEqual(
+            time.monotonic() - start, 0.05, "Same host must wait for interval"
+        )
+
+    def test_exec_command_output(self):
+        """Command output is read in chunks and limited by size"""
+        channel = FakeChannel([b"line 1\nli", b"ne 2\n"], [b"error\n"], status=1)
+        client = FakeClient()
+        client.exec_command = lambda command: (
+            None,
+            FakeStream(channel),
+            FakeStream(channel),
+        )
+        ssh = SSH("localhost", 22, "admin", "password")
+        ssh._ssh = client
+        flushed = []
+        status, response, error = ssh.exec_command(
+            "ls",
+            output_callback=lambda resp, err: flushed.append((resp, err)),
+        )
+        self.assertEqual(status, 1, "Status must be 1")
+        self.assertEqual(response, ["line 1\n", "line 2\n"], "Wrong response")
+        self.assertEqual(error, ["error\n"], "Wrong error")
+        # Only new output is passed to the callback
+        self.assertEqual(len(flushed), 2, "Output must be passed by chunks")
+        self.assertEqual(
+            "".join(resp for resp, err in flushed), "line 1\nline 2\n", "Wrong output"
+        )
+        self.assertEqual("".join(err for resp, err in flushed), "error\n")
+
+        # Multibyte character split between chunks
+        output = OutputBuffer()
+        output.write("é".encode()[:1])
+        self.assertEqual(output.read_new(), "", "Incomplete character must be kept")
+        output.write("é".encode()[1:])
+        self.assertEqual(output.read_new(), "é", "Character must be decoded")
+        self.assertEqual(output.read_new(), "", "Output must be read only once")
+
+        # Keep the tail of the output only
+        output = OutputBuffer(max_size=10)
+        output.write(b"line 1\n")
+        output.write(b"line 2\nline 3\n")
+        self.assertEqual(output.size, 10, "Output size must be limited")
+        self.assertEqual(
+            output.get_lines()[1:], [" 2\n", "line 3\n"], "Tail must be kept"
+        )
+        self.assertIn("11", output.get_lines()[0], "Truncated size must be shown")
+
+    def test_sudo_script_stream(self):
+        """Status markers are removed from the streamed script output"""
+        marker = "CX_TOWER_STEP_test"
+        flushed = []
+        stream = self.env["cx.tower.server"]._get_ssh_sudo_script_stream(
+            lambda resp, err, final=False: flushed.append(resp), marker
+        )
+        # Marker line is split between chunks
+        stream("line 1\n", "")
+        stream(f"ok\n\n{marker[:5]}", "")
+        stream(f"{marker[5:]}:0\nline 2\n", "")
+        self.assertNotIn(marker, "".join(flushed), "Marker must be removed")
+        self.assertEqual("".join(flushed), "line 1\nok\nline 2")
+
+        # Held back text is passed when the script is finished
+        stream("", "", final=True)
+        self.assertEqual("".join(flushed), "line 1\nok\nline 2\n")
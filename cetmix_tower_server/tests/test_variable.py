@@ -3,7 +3,7 @@ from unittest.mock import patch
 from psycopg2 import IntegrityError
 
 from odoo import _, fields
-from odoo.exceptions import AccessError, ValidationError
+from odoo.exceptions import AccessError, UserError, ValidationError
 from odoo.tests.common import Form
 from odoo.tools.misc import mute_logger
 
@@ -206,6 +206,70 @@ class TestTowerVariable(TestTowerCommon):
         )
         self.assertEqual(var_version, "10.0", msg="Variable 'version' must be '10.0'")
 
+    def test_variable_values_multiple_servers(self):
+        """Test variable values of several servers fetched at once"""
+        server_test_var = self.Server.create(
+            {
+                "name": "Test Var",
+                "os_id": self.os_debian_10.id,
+                "ip_v4_address": "localhost",
+                "ssh_username": "bob",
+                "ssh_password": "pass",
+                "variable_value_ids": [
+                    (0, 0, {"variable_id": self.variable_dir.id, "value_char": "/srv"})
+                ],
+            }
+        )
+        self.server_test_1.write(
+            {
+                "variable_value_ids": [
+                    (0, 0, {"variable_id": self.variable_dir.id, "value_char": "/web"})
+                ]
+            }
+        )
+
+        # Global value uses variable that has server specific values
+        self.VariableValues.create(
+            {
+                "variable_id": self.variable_path.id,
+                "value_char": "{{ test_dir }}/{{ test_version }}",
+            }
+        )
+        self.VariableValues.create(
+            {"variable_id": self.variable_version.id, "value_char": "10.0"}
+        )
+
+        res = (self.server_test_1 | server_test_var).get_variable_values(
+            ["test_path_", "test_url"]
+        )
+        self.assertEqual(
+            res[self.server_test_1.id],
+            {"test_path_": "/web/10.0", "test_url": None},
+            "Variable values of Server 1 are wrong",
+        )
+        self.assertEqual(
+            res[server_test_var.id],
+            {"test_path_": "/srv/10.0", "test_url": None},
+            "Variable values of Test Var server are wrong",
+        )
+
+    def test_variable_values_cycle(self):
+        """Variable values that reference each other raise an error"""
+        with Form(self.server_test_1) as f:
+            with f.variable_value_ids.new() as line:
+                line.variable_id = self.variable_dir
+                line.value_char = "{{ test_path_ }}/dir"
+            with f.variable_value_ids.new() as line:
+                line.variable_id = self.variable_path
+                line.value_char = "{{ test_url }}/path"
+            with f.variable_value_ids.new() as line:
+                line.variable_id = self.variable_url
+                line.value_char = "{{ test_dir }}/url"
+            f.save()
+
+        with self.assertRaisesRegex(UserError, "test_dir"):
+            self.server_test_1.get_variable_values(["test_dir"])
+
     def test_variable_values_unlink(self):
         """Ensure variable values are deleted properly
         - Create a new server
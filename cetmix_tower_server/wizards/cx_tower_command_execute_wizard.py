@@ -153,13 +153,12 @@ class CxTowerCommandExecuteWizard(models.TransientModel):
         )
         # Add custom values for log
         custom_values = {"log": {"label": log_label}}
-        for server in self.server_ids:
-            server.execute_command(
-                self.command_id,
-                sudo=self.use_sudo,
-                path=path_value,
-                **custom_values,
-            )
+        self.server_ids.execute_command_multi(
+            self.command_id,
+            sudo=self.use_sudo,
+            path=path_value,
+            **custom_values,
+        )
         return {
             "type": "ir.actions.act_window",
             "name": _("Command Log"),
@@ -1,11 +1,252 @@
 # Copyright (C) 2022 Cetmix OÜ
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
-from odoo import models
+import copy
+import logging
+
+from odoo import _, fields, models
+
+from odoo.addons.queue_job.exception import RetryableJobError
+
+_logger = logging.getLogger(__name__)
+
+# Used to compose advisory lock keys for host slots
+HOST_SLOT_LOCK_NAMESPACE = 0x4354
 
 
 class CxTowerServer(models.Model):
     _inherit = "cx.tower.server"
 
+    def execute_command_multi(self, command, path=None, sudo=None, **kwargs):
+        """Execute command on all servers in the recordset.
+        Commands are grouped into batches and each batch is run in a single job.
+        Settings are taken from the system parameters:
+            - `cetmix_tower_server_queue.batch_size`: max number of commands
+                in a single job.
+            - `cetmix_tower_server_queue.batch_priority`: priority of the jobs.
+
+        Args:
+            command (cx.tower.command()): Command record
+            path, sudo, kwargs: check `execute_command()`
+
+        Returns:
+            dict: {server.id: `execute_command()` result}
+        """
+        # Commands are collected here instead of creating a job for each of them
+        tasks = []
+        results = {}
+        for server in self.with_context(cx_tower_queue_tasks=tasks):
+            results[server.id] = server.execute_command(
+                command, path=path, sudo=sudo, **copy.deepcopy(kwargs)
+            )
+        self._enqueue_command_batches(tasks)
+        return results
+
+    def _get_job_channel(self):
+        """Get queue job channel for the servers.
+        Jobs of a single server are put into a dedicated channel,
+        eg `root.server_5`. Such channel can be configured
+        in the `queue_job` settings. Otherwise parent channel is used.
+
+        Returns:
+            Char: channel name
+        """
+        channel = (
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("cetmix_tower_server_queue.channel", default="root")
+        )
+        if len(self) == 1:
+            channel = f"{channel}.server_{self.id}"
+        return channel
+
+    def _get_host_retry_delay(self):
+        """Get delay in seconds before job postponed because of the
+        `cetmix_tower_server_queue.max_parallel_per_host` limit is retried.
+
+        Returns:
+            int: delay in seconds
+        """
+        return int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("cetmix_tower_server_queue.host_retry_delay", default=10)
+        )
+
+    def _try_lock_host_slot(self):
+        """Try to take one of the slots available for the server.
+        Number of slots is set in the `cetmix_tower_server_queue.max_parallel_per_host`
+        system parameter. 0 means no limit.
+        Slot is released when the current transaction is finished.
+
+        Returns:
+            bool: True if slot is taken
+        """
+        self.ensure_one()
+        limit = int(
+            self.env["ir.config_parameter"]
+            .sudo()
+            .get_param("cetmix_tower_server_queue.max_parallel_per_host", default=4)
+        )
+        if limit <= 0:
+            return True
+        for slot in range(min(limit, 256)):
+            self.env.cr.execute(
+                "SELECT pg_try_advisory_xact_lock(%s)",
+                ((HOST_SLOT_LOCK_NAMESPACE << 48) + (self.id << 8) + slot,),
+            )
+            if self.env.cr.fetchone()[0]:
+                return True
+        return False
+
+    def _enqueue_command_batches(self, tasks, eta=None):
+        """Create jobs for the collected commands.
+        Commands of the same server are put into the same batch when possible.
+
+        Args:
+            tasks (list of dict): values returned by `_prepare_command_task()`
+            eta (int, optional): delay in seconds before jobs are started
+        """
+        if not tasks:
+            return
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        batch_size = max(
+            int(get_param("cetmix_tower_server_queue.batch_size", default=50)), 1
+        )
+        priority = int(
+            get_param("cetmix_tower_server_queue.batch_priority", default=10)
+        )
+
+        tasks = sorted(tasks, key=lambda task: task["server_id"])
+        for i in range(0, len(tasks), batch_size):
+            batch = tasks[i : i + batch_size]
+            servers = self.browse(sorted({task["server_id"] for task in batch}))
+            servers.with_delay(
+                priority=priority,
+                eta=eta,
+                channel=servers._get_job_channel(),
+                description=_(
+                    "Run %(count)s commands on %(servers)s servers",
+                    count=len(batch),
+                    servers=len(servers),
+                ),
+            )._command_runner_batch(batch)
+
+    def _prepare_command_task(
+        self,
+        command,
+        log_record,
+        rendered_command_code,
+        rendered_command_path=None,
+        **kwargs,
+    ):
+        """Prepare values used to run command in a batch job.
+
+        Args:
+            check `_command_runner()`
+
+        Returns:
+            dict: command values
+        """
+        self.ensure_one()
+        return {
+            "server_id": self.id,
+            "command_id": command.id,
+            "log_id": log_record.id,
+            "code": rendered_command_code,
+            "path": rendered_command_path,
+            "use_sudo": self._context.get("use_sudo"),
+            "kwargs": kwargs,
+        }
+
+    def _command_runner_batch(self, tasks):
+        """Run commands collected by `execute_command_multi()`.
+        A single SSH connection is used for all commands of the same server.
+        Commands of the servers that have no free slots are postponed.
+
+        Args:
+            tasks (list of dict): values returned by `_prepare_command_task()`
+        """
+        connections = {}
+        # {server.id: slot is taken}
+        slots = {}
+        postponed_tasks = []
+        # Users are notified with a single digest when the batch is finished
+        notifications = []
+        servers = self.with_context(cx_tower_command_notifications=notifications)
+        command_obj = servers.env["cx.tower.command"]
+        log_obj = servers.env["cx.tower.command.log"]
+        try:
+            for task in tasks:
+                server = servers.browse(task["server_id"])
+                if server.id not in slots:
+                    slots[server.id] = server._try_lock_host_slot()
+                if not slots[server.id]:
+                    postponed_tasks.append(task)
+                    continue
+
+                log_record = log_obj.browse(task["log_id"])
+                try:
+                    with self.env.cr.savepoint():
+                        if server.id not in connections:
+                            connections[server.id] = server._connect(
+                                raise_on_error=False
+                            )
+                        server.with_context(use_sudo=task["use_sudo"])._command_runner(
+                            command_obj.browse(task["command_id"]),
+                            log_record,
+                            task["code"],
+                            task["path"],
+                            connections[server.id],
+                            **task["kwargs"],
+                        )
+                except Exception as e:
+                    _logger.error(
+                        "Failed to run command %s on server %s: %s",
+                        task["command_id"],
+                        server.name,
+                        e,
+                    )
+                    log_record.finish(fields.Datetime.now(), -1, None, str(e))
+        finally:
+            for connection in connections.values():
+                if hasattr(connection, "disconnect"):
+                    connection.disconnect()
+        log_obj._send_command_notifications(notifications)
+
+        if postponed_tasks:
+            self._enqueue_command_batches(
+                postponed_tasks, eta=self._get_host_retry_delay()
+            )
+
+    def _command_runner_queued(
+        self,
+        command,
+        log_record,
+        rendered_command_code,
+        rendered_command_path=None,
+        ssh_connection=None,
+        **kwargs,
+    ):
+        """Run command in a job.
+        Job is retried later if the server has no free slots.
+        Check `_command_runner()` for the arguments.
+        """
+        self.ensure_one()
+        if not self._try_lock_host_slot():
+            raise RetryableJobError(
+                _("Too many commands are running on server %(name)s", name=self.name),
+                seconds=self._get_host_retry_delay(),
+                ignore_retry=True,
+            )
+        return self._command_runner(
+            command,
+            log_record,
+            rendered_command_code,
+            rendered_command_path,
+            ssh_connection,
+            **kwargs,
+        )
+
     def _command_runner_wrapper(
         self,
         command,
@@ -15,9 +256,22 @@ class CxTowerServer(models.Model):
         ssh_connection=None,
         **kwargs,
     ):
+        # Collect command to run it later in a batch
+        tasks = self._context.get("cx_tower_queue_tasks")
+        if log_record and tasks is not None:
+            tasks.append(
+                self._prepare_command_task(
+                    command,
+                    log_record,
+                    rendered_command_code,
+                    rendered_command_path,
+                    **kwargs,
+                )
+            )
+
         # Use runner only if command log record is provided
-        if log_record:
-            self.with_delay()._command_runner(
+        elif log_record:
+            self.with_delay(channel=self._get_job_channel())._command_runner_queued(
                 command,
                 log_record,
                 rendered_command_code,
@@ -0,0 +1,211 @@
+from unittest.mock import patch
+
+from odoo.addons.cetmix_tower_server.tests.common import TestTowerCommon
+from odoo.addons.queue_job.exception import RetryableJobError
+from odoo.addons.queue_job.tests.common import trap_jobs
+
+
+class TestTowerServerQueue(TestTowerCommon):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.server_test_2 = self.server_test_1.copy({"name": "Test 2"})
+        self.server_test_3 = self.server_test_1.copy({"name": "Test 3"})
+        self.servers = self.server_test_1 | self.server_test_2 | self.server_test_3
+
+    def _collect_command_tasks(self, servers, commands):
+        """Collect tasks of the commands run on the servers
+
+        Args:
+            servers (cx.tower.server()): servers to run commands on
+            commands (cx.tower.command()): commands to run
+
+        Returns:
+            list of dict: collected tasks
+        """
+        tasks = []
+        for command in commands:
+            for server in servers.with_context(cx_tower_queue_tasks=tasks):
+                server.execute_command(command)
+        return tasks
+
+    def test_execute_command_multi_batch(self):
+        """Commands run on several servers are grouped into batch jobs"""
+        set_param = self.env["ir.config_parameter"].sudo().set_param
+        set_param("cetmix_tower_server_queue.batch_size", 2)
+        set_param("cetmix_tower_server_queue.batch_priority", 5)
+
+        with trap_jobs() as trap:
+            self.servers.execute_command_multi(self.command_create_dir)
+            trap.assert_jobs_count(2)
+            first_job, second_job = trap.enqueued_jobs
+            self.assertEqual(len(first_job.args[0]), 2, "Batch size must be used")
+            self.assertEqual(len(second_job.args[0]), 1, "Rest is put into new job")
+            self.assertEqual(
+                first_job.recordset, self.server_test_1 | self.server_test_2
+            )
+            self.assertEqual(second_job.recordset, self.server_test_3)
+            for job in trap.enqueued_jobs:
+                self.assertEqual(job.method_name, "_command_runner_batch")
+                self.assertEqual(job.priority, 5, "Batch priority must be used")
+
+        logs = self.CommandLog.search([("server_id", "in", self.servers.ids)])
+        self.assertEqual(len(logs), 3, "Log must be created for each server")
+        self.assertTrue(all(logs.mapped("is_running")), "Commands are not run yet")
+
+    def test_enqueue_command_batches_by_server(self):
+        """Commands of the same server are put into the same batch"""
+        self.env["ir.config_parameter"].sudo().set_param(
+            "cetmix_tower_server_queue.batch_size", 2
+        )
+        servers = self.server_test_2 | self.server_test_1
+        tasks = self._collect_command_tasks(
+            servers, self.command_create_dir | self.command_list_dir
+        )
+        with trap_jobs() as trap:
+            self.Server._enqueue_command_batches(tasks)
+            trap.assert_jobs_count(2)
+            first_job, second_job = trap.enqueued_jobs
+            self.assertEqual(first_job.recordset, self.server_test_1)
+            self.assertEqual(
+                {task["server_id"] for task in first_job.args[0]},
+                {self.server_test_1.id},
+            )
+            self.assertEqual(second_job.recordset, self.server_test_2)
+            self.assertEqual(
+                {task["server_id"] for task in second_job.args[0]},
+                {self.server_test_2.id},
+            )
+
+    def test_command_runner_batch(self):
+        """Single connection is used for all commands of the same server"""
+        tasks = self._collect_command_tasks(
+            self.server_test_1, self.command_create_dir | self.command_list_dir
+        )
+        with patch.object(
+            self.registry["cx.tower.server"], "_connect", return_value=True
+        ) as connect:
+            self.server_test_1._command_runner_batch(tasks)
+        connect.assert_called_once()
+        logs = self.CommandLog.browse([task["log_id"] for task in tasks])
+        self.assertFalse(any(logs.mapped("is_running")), "Commands must be finished")
+        self.assertEqual(logs.mapped("command_status"), [0, 0])
+
+    def test_command_runner_batch_error(self):
+        """Failed command does not affect other commands of the batch"""
+        tasks = self._collect_command_tasks(
+            self.server_test_1 | self.server_test_2, self.command_create_dir
+        )
+        failed_log = self.CommandLog.browse(tasks[0]["log_id"])
+        command_runner = type(self.Server)._command_runner
+
+        def command_runner_failing(this, command, log_record, *args, **kwargs):
+            if log_record == failed_log:
+                # Changes are rolled back along with the savepoint
+                log_record.label = "Failed"
+                raise ValueError("Test error")
+            return command_runner(this, command, log_record, *args, **kwargs)
+
+        with patch.object(
+            self.registry["cx.tower.server"], "_command_runner", command_runner_failing
+        ):
+            with self.assertLogs(
+                "odoo.addons.cetmix_tower_server_queue.models.cx_tower_server",
+                level="ERROR",
+            ):
+                (self.server_test_1 | self.server_test_2)._command_runner_batch(tasks)
+
+        self.assertFalse(failed_log.is_running)
+        self.assertEqual(failed_log.command_status, -1)
+        self.assertEqual(failed_log.command_error, "Test error")
+        self.assertFalse(failed_log.label, "Changes of failed command are rolled back")
+        log = self.CommandLog.browse(tasks[1]["log_id"])
+        self.assertFalse(log.is_running)
+        self.assertEqual(log.command_status, 0, "Other command must succeed")
+
+    def test_get_job_channel(self):
+        """Jobs of a single server are put into a dedicated channel"""
+        self.assertEqual(
+            self.server_test_1._get_job_channel(),
+            f"root.server_{self.server_test_1.id}",
+        )
+        self.assertEqual(self.servers._get_job_channel(), "root")
+
+        self.env["ir.config_parameter"].sudo().set_param(
+            "cetmix_tower_server_queue.channel", "root.tower"
+        )
+        self.assertEqual(
+            self.server_test_1._get_job_channel(),
+            f"root.tower.server_{self.server_test_1.id}",
+        )
+
+        # Batch of a single server is put into its channel
+        tasks = self._collect_command_tasks(
+            self.server_test_1, self.command_create_dir | self.command_list_dir
+        )
+        with trap_jobs() as trap:
+            self.Server._enqueue_command_batches(tasks)
+            trap.assert_jobs_count(1)
+            self.assertEqual(
+                trap.enqueued_jobs[0].channel,
+                f"root.tower.server_{self.server_test_1.id}",
+            )
+
+    def test_command_runner_queued_no_slot(self):
+        """Job is retried later if the server has no free slots"""
+        self.env["ir.config_parameter"].sudo().set_param(
+            "cetmix_tower_server_queue.host_retry_delay", 30
+        )
+        with trap_jobs() as trap:
+            self.server_test_1.execute_command(self.command_create_dir)
+            trap.assert_jobs_count(1)
+            job = trap.enqueued_jobs[0]
+            self.assertEqual(job.method_name, "_command_runner_queued")
+            self.assertEqual(job.channel, f"root.server_{self.server_test_1.id}")
+
+            with patch.object(
+                self.registry["cx.tower.server"],
+                "_try_lock_host_slot",
+                return_value=False,
+            ):
+                with self.assertRaises(RetryableJobError) as error:
+                    job.perform()
+            self.assertTrue(error.exception.ignore_retry, "Retries must not count")
+            self.assertEqual(error.exception.seconds, 30)
+            log = self.CommandLog.browse(job.args[1].id)
+            self.assertTrue(log.is_running, "Command must not be run")
+
+            # Command is run when a slot is free
+            job.perform()
+            self.assertFalse(log.is_running)
+            self.assertEqual(log.command_status, 0)
+
+    def test_command_runner_batch_postpone(self):
+        """Commands of the servers without free slots are postponed"""
+        tasks = self._collect_command_tasks(
+            self.server_test_1 | self.server_test_2, self.command_create_dir
+        )
+        busy_server = self.server_test_2
+
+        def try_lock_host_slot(this):
+            return this != busy_server
+
+        with trap_jobs() as trap:
+            with patch.object(
+                self.registry["cx.tower.server"],
+                "_try_lock_host_slot",
+                try_lock_host_slot,
+            ):
+                (self.server_test_1 | self.server_test_2)._command_runner_batch(tasks)
+            trap.assert_jobs_count(1)
+            job = trap.enqueued_jobs[0]
+            self.assertEqual(job.method_name, "_command_runner_batch")
+            self.assertEqual(job.recordset, busy_server)
+            self.assertEqual(job.channel, f"root.server_{busy_server.id}")
+            self.assertEqual(
+                [task["server_id"] for task in job.args[0]], [busy_server.id]
+            )
+            self.assertTrue(job.eta, "Postponed batch must be delayed")
+
+        logs = self.CommandLog.browse([task["log_id"] for task in tasks])
+        self.assertFalse(logs[0].is_running, "Command must be run")
+        self.assertTrue(logs[1].is_running, "Command must be postponed")